@@ -4,6 +4,7 @@ Based on: https://www.tutorialspoint.com/machine_learning_with_python/index.htm
 '''
 
 import db_functions
+import feature_sets
 import json
 import pandas as pd
 from pandas import set_option
@@ -177,15 +178,9 @@ def main():
         params = json.load(f)
         
         table = params['table']
+        feature_cache = params['feature_cache']
 
-    #get db parameters
-    user,password,database,host,port = db_functions.get_db_parameters()
-
-    #create connection to db with the db parameters
-    conn = db_functions.setup_connection(user,password,database,host,port)
-    conn.autocommit = True
-
-    data = pd.read_sql_query(f"SELECT * FROM training_data.{table};", conn)
+    data = db_functions.load_training_table(table, cache=feature_cache)
 
     #Data statistics
     quick_datacheck(data)
@@ -197,12 +192,7 @@ def main():
     data_skew(data)
 
     #Remove features based on correlation
-    data = data.drop(['actual_volume_lod1',
-                      'convex_hull_volume_lod1',
-                      'convex_hull_volume_lod2',
-                      'wall_area_lod1',
-                      'roof_area_lod1',
-                      'height_max_lod1'], axis='columns')
+    data = data.drop(feature_sets.CORRELATED, axis='columns')
     
     data_correlation(data, table)
     #visualision of correlation
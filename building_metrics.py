@@ -0,0 +1,648 @@
+'''
+Native engine for the 3D Building Metrics kept by import_3DBM.py.
+Computes only these metrics directly from the CityJSON surfaces with
+batched NumPy operations over all rings of a tile, instead of running the
+full 3DBM/PyVista pipeline. The output has the same columns as 3DBM.
+The surface areas are computed like 3DBM: the outer ring of every surface
+of a tile is triangulated by VTK in one PyVista mesh.
+
+The neighbour metrics (shared_walls_area, closest_distance) are 2D
+approximations, not the shared 3D wall surfaces and 3D distances of 3DBM:
+they are computed from the footprint boundaries of the buildings found with
+a grid index over the building bounding boxes, and include the buildings
+within HALO m in the adjacent tiles.
+
+Run as script to compare the output with the 3DBM results:
+python building_metrics.py native_lod1.csv merged_lod1.csv
+or to compare all metrics of a full tile with the 3DBM results of that tile,
+written to results/{tile}_native_parity.csv:
+python building_metrics.py parity-tile tile.json 3DBM_lod1.csv 3DBM_lod2.csv
+or to compare it with the 3DBM features of the training table of params.json
+(e.g. training_data.c1_rh restored from the DUMP file) for the tiles of path_3DBAG,
+from the database or exported as CSV, written to results/{table}_native_parity.csv:
+python building_metrics.py parity [c1_rh.csv]
+or to benchmark the neighbour search for increasing numbers of buildings:
+python building_metrics.py benchmark tile1.json [tile2.json ...]
+'''
+
+import json
+import os
+import sys
+from time import time
+import numpy as np
+import pandas as pd
+import pyvista as pv
+from scipy.spatial import ConvexHull, QhullError
+import cityjson_reader
+import tile_functions
+
+#Metrics in the order of the 3DBM columns kept by import_3DBM.prepare_3DBM_features
+METRICS = ['actual_volume', 'convex_hull_volume',
+           'footprint_perimeter', 'obb_width', 'obb_length',
+           'ground_area', 'wall_area', 'roof_area', 'ground_point_count',
+           'max_Z', 'min_Z', 'ground_Z',
+           'hole_count', 'shared_walls_area', 'closest_distance']
+
+#distance (m) around a tile in which buildings of adjacent tiles are taken into account for the neighbour metrics
+HALO = 100.0
+
+#metrics (3DBM columns, see METRICS) and columns of training_data (see extract_features.get_3DBM_features())
+#compared by check_parity() and check_tile_parity() and their tolerance:
+#the absolute difference (m, m2 or m3) or the difference relative to the 3DBM value, whichever is larger
+PARITY_TOLERANCE = {'actual_volume': (0.01, 0.01), 'convex_hull_volume': (0.01, 0.01),
+                    'footprint_perimeter': (0.01, 0.01), 'obb_width': (0.01, 0.01), 'obb_length': (0.01, 0.01),
+                    'ground_area': (0.01, 0.01), 'wall_area': (0.01, 0.01), 'roof_area': (0.01, 0.01),
+                    'ground_point_count': (0, 0), 'max_Z': (0.01, 0.0), 'min_Z': (0.01, 0.0), 'ground_Z': (0.01, 0.0),
+                    'hole_count': (0, 0), 'shared_walls_area': (1.0, 0.05), 'closest_distance': (0.05, 0.01),
+                    'height_max': (0.01, 0.0), 'height_min_roof': (0.01, 0.0)}
+
+#share of the buildings within the tolerance for a column to pass check_parity()
+PARITY_SHARE = 0.99
+
+def flatten_solids(solids):
+    """
+    Flatten the rings of the Solid geometries of a tile into arrays, so the metrics of all buildings can be computed at once.
+    Parameters:
+    solids -- list of (building index, geometry) with Solid geometries
+    Returns: dictionary of arrays, per ring entry (vertex index, ring index) and per ring (surface index, inner ring flag),
+    per surface (building index, semantic type)
+    """
+
+    vertex_idx, entry_ring = [], []
+    ring_surface, ring_inner = [], []
+    surface_bldg, surface_type = [], []
+
+    for bldg, geometry in solids:
+        semantics = geometry.get('semantics', {})
+        types = [s.get('type') for s in semantics.get('surfaces', [])]
+        values = semantics.get('values') or [[None] * len(shell) for shell in geometry['boundaries']]
+
+        for shell, shell_values in zip(geometry['boundaries'], values):
+            for surface, value in zip(shell, shell_values):
+                for i, ring in enumerate(surface):
+                    vertex_idx.extend(ring)
+                    entry_ring.extend([len(ring_surface)] * len(ring))
+                    ring_surface.append(len(surface_bldg))
+                    ring_inner.append(i > 0)
+                surface_bldg.append(bldg)
+                surface_type.append(types[value] if value is not None else None)
+
+    return {'vertex_idx': np.asarray(vertex_idx, dtype=np.int64),
+            'entry_ring': np.asarray(entry_ring, dtype=np.int64),
+            'ring_surface': np.asarray(ring_surface, dtype=np.int64),
+            'ring_inner': np.asarray(ring_inner, dtype=bool),
+            'surface_bldg': np.asarray(surface_bldg, dtype=np.int64),
+            'surface_type': np.asarray(surface_type, dtype=object)}
+
+def ring_edges(entry_ring):
+    """
+    Get for every ring entry the index of the next entry in the same ring, closing each ring.
+    """
+
+    n = len(entry_ring)
+    next_entry = np.arange(1, n + 1)
+    if n == 0:
+        return next_entry
+
+    last = np.flatnonzero(np.append(entry_ring[1:] != entry_ring[:-1], True))
+    first = np.concatenate(([0], last[:-1] + 1))
+    next_entry[last] = first
+    return next_entry
+
+def obb_sides(points):
+    """
+    Get the sides of the minimum-area oriented bounding box of 2D points, testing the orientation of every convex hull edge.
+    Returns: (width, length)
+    """
+
+    try:
+        hull = points[ConvexHull(points).vertices]
+    except (QhullError, ValueError):
+        return np.nan, np.nan
+
+    edges = np.roll(hull, -1, axis=0) - hull
+    angles = np.unique(np.mod(np.arctan2(edges[:, 1], edges[:, 0]), np.pi / 2))
+    cos, sin = np.cos(angles), np.sin(angles)
+
+    #rotate the hull for all edge angles at once: (n_angles, n_points)
+    x = np.outer(cos, hull[:, 0]) + np.outer(sin, hull[:, 1])
+    y = np.outer(-sin, hull[:, 0]) + np.outer(cos, hull[:, 1])
+    dx = x.max(axis=1) - x.min(axis=1)
+    dy = y.max(axis=1) - y.min(axis=1)
+
+    best = np.argmin(dx * dy)
+    return min(dx[best], dy[best]), max(dx[best], dy[best])
+
+def surface_areas(flat, vertices):
+    """
+    Compute the area of every surface the way 3DBM does: the outer rings of all surfaces in one PyVista mesh, cleaned and
+    triangulated by VTK. Like 3DBM, holes are not subtracted and the triangles of a concave surface can overlap.
+    Parameters:
+    flat -- flattened surfaces, see flatten_solids()
+    vertices -- vertices the vertex indices of flat refer to
+    Returns: array with the area of every surface
+    """
+
+    n_surfaces = len(flat['surface_bldg'])
+    outer_rings = np.flatnonzero(~flat['ring_inner'])
+    if len(outer_rings) == 0:
+        return np.zeros(n_surfaces)
+
+    #faces as VTK cell array: the number of vertices of each outer ring followed by its vertex indices
+    lengths = np.bincount(flat['entry_ring'], minlength=len(flat['ring_inner']))[outer_rings]
+    entries = flat['vertex_idx'][~flat['ring_inner'][flat['entry_ring']]]
+    faces = np.insert(entries, np.cumsum(lengths) - lengths, lengths)
+
+    mesh = pv.PolyData(vertices, faces)
+    mesh.cell_data['surface'] = flat['ring_surface'][outer_rings]
+    triangles = mesh.clean().triangulate().compute_cell_sizes(length=False, area=True, volume=False)
+    return np.bincount(triangles.cell_data['surface'], triangles.cell_data['Area'], minlength=n_surfaces)
+
+def convex_hull_volume(points):
+    try:
+        return ConvexHull(points).volume
+    except (QhullError, ValueError):
+        return np.nan
+
+def compute_tile_metrics(ids, solids, vertices, n_own=None):
+    """
+    Compute the metrics of all buildings of a tile.
+    Parameters:
+    ids -- ids of the buildings
+    solids -- list of (building index, Solid geometry)
+    vertices -- transformed vertices of the tile, see cityjson_reader.get_vertices()
+    n_own -- number of buildings to return, the others (halo buildings) are only used as neighbours (optional)
+    Returns: DataFrame with id and METRICS as columns
+    """
+
+    n = len(ids)
+    flat = flatten_solids(solids)
+    vertex_idx, entry_ring = flat['vertex_idx'], flat['entry_ring']
+    entry_surface = flat['ring_surface'][entry_ring]
+    entry_bldg = flat['surface_bldg'][entry_surface]
+    entry_type = flat['surface_type'][entry_surface]
+
+    #coordinates relative to the first vertex of each building, to avoid cancellation with large RD coordinates
+    first_entry = np.full(n, -1)
+    first_entry[entry_bldg[::-1]] = np.arange(len(entry_bldg))[::-1]
+    origin = vertices[vertex_idx[first_entry[entry_bldg]]]
+    a = vertices[vertex_idx] - origin
+    next_entry = ring_edges(entry_ring)
+    b = a[next_entry]
+    cross = np.cross(a, b)
+
+    surface_area = surface_areas(flat, vertices)
+
+    #signed volume as sum of the tetrahedra between the first vertex of each ring and its edges
+    ring_start = np.flatnonzero(np.append(True, entry_ring[1:] != entry_ring[:-1]))
+    r0 = a[ring_start][entry_ring]
+    volume = np.bincount(entry_bldg, np.einsum('ij,ij->i', r0, cross), minlength=n) / 6
+
+    metrics = {'id': ids, 'actual_volume': np.abs(volume)}
+
+    for name, surface in [('ground_area', 'GroundSurface'), ('wall_area', 'WallSurface'), ('roof_area', 'RoofSurface')]:
+        mask = flat['surface_type'] == surface
+        metrics[name] = np.bincount(flat['surface_bldg'][mask], surface_area[mask], minlength=n)
+
+    #footprint: edges of the ground surfaces that are not shared by two ground surfaces of the same building
+    ground = entry_type == 'GroundSurface'
+    lo = np.minimum(vertex_idx, vertex_idx[next_entry])[ground]
+    hi = np.maximum(vertex_idx, vertex_idx[next_entry])[ground]
+    edge_keys, edge_counts = np.unique(np.stack([entry_bldg[ground], lo, hi], axis=1), axis=0, return_counts=True)
+    boundary = edge_keys[edge_counts == 1]
+    boundary_length = np.linalg.norm(vertices[boundary[:, 1], :2] - vertices[boundary[:, 2], :2], axis=1)
+    metrics['footprint_perimeter'] = np.bincount(boundary[:, 0], boundary_length, minlength=n)
+
+    ground_inner = flat['ring_inner'] & (flat['surface_type'][flat['ring_surface']] == 'GroundSurface')
+    metrics['hole_count'] = np.bincount(flat['surface_bldg'][flat['ring_surface'][ground_inner]], minlength=n)
+
+    #heights: max and min of the roof, lowest point of the ground surfaces
+    z = vertices[vertex_idx, 2]
+    roof = entry_type == 'RoofSurface'
+    max_z, min_z, ground_z = np.full(n, np.nan), np.full(n, np.nan), np.full(n, np.nan)
+    np.fmax.at(max_z, entry_bldg[roof], z[roof])
+    np.fmin.at(min_z, entry_bldg[roof], z[roof])
+    np.fmin.at(ground_z, entry_bldg[ground], z[ground])
+    metrics['max_Z'], metrics['min_Z'], metrics['ground_Z'] = max_z, min_z, ground_z
+
+    #per building: unique ground points, convex hull volume and oriented bounding box
+    ground_pairs = np.unique(np.stack([entry_bldg[ground], vertex_idx[ground]], axis=1), axis=0)
+    ground_split = np.split(ground_pairs[:, 1], np.flatnonzero(np.diff(ground_pairs[:, 0])) + 1) if len(ground_pairs) else []
+    ground_points = dict(zip(np.unique(ground_pairs[:, 0]), ground_split))
+    all_pairs = np.unique(np.stack([entry_bldg, vertex_idx], axis=1), axis=0)
+    all_split = np.split(all_pairs[:, 1], np.flatnonzero(np.diff(all_pairs[:, 0])) + 1) if len(all_pairs) else []
+    all_points = dict(zip(np.unique(all_pairs[:, 0]), all_split))
+
+    metrics['ground_point_count'] = np.array([len(ground_points.get(i, [])) for i in range(n)])
+    metrics['convex_hull_volume'] = np.array([convex_hull_volume(vertices[all_points[i]] - vertices[all_points[i][0]]) if i in all_points else np.nan for i in range(n)])
+    sides = np.array([obb_sides(vertices[ground_points.get(i, all_points.get(i, [0]))][:, :2] - vertices[all_points[i][0], :2]) if i in all_points else (np.nan, np.nan) for i in range(n)])
+    metrics['obb_width'], metrics['obb_length'] = sides[:, 0], sides[:, 1]
+
+    with np.errstate(divide='ignore', invalid='ignore'):
+        height = np.where(metrics['ground_area'] > 0, metrics['actual_volume'] / metrics['ground_area'], 0)
+    n_own = n_own or n
+    data = pd.DataFrame(metrics).iloc[:n_own]
+    data['shared_walls_area'], data['closest_distance'] = neighbour_metrics(get_segments(boundary, vertices, n), height, n_own)
+
+    return data[['id'] + METRICS]
+
+def get_segments(boundary, vertices, n):
+    """
+    Get the 2D footprint boundary segments of every building.
+    Parameters:
+    boundary -- (building index, vertex index, vertex index) of the footprint boundary edges, sorted by building
+    Returns: list with per building an (m, 2, 2) array of segments
+    """
+
+    segments = np.stack([vertices[boundary[:, 1], :2], vertices[boundary[:, 2], :2]], axis=1)
+    split = np.searchsorted(boundary[:, 0], np.arange(1, n))
+    return np.split(segments, split)
+
+class GridIndex:
+    """
+    Grid index over the 2D bounding boxes of the buildings, so a neighbour search only tests the buildings in nearby cells.
+    Parameters:
+    bboxes -- (n, 4) array of minx, miny, maxx, maxy (NaN for buildings without footprint)
+    cell_size -- size of the grid cells (m), np.inf puts all buildings in one cell (brute force)
+    """
+
+    def __init__(self, bboxes, cell_size=25.0):
+        self.bboxes = bboxes
+        self.cell_size = cell_size
+        self.cells = {}
+
+        for i, bbox in enumerate(bboxes):
+            if np.isnan(bbox).any():
+                continue
+            for cell in self.get_cells(bbox, 0):
+                self.cells.setdefault(cell, []).append(i)
+
+    def get_cells(self, bbox, distance):
+        if np.isinf(self.cell_size):
+            return [(0, 0)]
+        (x0, y0), (x1, y1) = np.floor((bbox[:2] - distance) / self.cell_size), np.floor((bbox[2:] + distance) / self.cell_size)
+        return [(x, y) for x in range(int(x0), int(x1) + 1) for y in range(int(y0), int(y1) + 1)]
+
+    def query(self, bbox, distance):
+        """
+        Get the buildings with a bounding box within distance of bbox.
+        """
+
+        candidates = set()
+        for cell in self.get_cells(bbox, distance):
+            candidates.update(self.cells.get(cell, []))
+        candidates = np.fromiter(candidates, dtype=np.int64, count=len(candidates))
+
+        b = self.bboxes[candidates]
+        near = (b[:, 0] <= bbox[2] + distance) & (b[:, 2] >= bbox[0] - distance) & (b[:, 1] <= bbox[3] + distance) & (b[:, 3] >= bbox[1] - distance)
+        return candidates[near]
+
+def point_segment_distance(points, segments):
+    """
+    Distance from every point to the closest of the segments.
+    Parameters:
+    points -- (p, 2) array
+    segments -- (s, 2, 2) array
+    Returns: (p,) array of distances
+    """
+
+    start, direction = segments[:, 0], segments[:, 1] - segments[:, 0]
+    length2 = np.maximum(np.einsum('ij,ij->i', direction, direction), 1e-12)
+    t = np.clip(np.einsum('psj,sj->ps', points[:, None, :] - start[None], direction) / length2, 0, 1)
+    closest = start[None] + t[:, :, None] * direction[None]
+    return np.linalg.norm(points[:, None, :] - closest, axis=2).min(axis=1)
+
+def segments_distance(a, b):
+    #minimum distance between two sets of (non-crossing) segments, from the endpoints of each set to the other set
+    return min(point_segment_distance(a.reshape(-1, 2), b).min(), point_segment_distance(b.reshape(-1, 2), a).min())
+
+def neighbour_metrics(segments, height, n_own, index=None, spacing=0.25, tolerance=0.2):
+    """
+    Compute the shared wall area and the closest distance to another building, testing only the buildings found with the grid index.
+    The shared wall area is approximated by sampling the footprint boundary every spacing m, samples within tolerance m
+    of the boundary of another building are shared and contribute their length times the lower of both mean heights.
+    Parameters:
+    segments -- footprint boundary segments per building, see get_segments()
+    height -- mean height of each building (volume / ground area)
+    n_own -- number of buildings to compute the metrics for, the others are only used as neighbours
+    index -- GridIndex over the buildings (optional, built when not given)
+    Returns: (shared wall area, closest distance) arrays of n_own buildings
+    """
+
+    bboxes = np.array([np.concatenate([s.reshape(-1, 2).min(axis=0), s.reshape(-1, 2).max(axis=0)]) if len(s) else [np.nan] * 4 for s in segments])
+    index = index if index is not None else GridIndex(bboxes)
+    max_distance = np.nanmax(bboxes[:, 2:]) - np.nanmin(bboxes[:, :2]) if len(bboxes) else 0
+
+    shared = np.zeros(n_own)
+    closest = np.full(n_own, np.nan)
+
+    for i in range(n_own):
+        if len(segments[i]) == 0:
+            continue
+
+        #closest distance: grow the search distance until there are candidates, then test all buildings within the found distance
+        distance = index.cell_size if np.isfinite(index.cell_size) else max_distance
+        candidates = []
+        while len(candidates) == 0 and distance <= 2 * max_distance:
+            candidates = [j for j in index.query(bboxes[i], distance) if j != i]
+            distance *= 2
+        if candidates:
+            d = min(segments_distance(segments[i], segments[j]) for j in candidates)
+            candidates = [j for j in index.query(bboxes[i], d) if j != i]
+            closest[i] = min([d] + [segments_distance(segments[i], segments[j]) for j in candidates])
+
+        #shared walls: samples of the own boundary close to the boundary of a candidate
+        candidates = [j for j in index.query(bboxes[i], tolerance) if j != i]
+        if not candidates:
+            continue
+
+        start, end = segments[i][:, 0], segments[i][:, 1]
+        length = np.linalg.norm(end - start, axis=1)
+        n_samples = np.maximum(np.ceil(length / spacing).astype(np.int64), 1)
+        edge = np.repeat(np.arange(len(length)), n_samples)
+        part = np.arange(len(edge)) - np.repeat(np.cumsum(n_samples) - n_samples, n_samples)
+        samples = start[edge] + (end - start)[edge] * ((part + 0.5) / n_samples[edge])[:, None]
+        sample_length = (length / n_samples)[edge]
+
+        d = np.stack([point_segment_distance(samples, segments[j]) for j in candidates], axis=1)
+        nearest = np.argmin(d, axis=1)
+        found = d[np.arange(len(samples)), nearest] <= tolerance
+        shared[i] = np.sum(sample_length[found] * np.fmin(height[i], height[np.asarray(candidates)[nearest[found]]]))
+
+    return shared, closest
+
+def add_building(solids, vertices, geometry, tile_vertices, offset):
+    """
+    Add a Solid geometry with its own copy of the used vertices, so buildings of different tiles can be combined.
+    Parameters:
+    solids -- list of (building index, Solid geometry) to add the geometry to
+    vertices -- list of vertex arrays to add the used vertices to
+    geometry -- Solid geometry referring to tile_vertices
+    tile_vertices -- transformed vertices of the tile
+    offset -- number of vertices in the vertex arrays so far
+    Returns: new number of vertices
+    """
+
+    index = {}
+    geometry = dict(geometry)
+    geometry['boundaries'] = cityjson_reader.remap_boundaries(geometry['boundaries'], index, offset)
+    solids.append((len(solids), geometry))
+    vertices.append(tile_vertices[np.fromiter(index.keys(), dtype=np.int64, count=len(index))])
+    return offset + len(index)
+
+def compute_metrics(tile, lod, halo_tiles=(), halo=HALO):
+    """
+    Compute the metrics of all buildings of one LoD of a tile.
+    Parameters:
+    tile -- path to the 3D BAG tile
+    lod -- CityJSON LoD, '1.2' or '2.2'
+    halo_tiles -- paths to the adjacent tiles, their buildings within halo m of the tile are used as neighbours (optional)
+    halo -- size of the halo (m)
+    Returns: DataFrame with id and METRICS as columns, with the same ids as 3DBM (the BuildingParts)
+    """
+
+    ids, solids, vertices = [], [], []
+    n_vertices = 0
+    extent = None
+    for id, cityobject, tile_vertices, geometries in cityjson_reader.iter_buildings([tile], lods=(lod,)):
+        if geometries[lod]['type'] != 'Solid':
+            continue
+        if extent is None:
+            extent = np.concatenate([tile_vertices[:, :2].min(axis=0) - halo, tile_vertices[:, :2].max(axis=0) + halo])
+        ids.append(id)
+        n_vertices = add_building(solids, vertices, geometries[lod], tile_vertices, n_vertices)
+
+    if not ids:
+        return pd.DataFrame(columns=['id'] + METRICS)
+    n_own = len(ids)
+
+    for id, cityobject, tile_vertices, geometries in cityjson_reader.iter_buildings(halo_tiles, lods=(lod,)):
+        if geometries[lod]['type'] != 'Solid':
+            continue
+        new_vertices = add_building(solids, vertices, geometries[lod], tile_vertices, n_vertices)
+        xy = vertices[-1][:, :2]
+        if (xy[:, 0].max() < extent[0]) or (xy[:, 0].min() > extent[2]) or (xy[:, 1].max() < extent[1]) or (xy[:, 1].min() > extent[3]):
+            solids.pop()
+            vertices.pop()
+            continue
+        ids.append(id)
+        n_vertices = new_vertices
+
+    return compute_tile_metrics(ids, solids, np.concatenate(vertices), n_own)
+
+def benchmark(tiles, lod='1.2', sizes=(100, 200, 400, 800, 1600, 3200), max_brute_force=400):
+    """
+    Time the neighbour metrics for increasing numbers of buildings, with the grid index and brute force.
+    Parameters:
+    tiles -- paths to the tiles to take the buildings from
+    lod -- CityJSON LoD
+    sizes -- numbers of buildings to time
+    max_brute_force -- largest number of buildings to time brute force for, since it grows quadratically
+    Returns: DataFrame with the number of buildings and the time (s) with the grid index and brute force
+    """
+
+    solids, vertices = [], []
+    n_vertices = 0
+    for id, cityobject, tile_vertices, geometries in cityjson_reader.iter_buildings(tiles, lods=(lod,)):
+        if geometries[lod]['type'] == 'Solid':
+            n_vertices = add_building(solids, vertices, geometries[lod], tile_vertices, n_vertices)
+
+    rows = []
+    for size in [size for size in sizes if size <= len(solids)] or [len(solids)]:
+        v = np.concatenate(vertices[:size])
+        flat = flatten_solids(solids[:size])
+        entry_surface = flat['ring_surface'][flat['entry_ring']]
+        entry_bldg = flat['surface_bldg'][entry_surface]
+        ground = flat['surface_type'][entry_surface] == 'GroundSurface'
+        next_entry = ring_edges(flat['entry_ring'])
+        lo = np.minimum(flat['vertex_idx'], flat['vertex_idx'][next_entry])[ground]
+        hi = np.maximum(flat['vertex_idx'], flat['vertex_idx'][next_entry])[ground]
+        keys, counts = np.unique(np.stack([entry_bldg[ground], lo, hi], axis=1), axis=0, return_counts=True)
+        segments = get_segments(keys[counts == 1], v, size)
+        bboxes = np.array([np.concatenate([s.reshape(-1, 2).min(axis=0), s.reshape(-1, 2).max(axis=0)]) if len(s) else [np.nan] * 4 for s in segments])
+        height = np.ones(size)
+
+        times = []
+        for index in [GridIndex(bboxes), GridIndex(bboxes, cell_size=np.inf) if size <= max_brute_force else None]:
+            if index is None:
+                times.append(np.nan)
+                continue
+            start = time()
+            neighbour_metrics(segments, height, size, index)
+            times.append(time() - start)
+        rows.append([size] + times)
+
+    return pd.DataFrame(rows, columns=['buildings', 'grid_index_s', 'brute_force_s'])
+
+def compare_columns(native, reference, columns, tolerance=PARITY_TOLERANCE, share=PARITY_SHARE):
+    """
+    Compare columns of this engine with the same columns of 3DBM, row by row.
+    Parameters:
+    native -- DataFrame with the values of this engine
+    reference -- DataFrame with the 3DBM values of the same buildings in the same order
+    columns -- list of (name in the result, column, metric of the tolerance)
+    tolerance -- per metric the absolute and relative tolerance (optional)
+    share -- share of the buildings within the tolerance for a column to pass (optional)
+    Returns: DataFrame with per column the number of buildings compared, the median and maximum absolute difference,
+    the share of buildings within the tolerance and whether the column passed
+    """
+
+    rows = []
+    for name, column, metric in columns:
+        absolute, relative = tolerance[metric]
+        a = native[column].astype(float).to_numpy()
+        b = reference[column].astype(float).to_numpy()
+        valid = ~np.isnan(a) & ~np.isnan(b)
+        diff = np.abs(a[valid] - b[valid])
+        within = (diff <= np.maximum(absolute, relative * np.abs(b[valid]))).mean() if valid.any() else np.nan
+        rows.append([name, valid.sum(), np.median(diff) if valid.any() else np.nan, diff.max() if valid.any() else np.nan,
+                     within, bool(within >= share)])
+
+    return pd.DataFrame(rows, columns=['column', 'count', 'median_abs_diff', 'max_abs_diff', 'share_within_tolerance', 'passed'])
+
+def compare_metrics(native_csv, reference_csv):
+    """
+    Compare the output of this engine with the 3DBM results of the same buildings.
+    Returns: DataFrame of compare_columns() with a row per metric
+    """
+
+    native = pd.read_csv(native_csv).set_index('id')
+    reference = pd.read_csv(reference_csv).set_index('id')
+    ids = native.index.intersection(reference.index)
+
+    return compare_columns(native.loc[ids], reference.loc[ids], [(metric, metric, metric) for metric in METRICS])
+
+def get_training_features(metrics, lod):
+    """
+    Convert the metrics of one LoD to the columns of training_data like import_3DBM.py and extract_features.get_3DBM_features():
+    without the buildings with holes, the bag_id of the first BuildingPart and the heights above the ground.
+    Parameters:
+    metrics -- DataFrame of compute_metrics()
+    lod -- 'lod1' or 'lod2'
+    Returns: DataFrame with bag_id and the columns {metric}_{lod}
+    """
+
+    metrics = metrics[metrics['hole_count'] == 0]
+    features = pd.DataFrame({'bag_id': metrics['id'].str[:-2].to_numpy()})
+    for metric in ['actual_volume', 'convex_hull_volume', 'footprint_perimeter', 'obb_width', 'obb_length', 'ground_area',
+                   'wall_area', 'roof_area', 'ground_point_count', 'shared_walls_area', 'closest_distance']:
+        features[f'{metric}_{lod}'] = metrics[metric].to_numpy(dtype=float)
+    features[f'height_max_{lod}'] = (metrics['max_Z'] - metrics['ground_Z']).to_numpy(dtype=float)
+    features[f'height_min_roof_{lod}'] = (metrics['min_Z'] - metrics['ground_Z']).to_numpy(dtype=float)
+    return features.drop_duplicates('bag_id')
+
+def check_parity(tiles, reference, tolerance=PARITY_TOLERANCE, share=PARITY_SHARE):
+    """
+    Compare the metrics of this engine for the buildings of the tiles with the 3DBM features of the same buildings in a training table,
+    e.g. training_data.c1_rh of the provided DUMP file for the tiles in data/3DBAG/c1_rh/.
+    The training tables only contain the labelled buildings and not shared_walls_area and closest_distance, see check_tile_parity() for these.
+    Parameters:
+    tiles -- paths to the 3D BAG tiles
+    reference -- DataFrame with bag_id and the 3DBM features, see extract_features.get_3DBM_features()
+    tolerance -- per metric the absolute and relative tolerance (optional)
+    share -- share of the buildings within the tolerance for a column to pass (optional)
+    Returns: DataFrame with per column the number of buildings compared, the median and maximum absolute difference,
+    the share of buildings within the tolerance and whether the column passed
+    """
+
+    native = None
+    for lod, cityjson_lod in tile_functions.LODS.items():
+        features = get_training_features(pd.concat([compute_metrics(tile, cityjson_lod) for tile in tiles]), lod)
+        native = features if native is None else native.merge(features, on='bag_id', how='outer')
+
+    merged = native.merge(reference, on='bag_id', suffixes=('_native', ''))
+    columns = [f'{metric}_{lod}' for lod in tile_functions.LODS for metric in tolerance
+               if f'{metric}_{lod}' in reference.columns and f'{metric}_{lod}' in native.columns]
+    native = merged[[f'{column}_native' for column in columns]].set_axis(columns, axis=1)
+
+    return compare_columns(native, merged[columns], [(column, column, column.rsplit('_', 1)[0]) for column in columns], tolerance, share)
+
+def check_tile_parity(tile, reference_csvs, tolerance=PARITY_TOLERANCE, share=PARITY_SHARE):
+    """
+    Compare all metrics of this engine for every building of a tile with the 3DBM results of the tile, including shared_walls_area
+    and closest_distance. The tile is computed without adjacent tiles, like 3DBM on a single tile (e.g. with per_tile).
+    Parameters:
+    tile -- path to the 3D BAG tile
+    reference_csvs -- dictionary with 'lod1' and 'lod2' as keys and the path to the 3DBM .csv file of the tile as value
+    tolerance -- per metric the absolute and relative tolerance (optional)
+    share -- share of the buildings within the tolerance for a column to pass (optional)
+    Returns: DataFrame of compare_columns() with a row per metric and LoD
+    """
+
+    results = []
+    for lod, cityjson_lod in tile_functions.LODS.items():
+        native = compute_metrics(tile, cityjson_lod)
+        reference = pd.read_csv(reference_csvs[lod], usecols=['id'] + METRICS)
+        merged = native.merge(reference, on='id', how='left', suffixes=('_native', ''))
+        if merged['actual_volume'].isna().all():
+            print(f'\nError: no buildings of {tile} in {reference_csvs[lod]}')
+
+        native = merged[[f'{metric}_native' for metric in METRICS]].set_axis(METRICS, axis=1)
+        result = compare_columns(native, merged[METRICS], [(f'{metric}_{lod}', metric, metric) for metric in METRICS], tolerance, share)
+        result['n_buildings'] = len(merged)
+        results.append(result)
+
+    return pd.concat(results, ignore_index=True)
+
+def run_parity_check(reference_csv=None):
+    """
+    Run check_parity() for the tiles of path_3DBAG and the training table of params.json, or the training table exported as reference_csv,
+    and write the result to results/{table}_native_parity.csv.
+    Returns: True if all columns passed
+    """
+
+    with open('params.json', 'r') as f:
+        params = json.load(f)
+
+        table = params['table']
+        path_3DBAG = params['path_3DBAG']
+        feature_cache = params['feature_cache']
+
+    if reference_csv is not None:
+        reference = pd.read_csv(reference_csv)
+    else:
+        #only needed to read the reference from the database, the engine itself does not use it
+        import db_functions
+        reference = db_functions.load_training_table(table, cache=feature_cache)
+
+    tiles = tile_functions.get_tiles(path_3DBAG)
+    start = time()
+    result = check_parity(tiles, reference)
+    print(f'\n>> Dataset {table} -- compared the native metrics of {len(tiles)} tiles with the 3DBM features in {time() - start:.1f}s')
+    print(result.to_string(index=False))
+
+    os.makedirs('results', exist_ok=True)
+    result.to_csv(f'results/{table}_native_parity.csv', index=False)
+
+    if not result['passed'].all():
+        print(f"\nError: {', '.join(result.loc[~result['passed'], 'column'])} of the native engine differ from 3DBM")
+    return bool(result['passed'].all())
+
+def run_tile_parity_check(tile, lod1_csv, lod2_csv):
+    """
+    Run check_tile_parity() for a tile and write the result to results/{tile}_native_parity.csv.
+    Returns: True if all columns passed
+    """
+
+    name = os.path.basename(tile).split('.')[0]
+    start = time()
+    result = check_tile_parity(tile, {'lod1': lod1_csv, 'lod2': lod2_csv})
+    print(f'\n>> Compared the native metrics of {name} with the 3DBM results in {time() - start:.1f}s')
+    print(result.to_string(index=False))
+
+    os.makedirs('results', exist_ok=True)
+    result.to_csv(f'results/{name}_native_parity.csv', index=False)
+
+    if not result['passed'].all():
+        print(f"\nError: {', '.join(result.loc[~result['passed'], 'column'])} of the native engine differ from 3DBM")
+    return bool(result['passed'].all())
+
+if __name__ == '__main__':
+    if sys.argv[1] == 'benchmark':
+        print(benchmark(sys.argv[2:]).to_string(index=False))
+    elif sys.argv[1] == 'parity':
+        sys.exit(0 if run_parity_check(sys.argv[2] if len(sys.argv) > 2 else None) else 1)
+    elif sys.argv[1] == 'parity-tile':
+        sys.exit(0 if run_tile_parity_check(*sys.argv[2:5]) else 1)
+    else:
+        print(compare_metrics(sys.argv[1], sys.argv[2]).to_string(index=False))
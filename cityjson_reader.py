@@ -0,0 +1,195 @@
+'''
+Streaming reader for the 3D BAG CityJSON tiles.
+The tiles are read one at a time, so peak memory depends on the largest
+tile instead of on the whole case study. Replaces the cjio merge and
+lod_filter steps: LoD 1.2 and 2.2 are split in a single pass.
+'''
+
+import json
+import os
+import tempfile
+import numpy as np
+
+def read_tile(path):
+    with open(path, 'r') as f:
+        return json.load(f)
+
+def get_vertices(cm):
+    """
+    Get the vertices of a CityJSON model with the transform applied.
+    Parameters:
+    cm -- CityJSON model as dictionary
+    Returns: (n, 3) float64 array of real world coordinates
+    """
+
+    vertices = np.asarray(cm['vertices'], dtype=np.float64).reshape(-1, 3)
+
+    if 'transform' in cm:
+        vertices = vertices * cm['transform']['scale'] + cm['transform']['translate']
+    return vertices
+
+def get_extent(path):
+    """
+    Get the 2D extent of a tile: minx, miny, maxx, maxy.
+    """
+
+    cm = read_tile(path)
+    if 'geographicalExtent' in cm.get('metadata', {}):
+        minx, miny, minz, maxx, maxy, maxz = cm['metadata']['geographicalExtent']
+        return [minx, miny, maxx, maxy]
+
+    vertices = get_vertices(cm)
+    return list(vertices[:, :2].min(axis=0)) + list(vertices[:, :2].max(axis=0))
+
+def get_lod(geometry):
+    #CityJSON 1.0 stores the LoD as number, 1.1 as string
+    return str(geometry['lod'])
+
+def iter_buildings(tiles, lods=('1.2', '2.2')):
+    """
+    Iterate over the buildings of all tiles, one tile in memory at a time.
+    Parameters:
+    tiles -- paths to CityJSON tiles
+    lods -- LoDs to return the geometries of
+    Returns: generator of (id, cityobject, vertices, {lod: geometry}) for every CityObject with geometry in one of the LoDs,
+    vertices is the transformed vertex array of the whole tile the geometry indices refer to
+    """
+
+    for tile in tiles:
+        cm = read_tile(tile)
+        vertices = get_vertices(cm)
+
+        for id, cityobject in cm['CityObjects'].items():
+            geometries = {get_lod(g): g for g in cityobject.get('geometry', []) if get_lod(g) in lods}
+            if geometries:
+                yield id, cityobject, vertices, geometries
+
+        del cm, vertices
+
+def remap_boundaries(boundaries, index, offset=0):
+    """
+    Replace the vertex indices in (nested) boundaries with new indices starting at offset, adding unseen vertices to index.
+    """
+
+    if isinstance(boundaries, int):
+        if boundaries not in index:
+            index[boundaries] = offset + len(index)
+        return index[boundaries]
+    return [remap_boundaries(b, index, offset) for b in boundaries]
+
+class LodWriter:
+    """
+    Writes the CityObjects of one LoD of multiple tiles into one CityJSON file.
+    CityObjects are written while reading, the real world coordinates of the vertices are collected
+    in a temporary file and appended at the end, so the merged model is never held in memory.
+    The vertices are quantized with the translate of the first tile and the smallest scale of all tiles,
+    so no tile loses precision when the tiles have different transforms.
+    """
+
+    #size of the blocks of vertices quantized at a time by close()
+    BLOCK_SIZE = 1 << 16
+
+    def __init__(self, path, cm, lod):
+        self.path = path
+        self.lod = lod
+        transform = cm.get('transform', {'scale': [1.0, 1.0, 1.0], 'translate': [0.0, 0.0, 0.0]})
+        self.scale = np.asarray(transform['scale'], dtype=np.float64)
+        self.translate = np.asarray(transform['translate'], dtype=np.float64)
+        self.n_vertices = 0
+        self.n_buildings = 0
+        self.first = True
+
+        metadata = dict(cm.get('metadata', {}))
+        metadata.pop('geographicalExtent', None)
+
+        #the transform is written by close(), once the scales of all tiles are known
+        self.f = open(path, 'w')
+        self.f.write('{"type": "CityJSON", "version": %s, "metadata": %s, "CityObjects": {'
+                     % (json.dumps(cm['version']), json.dumps(metadata)))
+        self.vertices_tmp = tempfile.TemporaryFile('w+b', dir=os.path.dirname(os.path.abspath(path)))
+
+    def add_tile(self, cm, vertices):
+        """
+        Add all CityObjects of a tile, keeping only the geometries of the LoD of this writer.
+        Like cjio lod_filter, CityObjects without geometry in the LoD are kept with an empty geometry list
+        (and CityObjects without geometry key without it), so the references between parents and children stay valid.
+        Parameters:
+        cm -- CityJSON model of the tile as dictionary
+        vertices -- transformed vertices of the tile, see get_vertices()
+        """
+
+        if 'transform' in cm:
+            self.scale = np.minimum(self.scale, cm['transform']['scale'])
+
+        index = {}
+        for id, cityobject in cm['CityObjects'].items():
+            if 'geometry' in cityobject:
+                cityobject = dict(cityobject)
+                geometries = [dict(g) for g in cityobject['geometry'] if get_lod(g) == self.lod]
+                for g in geometries:
+                    g['boundaries'] = remap_boundaries(g['boundaries'], index, self.n_vertices)
+                cityobject['geometry'] = geometries
+                self.n_buildings += len(geometries) > 0
+
+            self.f.write(('' if self.first else ', ') + f'{json.dumps(id)}: {json.dumps(cityobject)}')
+            self.first = False
+
+        if not index:
+            return
+
+        #store the used vertices in order of their new index
+        used = np.fromiter(index.keys(), dtype=np.int64, count=len(index))
+        vertices[used].astype(np.float64).tofile(self.vertices_tmp)
+        self.n_vertices += len(used)
+        return
+
+    def close(self):
+        transform = {'scale': self.scale.tolist(), 'translate': self.translate.tolist()}
+        self.f.write('}, "transform": %s, "vertices": [' % json.dumps(transform))
+
+        #quantize the vertices in blocks with the transform of this file
+        self.vertices_tmp.seek(0)
+        first = True
+        while True:
+            block = np.fromfile(self.vertices_tmp, dtype=np.float64, count=3 * self.BLOCK_SIZE)
+            if block.size == 0:
+                break
+            quantized = np.rint((block.reshape(-1, 3) - self.translate) / self.scale).astype(np.int64)
+            self.f.write(('' if first else ', ') + ', '.join(json.dumps(v) for v in quantized.tolist()))
+            first = False
+        self.f.write(']}')
+        self.f.close()
+        self.vertices_tmp.close()
+
+def split_lods(tiles, outputs, chunk_size=None):
+    """
+    Merge the tiles and split them by LoD in a single pass over the tiles.
+    Parameters:
+    tiles -- paths to CityJSON tiles
+    outputs -- dictionary with LoD as key ('1.2', '2.2') and output path as value
+    chunk_size -- start a new output file, after a whole tile, once a file has this number of buildings (optional),
+    the files are then named after the output path with _0, _1, ... before .city.json
+    Returns: dictionary with LoD as key and list of (path, number of buildings) of the written files as value
+    """
+
+    writers = {}
+    written = {lod: [] for lod in outputs}
+    for tile in tiles:
+        cm = read_tile(tile)
+        vertices = get_vertices(cm)
+
+        for lod, path in outputs.items():
+            if lod in writers and chunk_size and writers[lod].n_buildings >= chunk_size:
+                writers.pop(lod).close()
+            if lod not in writers:
+                if chunk_size:
+                    path = path.replace('.city.json', f'_{len(written[lod])}.city.json')
+                writers[lod] = LodWriter(path, cm, lod)
+                written[lod].append(writers[lod])
+            writers[lod].add_tile(cm, vertices)
+
+        del cm, vertices
+
+    for writer in writers.values():
+        writer.close()
+    return {lod: [(writer.path, writer.n_buildings) for writer in lod_writers] for lod, lod_writers in written.items()}
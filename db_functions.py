@@ -4,10 +4,40 @@ Based on: Ellie Roy (https://github.com/ellieroy/no-floors-inference-NL)
 & Imke Lansky (https://github.com/ImkeLansky/USA-BuildingHeightInference)
 '''
 
+import json
+import numpy as np
 import os
+import pandas as pd
 import psycopg2
+import psycopg2.pool
+import shutil
+import sql_profiler
 import sys
+from contextlib import contextmanager
+from functools import lru_cache
+from tempfile import SpooledTemporaryFile
+from sqlalchemy import URL, create_engine
 
+MAX_CONNECTIONS = 32
+
+#dtypes of the columns of the training tables read by load_training_table(), nullable integers are converted afterwards
+DTYPES = {'double precision': 'float64', 'real': 'float32', 'numeric': 'float64',
+          'integer': 'Int32', 'bigint': 'Int64', 'smallint': 'Int16', 'boolean': 'boolean'}
+
+#size of the COPY output kept in memory by load_training_table() before it is written to a temporary file
+SPOOL_SIZE = 256 * 1024 * 1024
+
+#directory of the feature cache of load_training_table() next to this module, one subdirectory per table
+CACHE_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'cache')
+
+#column of the training tables that matches the rows of columns added to the feature cache later
+CACHE_KEY = 'bag_id'
+
+#one pool and engine per process, connections can not be shared with forked processes
+POOLS = {}
+ENGINES = {}
+
+@lru_cache(maxsize=None)
 def get_db_parameters():
     location = os.path.dirname(os.path.abspath(__file__))
     parameters_file = os.path.join(location,"db_parameters.txt")
@@ -27,16 +57,86 @@ def setup_connection(user,password,database,host,port):
     database -- database name
     host -- host address of database
     port -- port number of database
+    The cursors of the connection record their statements when sql_profiler is enabled.
     '''
     try:
         print(f'\n>> Connecting to PostgreSQL database: {database}')
-        return psycopg2.connect(database=database, user=user, password=password, host=host, port=port)
+        return psycopg2.connect(database=database, user=user, password=password, host=host, port=port,
+                                cursor_factory=sql_profiler.get_cursor_factory())
 
     except (Exception, psycopg2.Error) as error:
         print("Error while connecting to PostgreSQL;", error)
         sys.exit()
 
 
+def get_pool():
+    """
+    Get the connection pool of the process, created with the parameters of db_parameters.txt on first use.
+    Connections are opened when needed, up to MAX_CONNECTIONS at the same time.
+    """
+
+    pid = os.getpid()
+    if pid not in POOLS:
+        user,password,database,host,port = get_db_parameters()
+        print(f'\n>> Creating connection pool for PostgreSQL database: {database}')
+        POOLS[pid] = psycopg2.pool.ThreadedConnectionPool(0, MAX_CONNECTIONS, database=database, user=user, password=password, host=host, port=port,
+                                                          cursor_factory=sql_profiler.get_cursor_factory())
+    return POOLS[pid]
+
+@contextmanager
+def session(autocommit=True):
+    """
+    Context manager that lends a connection of the pool (see get_pool()) and gives a cursor on it,
+    the cursor is closed and the connection returned to the pool afterwards.
+    Without autocommit the statements of the block are one transaction, committed when the block ends
+    and rolled back when it raises an exception.
+    Usage: with db_functions.session() as cursor: ...
+    Parameters:
+    autocommit -- autocommit of the connection (optional)
+    """
+
+    pool = get_pool()
+    conn = pool.getconn()
+    try:
+        conn.autocommit = autocommit
+        cursor = conn.cursor()
+        try:
+            yield cursor
+            if not autocommit:
+                conn.commit()
+        except Exception:
+            if not autocommit:
+                conn.rollback()
+            raise
+        finally:
+            cursor.close()
+    finally:
+        pool.putconn(conn)
+
+def get_engine():
+    """
+    Get the SQLAlchemy engine of the process for the database of db_parameters.txt, created on first use.
+    """
+
+    pid = os.getpid()
+    if pid not in ENGINES:
+        user,password,database,host,port = get_db_parameters()
+        url = URL.create('postgresql+psycopg2', username=user, password=password, host=host, port=port, database=database)
+        ENGINES[pid] = create_engine(url, pool_pre_ping=True)
+    return ENGINES[pid]
+
+def close_pool():
+    """
+    Close all connections of the pool and the engine of the process.
+    """
+
+    pid = os.getpid()
+    if pid in POOLS:
+        POOLS.pop(pid).closeall()
+        print("\n>> PostgreSQL connection pool is closed")
+    if pid in ENGINES:
+        ENGINES.pop(pid).dispose()
+
 def close_connection(connection, cursor):
     """
     Close connection to the database and cursor used to perform queries.
@@ -75,7 +175,7 @@ def create_temp_table(cursor, table, pkey=None):
     else:
         pass
 
-def replace_temp_table(cursor, table, pkey=None, geom_index=None):
+def replace_temp_table(cursor, table, pkey=None, geom_index=None, swap=False):
     """
     Replace original table with temporary table containing extracted data, drop temporary table and create (optional) indexes on new table.
     Parameters:
@@ -83,10 +183,18 @@ def replace_temp_table(cursor, table, pkey=None, geom_index=None):
     table -- table to store the data in the database
     pkey -- column to create primary key on (optional)
     geom_index -- column to create geometry index on (optional)
+    swap -- make the temporary table logged and swap it with the original table in one transaction instead of copying it,
+    the original table is kept as training_data.{table}_backup, see restore_backup_table() (optional)
     Returns: none
 
     """
 
+    invalidate_training_cache(table)
+
+    if swap:
+        swap_temp_table(cursor, table, pkey, geom_index)
+        return
+
     print(f'\n>> Dataset {table} -- copying unlogged table to logged table')
     cursor.execute(f"CREATE TABLE training_data.{table}_new AS TABLE training_data.{table}_tmp;")
     cursor.execute(f"DROP TABLE training_data.{table};")
@@ -107,4 +215,348 @@ def replace_temp_table(cursor, table, pkey=None, geom_index=None):
         except Exception as error:
             print(f'\nError: {str(error)}')
     else:
-        pass
\ No newline at end of file
+        pass
+
+def execute_transaction(cursor, statements):
+    """
+    Execute statements in one transaction on a connection with autocommit. If a statement fails, the aborted transaction
+    is rolled back before the error is raised, so the pooled connection can be used again.
+    Parameters:
+    cursor -- cursor for database connection
+    statements -- SQL statements separated by semicolons
+    Returns: none
+    """
+
+    try:
+        cursor.execute(f'''
+            BEGIN;
+            {statements}
+            COMMIT;
+            '''
+        )
+    except Exception:
+        cursor.execute('ROLLBACK;')
+        raise
+
+def swap_temp_table(cursor, table, pkey=None, geom_index=None):
+    """
+    Replace original table with temporary table without copying it: the temporary table is made logged with ALTER TABLE ... SET LOGGED
+    and renamed in one transaction, so the table is never missing. The original table is kept as training_data.{table}_backup
+    (replacing an older backup) with its indexes renamed to {table}_backup_*. The primary key of the temporary table is kept,
+    a missing primary key and the geometry index are created concurrently afterwards. Needs a connection with autocommit.
+    Parameters:
+    cursor -- cursor for database connection
+    table -- table to store the data in the database
+    pkey -- column to create primary key on (optional)
+    geom_index -- column to create geometry index on (optional)
+    Returns: none
+    """
+
+    print(f'\n>> Dataset {table} -- making unlogged table logged and swapping it with table, keeping {table}_backup')
+    cursor.execute(f"ALTER TABLE training_data.{table}_tmp SET LOGGED;")
+
+    rename_geom_index = ''
+    if geom_index is not None:
+        rename_geom_index = f"ALTER INDEX IF EXISTS training_data.{table}_{geom_index}_idx RENAME TO {table}_backup_{geom_index}_idx;"
+
+    execute_transaction(cursor, f'''
+        DROP TABLE IF EXISTS training_data.{table}_backup;
+        ALTER INDEX IF EXISTS training_data.{table}_pkey RENAME TO {table}_backup_pkey;
+        {rename_geom_index}
+        ALTER TABLE training_data.{table} RENAME TO {table}_backup;
+        ALTER TABLE training_data.{table}_tmp RENAME TO {table};
+        ALTER INDEX IF EXISTS training_data.{table}_tmp_pkey RENAME TO {table}_pkey;
+        '''
+    )
+
+    cursor.execute(f"SELECT EXISTS (SELECT 1 FROM pg_constraint WHERE conrelid = 'training_data.{table}'::regclass AND contype = 'p');")
+    has_pkey = cursor.fetchone()[0]
+
+    if pkey is not None and not has_pkey:
+        try:
+            cursor.execute(f"CREATE UNIQUE INDEX CONCURRENTLY IF NOT EXISTS {table}_pkey ON training_data.{table} ({pkey});")
+            cursor.execute(f"ALTER TABLE training_data.{table} ADD CONSTRAINT {table}_pkey PRIMARY KEY USING INDEX {table}_pkey;")
+        except Exception as error:
+            print(f'\nError: {str(error)}')
+
+    if geom_index is not None:
+        try:
+            cursor.execute(f"CREATE INDEX CONCURRENTLY IF NOT EXISTS {table}_{geom_index}_idx ON training_data.{table} USING GIST ({geom_index});")
+        except Exception as error:
+            print(f'\nError: {str(error)}')
+
+def restore_backup_table(cursor, table):
+    """
+    Roll back a swap_temp_table(): swap training_data.{table}_backup back in place of training_data.{table} in one transaction,
+    the replaced table is kept as training_data.{table}_backup.
+    Parameters:
+    cursor -- cursor for database connection
+    table -- table to restore
+    Returns: none
+    """
+
+    print(f'\n>> Dataset {table} -- restoring {table}_backup')
+    invalidate_training_cache(table)
+
+    execute_transaction(cursor, f'''
+        ALTER TABLE training_data.{table} RENAME TO {table}_restored;
+        ALTER INDEX IF EXISTS training_data.{table}_pkey RENAME TO {table}_restored_pkey;
+        ALTER TABLE training_data.{table}_backup RENAME TO {table};
+        ALTER INDEX IF EXISTS training_data.{table}_backup_pkey RENAME TO {table}_pkey;
+        ALTER TABLE training_data.{table}_restored RENAME TO {table}_backup;
+        ALTER INDEX IF EXISTS training_data.{table}_restored_pkey RENAME TO {table}_backup_pkey;
+        '''
+    )
+
+def create_vbo_aggregate(cursor, refresh=False):
+    """
+    Create the materialized view input_data.verblijfsobject_per_pand with, for every pand, the uses, the number of dwellings
+    and the identificaties of its verblijfsobjecten in use, so the BAG features only scan the verblijfsobject table once per BAG release.
+    Parameters:
+    cursor -- cursor for database connection
+    refresh -- refresh the view from input_data.verblijfsobject if it exists already, after importing a new BAG release (optional)
+    Returns: none
+    """
+
+    cursor.execute("SELECT to_regclass('input_data.verblijfsobject_per_pand') IS NOT NULL;")
+    exists = cursor.fetchone()[0]
+
+    if not exists:
+        print('\n>> Creating materialized view input_data.verblijfsobject_per_pand')
+        cursor.execute('''
+            CREATE MATERIALIZED VIEW input_data.verblijfsobject_per_pand AS
+            SELECT pandid, ARRAY_AGG(DISTINCT gebruiksdoelen) FILTER (WHERE gebruiksdoelen IS NOT NULL) AS uses,
+            COUNT(DISTINCT identificatie)::INTEGER AS bag_no_dwellings, ARRAY_AGG(DISTINCT identificatie) AS vbo_ids
+            FROM input_data.verblijfsobject CROSS JOIN unnest(pandref) AS pandid
+            LEFT JOIN LATERAL unnest(gebruiksdoel) AS gebruiksdoelen ON true
+            WHERE status LIKE 'Verblijfsobject in gebruik%' AND eindgeldigheid IS NULL
+            GROUP BY pandid;
+
+            CREATE UNIQUE INDEX verblijfsobject_per_pand_idx ON input_data.verblijfsobject_per_pand (pandid);
+            '''
+        )
+    elif refresh:
+        print('\n>> Refreshing materialized view input_data.verblijfsobject_per_pand')
+        cursor.execute("REFRESH MATERIALIZED VIEW CONCURRENTLY input_data.verblijfsobject_per_pand;")
+
+def copy_training_table(cursor, table, columns=None, exclude=()):
+    """
+    Load a table of the training_data schema into a DataFrame with typed NumPy columns, reading only the needed columns
+    with one COPY ... TO STDOUT WITH (FORMAT csv) that is parsed by the C parser of pandas, instead of row by row with pd.read_sql_query().
+    Integer and boolean columns without NULL values are int32/int64/int16 and bool, with NULL values float64 (NaN) and
+    nullable boolean, like pd.read_sql_query(). Array columns (e.g. building_type of the EP-Online ground truth) are
+    selected as JSON and parsed back into lists, so they are the same lists as with pd.read_sql_query().
+    Parameters:
+    cursor -- cursor for database connection
+    table -- table in the training_data schema
+    columns -- columns to load, all columns by default (optional)
+    exclude -- columns not to load (optional)
+    Returns: DataFrame with the columns in the order of the table
+    """
+
+    cursor.execute(f'''
+        SELECT column_name, data_type FROM information_schema.columns
+        WHERE table_schema = 'training_data' AND table_name = '{table}'
+        ORDER BY ordinal_position;
+        '''
+    )
+    types = {column: data_type for column, data_type in cursor.fetchall()
+             if (columns is None or column in columns) and column not in exclude}
+
+    if columns is not None and set(columns) - set(types):
+        raise ValueError(f'Columns not in training_data.{table}: {sorted(set(columns) - set(types))}')
+
+    print(f'\n>> Dataset {table} -- loading {len(types)} columns')
+
+    #COPY writes arrays as {...} literals, as JSON they can be parsed back into lists
+    names = ', '.join(f'to_json("{column}")' if data_type == 'ARRAY' else f'"{column}"' for column, data_type in types.items())
+    with SpooledTemporaryFile(max_size=SPOOL_SIZE, mode='w+b') as buffer:
+        cursor.copy_expert(f"COPY (SELECT {names} FROM training_data.{table}) TO STDOUT WITH (FORMAT csv)", buffer)
+        buffer.seek(0)
+        #only the empty fields of COPY are NULL, strings such as 'NA' or 'null' (e.g. in bag_id or building_type) are kept,
+        #booleans are written as t and f
+        data = pd.read_csv(buffer, names=list(types), dtype={column: DTYPES.get(data_type, 'object') for column, data_type in types.items()},
+                           keep_default_na=False, na_values=[''], true_values=['t'], false_values=['f'])
+
+    for column, data_type in types.items():
+        if data_type in ('integer', 'bigint', 'smallint'):
+            has_null = data[column].isna().any()
+            data[column] = data[column].to_numpy(dtype='float64', na_value=np.nan) if has_null else data[column].to_numpy(dtype=DTYPES[data_type].lower())
+        elif data_type == 'boolean' and not data[column].isna().any():
+            data[column] = data[column].to_numpy(dtype='bool')
+        elif data_type == 'ARRAY':
+            data[column] = pd.Series([json.loads(value) if isinstance(value, str) else None for value in data[column]], index=data.index, dtype='object')
+    return data
+
+def get_table_marker(cursor, table):
+    """
+    Get the change marker of training_data.{table} without reading the table: its oid and file node, which change when the table
+    is replaced (e.g. by replace_temp_table()) or truncated, the numbers of inserted, updated and deleted rows of pg_stat_user_tables
+    and its columns. Note: other sessions report their changes to pg_stat_user_tables at the end of their transactions, up to a few seconds later.
+    Returns: list with the marker, the columns of the table in their order as last item
+    """
+
+    cursor.execute(f'''
+        SELECT c.oid::BIGINT, pg_relation_filenode(c.oid)::BIGINT, s.n_tup_ins, s.n_tup_upd, s.n_tup_del,
+            (SELECT array_agg(attname::TEXT ORDER BY attnum) FROM pg_attribute WHERE attrelid = c.oid AND attnum > 0 AND NOT attisdropped)
+        FROM pg_class c JOIN pg_stat_user_tables s ON s.relid = c.oid
+        WHERE c.oid = 'training_data.{table}'::regclass;
+        '''
+    )
+    return list(cursor.fetchone())
+
+def get_cache_columns(table, table_columns, columns=None, exclude=()):
+    """
+    Get the columns of training_data.{table} to load, in the order of the table.
+    """
+
+    if columns is not None and set(columns) - set(table_columns):
+        raise ValueError(f'Columns not in training_data.{table}: {sorted(set(columns) - set(table_columns))}')
+    return [column for column in table_columns if (columns is None or column in columns) and column not in exclude]
+
+def write_training_cache(table, data, marker, meta=None):
+    """
+    Store the columns of a DataFrame of training_data.{table} in the feature cache: one .npy file per column, numeric and boolean
+    columns as NumPy arrays that can be memory-mapped, the other columns (strings with NULL as None, arrays as lists) as pickled
+    object arrays, and meta.json with the cached columns and the change marker of the table.
+    Without meta the cache is written to a temporary directory that replaces the old cache, with meta (the cache of the same marker)
+    the columns are added to the cache, in the order of its rows (matched on CACHE_KEY).
+    Returns: meta of the cache
+    """
+
+    path = os.path.join(CACHE_DIR, table)
+    if meta is not None:
+        order = pd.Index(data[CACHE_KEY]).get_indexer(np.load(os.path.join(path, f'{CACHE_KEY}.npy'), allow_pickle=True))
+        if len(order) != len(data) or (order < 0).any():
+            return write_training_cache(table, data, marker)
+        data = data.iloc[order].reset_index(drop=True)
+        meta = dict(meta, columns=list(meta['columns']), objects=list(meta['objects']))
+        save_cache_columns(path, data, meta)
+
+        tmp_meta = os.path.join(path, f'meta.json.tmp{os.getpid()}')
+        with open(tmp_meta, 'w') as f:
+            json.dump(meta, f)
+        os.replace(tmp_meta, os.path.join(path, 'meta.json'))
+        return meta
+
+    tmp_path = f'{path}_tmp{os.getpid()}'
+    shutil.rmtree(tmp_path, ignore_errors=True)
+    os.makedirs(tmp_path)
+
+    try:
+        meta = {'marker': marker, 'columns': [], 'objects': []}
+        save_cache_columns(tmp_path, data, meta)
+
+        with open(os.path.join(tmp_path, 'meta.json'), 'w') as f:
+            json.dump(meta, f)
+    except Exception:
+        shutil.rmtree(tmp_path, ignore_errors=True)
+        raise
+
+    invalidate_training_cache(table)
+    os.rename(tmp_path, path)
+    return meta
+
+def save_cache_columns(path, data, meta):
+    #write the columns of data that are not in the cache yet and add them to meta, see write_training_cache()
+    for column in data.columns:
+        if column in meta['columns']:
+            continue
+
+        values = data[column]
+        if pd.api.types.is_bool_dtype(values):
+            #like the nullable integers of copy_training_table()
+            values = values.to_numpy(dtype='float64', na_value=np.nan) if values.isna().any() else values.to_numpy(dtype=bool)
+        elif pd.api.types.is_numeric_dtype(values):
+            values = values.to_numpy()
+        else:
+            values = values.astype(object).where(values.notna(), None).to_numpy()
+            meta['objects'].append(column)
+        np.save(os.path.join(path, f'{column}.npy'), values, allow_pickle=column in meta['objects'])
+        meta['columns'].append(column)
+    return
+
+def read_training_cache_meta(table):
+    try:
+        with open(os.path.join(CACHE_DIR, table, 'meta.json')) as f:
+            meta = json.load(f)
+    except (OSError, ValueError):
+        return None
+
+    #the cache of an older version is written again
+    return meta if 'objects' in meta else None
+
+def read_training_cache(table, meta, columns):
+    """
+    Read columns of training_data.{table} from the feature cache, see write_training_cache().
+    The numeric columns are memory-mapped, pandas copies only the selected columns into the DataFrame.
+    Returns: DataFrame with the columns in the given order
+    """
+
+    data = {}
+    for column in columns:
+        if column in meta['objects']:
+            data[column] = np.load(os.path.join(CACHE_DIR, table, f'{column}.npy'), allow_pickle=True)
+        else:
+            data[column] = np.load(os.path.join(CACHE_DIR, table, f'{column}.npy'), mmap_mode='r')
+
+    print(f'\n>> Dataset {table} -- loading {len(data)} columns from the feature cache')
+    return pd.DataFrame(data)
+
+def invalidate_training_cache(table):
+    """
+    Remove training_data.{table} from the feature cache, called by the scripts that rewrite the table.
+    """
+
+    shutil.rmtree(os.path.join(CACHE_DIR, table), ignore_errors=True)
+    return
+
+def load_training_table(table, columns=None, exclude=(), cache='off'):
+    """
+    Load a table of the training_data schema into a DataFrame, see copy_training_table().
+    With the feature cache the loaded columns are stored on disk (see write_training_cache()) and the next loads read the cache
+    instead of the database, keyed by the table and its change marker (see get_table_marker()). Only the columns that are not
+    cached yet are loaded from the database, they are added to the cache.
+    Parameters:
+    table -- table in the training_data schema
+    columns -- columns to load, all columns by default (optional)
+    exclude -- columns not to load (optional)
+    cache -- 'off': always read the database, 'verify': use the cache if the change marker of the table is unchanged,
+    'trust': use the cache without a database round trip, it is only removed by the scripts that rewrite the table (optional)
+    Returns: DataFrame with the columns in the order of the table
+    """
+
+    if cache not in ('off', 'verify', 'trust'):
+        raise ValueError(f"Unknown feature cache mode '{cache}', use 'off', 'verify' or 'trust'")
+
+    if cache == 'off':
+        with session() as cursor:
+            return copy_training_table(cursor, table, columns, exclude)
+
+    meta = read_training_cache_meta(table)
+    if meta is not None and cache == 'trust':
+        needed = get_cache_columns(table, meta['marker'][-1], columns, exclude)
+        if set(needed) <= set(meta['columns']):
+            return read_training_cache(table, meta, needed)
+
+    with session() as cursor:
+        marker = get_table_marker(cursor, table)
+        table_columns = marker[-1]
+        needed = get_cache_columns(table, table_columns, columns, exclude)
+        if meta is not None and meta['marker'] != marker:
+            meta = None
+
+        missing = [column for column in needed if meta is None or column not in meta['columns']]
+        if not missing:
+            return read_training_cache(table, meta, needed)
+
+        print(f'\n>> Dataset {table} -- feature cache is missing or outdated for {len(missing)} columns')
+        if CACHE_KEY not in table_columns:
+            #without the key the rows of columns loaded later can not be matched, the table is not cached
+            return copy_training_table(cursor, table, needed)
+
+        #the key is always cached, to match the rows of the columns added later
+        data = copy_training_table(cursor, table, set(missing) | {CACHE_KEY})
+
+    meta = write_training_cache(table, data, marker, meta)
+    return read_training_cache(table, meta, needed)
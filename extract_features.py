@@ -4,8 +4,20 @@ Based on: Ellie Roy (https://github.com/ellieroy/no-floors-inference-NL)
 & Imke Lansky (https://github.com/ImkeLansky/USA-BuildingHeightInference)
 '''
 
+import cityjson_reader
 import db_functions
+import feature_scheduler
+import footprint_metrics
+import import_groundtruth
+import io
 import json
+import numpy as np
+import pandas as pd
+import sql_profiler
+import tile_functions
+from multiprocessing import Pool
+from scipy.sparse import csr_matrix
+from scipy.sparse.csgraph import connected_components, dijkstra
 
 #2D problems
 def get_buildingfunction(cursor, table):
@@ -19,10 +31,8 @@ def get_buildingfunction(cursor, table):
         UPDATE training_data.{table}_tmp
         SET uses = subquery.uses 
         FROM 
-            (SELECT pandid, ARRAY_AGG(distinct gebruiksdoelen) AS uses
-            FROM input_data.verblijfsobject, unnest(pandref) AS pandid, unnest(gebruiksdoel) AS gebruiksdoelen
-            WHERE status LIKE 'Verblijfsobject in gebruik%' AND eindgeldigheid IS NULL 
-            GROUP BY pandid) AS subquery
+            (SELECT pandid, uses
+            FROM input_data.verblijfsobject_per_pand) AS subquery
         WHERE training_data.{table}_tmp.bag_id = subquery.pandid;
         '''
     )
@@ -84,132 +94,223 @@ def get_num_dwellings(cursor, table):
         UPDATE training_data.{table}_tmp
         SET bag_no_dwellings = subquery.bag_no_dwellings
         FROM
-            (SELECT pandid, COUNT(DISTINCT identificatie) AS bag_no_dwellings
-            FROM input_data.verblijfsobject, unnest(pandref) AS pandid
-            WHERE status LIKE 'Verblijfsobject in gebruik%' AND eindgeldigheid IS NULL
-            GROUP BY pandid
-            ORDER BY pandid ASC) AS subquery
+            (SELECT pandid, bag_no_dwellings
+            FROM input_data.verblijfsobject_per_pand) AS subquery
         WHERE training_data.{table}_tmp.bag_id = subquery.pandid;
         '''
     )
     return
 
-def compute_buffers(cursor, table, size):
+def compute_adjacency(cursor, table, buffer_sizes):
     """
-    Compute buffers around all footprint geometries and store results in database. 
-    
+    Compute the adjacency graph of the building footprints once and store it as edge table training_data.{table}_adjacency,
+    with a row (bag_id, adjacent_id, buffer_size) for every footprint that intersects the buffer around another footprint.
+    All buffer sizes are computed from one spatial join with the largest buffer, the adjacency features are graph queries on this table.
     Parameters:
     cursor -- cursor for database connection
     table -- table to store the features in the database
-    size -- size of buffer (meters)
+    buffer_sizes -- list of buffer sizes (meters)
     Returns: none
     """
 
-    print(f'\n>> Dataset {table} -- computing buffers of {size}m around footprints')
+    print(f'\n>> Dataset {table} -- computing adjacency graph of footprints with buffers of {buffer_sizes}m')
 
-    cursor.execute(f"ALTER TABLE training_data.{table}_tmp ADD COLUMN IF NOT EXISTS footprint_buffer GEOMETRY;")
+    sizes = ', '.join(str(size) for size in buffer_sizes)
 
     cursor.execute(f'''
-        UPDATE training_data.{table}_tmp
-        SET footprint_buffer = subquery.buffer
+        CREATE TABLE IF NOT EXISTS training_data.{table}_adjacency
+        (bag_id VARCHAR, adjacent_id VARCHAR, buffer_size DOUBLE PRECISION);
+        '''
+    )
+
+    #replace the edges of a previous run with the same buffer sizes
+    cursor.execute(f"DELETE FROM training_data.{table}_adjacency WHERE buffer_size IN ({sizes});")
+
+    cursor.execute(f'''
+        INSERT INTO training_data.{table}_adjacency (bag_id, adjacent_id, buffer_size)
+        SELECT a.bag_id, b.bag_id, s.buffer_size
         FROM
-            (SELECT bag_id, ST_Buffer(footprint_geom, {size}, 'join=mitre') AS buffer
-            FROM training_data.{table}_tmp) AS subquery
-        WHERE training_data.{table}_tmp.bag_id = subquery.bag_id;
+            (SELECT bag_id, footprint_geom, ST_Buffer(footprint_geom, {max(buffer_sizes)}, 'join=mitre') AS footprint_buffer
+            FROM training_data.{table}_tmp
+            WHERE footprint_geom IS NOT NULL) AS a
+        JOIN training_data.{table}_tmp AS b
+        ON a.footprint_buffer && b.footprint_geom
+        AND a.bag_id != b.bag_id
+        CROSS JOIN unnest(ARRAY[{sizes}]::DOUBLE PRECISION[]) AS s(buffer_size)
+        WHERE ST_INTERSECTS(
+            CASE WHEN s.buffer_size = {max(buffer_sizes)} THEN a.footprint_buffer
+            ELSE ST_Buffer(a.footprint_geom, s.buffer_size, 'join=mitre') END,
+            b.footprint_geom);
         '''
     )
 
     cursor.execute(f'''
-        CREATE INDEX IF NOT EXISTS {table}_buf_idx_tmp
-        ON training_data.{table}_tmp
-        USING GIST (footprint_buffer);
+        CREATE INDEX IF NOT EXISTS {table}_adjacency_idx
+        ON training_data.{table}_adjacency (buffer_size, bag_id);
         '''
     )
     return
 
-def get_num_adjacent_bldg(cursor, table, buffer_size):
+def get_num_adjacent_bldg(cursor, table, buffer_size, column='no_adjacent_bldg', graph=None):
     """
-    Get number of adjacent buildings (of all functions except for "Others" and "Unknown") of each building footprint and store results in the database. 
+    Get number of adjacent buildings (of all functions except for "Others" and "Unknown") of each building footprint
+    as degree in the adjacency graph and store results in the database, see compute_adjacency().
     Parameters:
-    cursor -- cursor for database connection 
+    cursor -- cursor for database connection
     table -- table to store the features in the database
-    adjacent_distance -- list of distances to adjacent buildings
+    buffer_size -- buffer size of the edges to use
+    column -- column to store the number in (optional)
+    graph -- edge table of the adjacency graph, {table}_adjacency by default (optional)
     Returns: none
-    
     """
 
-    # Compute buffer around footprints
-    compute_buffers(cursor, table, buffer_size)
-    
-    print(f'\n>> Dataset {table} -- obtaining number of adjacent buildings from footprints')
+    graph = graph if graph is not None else f'{table}_adjacency'
 
-    # Extract number of adjacent buildings based on buffer
-    cursor.execute(f"ALTER TABLE training_data.{table}_tmp ADD COLUMN IF NOT EXISTS no_adjacent_bldg INTEGER;")
+    print(f'\n>> Dataset {table} -- obtaining number of adjacent buildings from adjacency graph')
 
+    cursor.execute(f"ALTER TABLE training_data.{table}_tmp ADD COLUMN IF NOT EXISTS {column} INTEGER;")
+
+    # Buildings without adjacent buildings get 0 (except from when footprint geometry is equal to null)
     cursor.execute(f'''
         UPDATE training_data.{table}_tmp
-        SET no_adjacent_bldg = subquery.no_adjacent
+        SET {column} = subquery.no_adjacent
         FROM
-            (SELECT a.bag_id, COUNT(*) AS no_adjacent
+            (SELECT a.bag_id, COUNT(b.bag_id) FILTER (WHERE a.bag_function != 'Others' AND a.bag_function != 'Unknown') AS no_adjacent
             FROM training_data.{table}_tmp AS a
-            JOIN training_data.{table}_tmp AS b
-            ON a.footprint_buffer && b.footprint_geom
-            AND ST_INTERSECTS(a.footprint_buffer, b.footprint_geom)
-            WHERE a.bag_id != b.bag_id
-            AND a.bag_function != 'Others' AND a.bag_function != 'Unknown' 
-            AND b.bag_function != 'Others' AND b.bag_function != 'Unknown' 
+            LEFT JOIN training_data.{graph} AS e
+            ON e.bag_id = a.bag_id AND e.buffer_size = {buffer_size}
+            LEFT JOIN training_data.{table}_tmp AS b
+            ON b.bag_id = e.adjacent_id
+            AND b.bag_function != 'Others' AND b.bag_function != 'Unknown'
+            WHERE a.footprint_geom IS NOT NULL
             GROUP BY a.bag_id) AS subquery
         WHERE training_data.{table}_tmp.bag_id = subquery.bag_id;
         '''
     )
-    
-    # Set number of adjacent buildings equal to zero when column is null
-    # (except from when footprint geometry is equal to null)
-    cursor.execute(f'''
-        UPDATE training_data.{table}_tmp
-        SET no_adjacent_bldg = 0 
-        WHERE no_adjacent_bldg IS NULL
-        AND footprint_geom IS NOT NULL;
-        '''
-    )
     return
 
-def get_num_adjacent_bldg_of_adjacent_bldg(cursor, table):
+def get_num_adjacent_bldg_of_adjacent_bldg(cursor, table, buffer_size, column='no_adjacent_of_adja_bldg', degree_column='no_adjacent_bldg', graph=None):
     """
-    Get (maximum) number of adjacent buildings of adjacent buildings
+    Get (maximum) number of adjacent buildings of adjacent buildings from the adjacency graph, see get_num_adjacent_bldg().
+    Parameters:
+    cursor -- cursor for database connection
+    table -- table to store the features in the database
+    buffer_size -- buffer size of the edges to use
+    column -- column to store the number in (optional)
+    degree_column -- column with the number of adjacent buildings (optional)
+    graph -- edge table of the adjacency graph, {table}_adjacency by default (optional)
+    Returns: none
     """
 
+    graph = graph if graph is not None else f'{table}_adjacency'
+
     print(f'\n>> Dataset {table} -- obtaining number of adjacent buildings of adjacent building(s)')
 
-    cursor.execute(f"ALTER TABLE training_data.{table}_tmp ADD COLUMN IF NOT EXISTS no_adjacent_of_adja_bldg INTEGER;")
+    cursor.execute(f"ALTER TABLE training_data.{table}_tmp ADD COLUMN IF NOT EXISTS {column} INTEGER;")
 
+    # Buildings without adjacent buildings get 0 (except from when footprint geometry is equal to null)
     cursor.execute(f'''
         UPDATE training_data.{table}_tmp
-        SET no_adjacent_of_adja_bldg = subquery.no_adjacent_of_adja_bldg
+        SET {column} = subquery.no_adjacent_of_adja_bldg
         FROM
-            (SELECT a.bag_id, MAX(b.no_adjacent_bldg) AS no_adjacent_of_adja_bldg
+            (SELECT a.bag_id, COALESCE(MAX(b.{degree_column}), 0) AS no_adjacent_of_adja_bldg
             FROM training_data.{table}_tmp AS a
-            JOIN training_data.{table}_tmp AS b
-            ON a.footprint_buffer && b.footprint_geom
-            AND ST_INTERSECTS(a.footprint_buffer, b.footprint_geom)
-            WHERE a.bag_id != b.bag_id
+            LEFT JOIN training_data.{graph} AS e
+            ON e.bag_id = a.bag_id AND e.buffer_size = {buffer_size}
+            LEFT JOIN training_data.{table}_tmp AS b
+            ON b.bag_id = e.adjacent_id
+            WHERE a.footprint_geom IS NOT NULL
             GROUP BY a.bag_id) AS subquery
         WHERE training_data.{table}_tmp.bag_id = subquery.bag_id;
         '''
     )
+    return
+
+def compute_blocks(ids, edges):
+    """
+    Compute the building blocks (connected components) of the adjacency graph.
+    Parameters:
+    ids -- list of bag_ids
+    edges -- list of (bag_id, adjacent_id) tuples
+    Returns: array with the number of buildings in the block and array with the position in the row,
+    the number of buildings between the building and the nearest end of its block (0 for ends and detached buildings)
+    """
+
+    index = {id: i for i, id in enumerate(ids)}
+    edges = [(index[a], index[b]) for a, b in edges if a in index and b in index]
+    rows = np.array([a for a, b in edges], dtype=np.int64)
+    cols = np.array([b for a, b in edges], dtype=np.int64)
+
+    graph = csr_matrix((np.ones(len(edges)), (rows, cols)), shape=(len(ids), len(ids)))
+    graph = ((graph + graph.T) > 0).astype(np.float64)
+
+    n_blocks, labels = connected_components(graph, directed=False)
+    block_size = np.bincount(labels, minlength=n_blocks)[labels]
+
+    #ends of a block are its buildings with the lowest degree, the middle of a closed block is as far as possible from them
+    degree = np.asarray(graph.sum(axis=1)).ravel()
+    min_degree = np.full(n_blocks, np.inf)
+    np.minimum.at(min_degree, labels, degree)
+    ends = np.flatnonzero(degree == min_degree[labels])
+    row_position = dijkstra(graph, directed=False, indices=ends, unweighted=True, min_only=True)
+
+    return block_size, row_position.astype(np.int64)
+
+def get_block_features(cursor, table, buffer_size, graph=None):
+    """
+    Get the number of buildings in the building block (connected component of the adjacency graph) and the position in the row
+    of each building footprint and store results in the database, see compute_blocks().
+    Buildings with function "Others" and "Unknown" are not part of a block, like in get_num_adjacent_bldg().
+    Parameters:
+    cursor -- cursor for database connection
+    table -- table to store the features in the database
+    buffer_size -- buffer size of the edges to use
+    graph -- edge table of the adjacency graph, {table}_adjacency by default (optional)
+    Returns: none
+    """
+
+    graph = graph if graph is not None else f'{table}_adjacency'
+
+    print(f'\n>> Dataset {table} -- obtaining building block size and position in row from adjacency graph')
+
+    cursor.execute(f"SELECT bag_id FROM training_data.{table}_tmp WHERE footprint_geom IS NOT NULL;")
+    ids = [bag_id for (bag_id,) in cursor.fetchall()]
 
-    # Set number of adjacent buildings of adjacent buildings equal to zero when column is null
-    # (except from when footprint geometry is equal to null)
     cursor.execute(f'''
-        UPDATE training_data.{table}_tmp
-        SET no_adjacent_of_adja_bldg = 0 
-        WHERE no_adjacent_of_adja_bldg IS NULL
-            AND footprint_geom IS NOT NULL;
+        SELECT e.bag_id, e.adjacent_id
+        FROM training_data.{graph} AS e
+        JOIN training_data.{table}_tmp AS a ON a.bag_id = e.bag_id
+        JOIN training_data.{table}_tmp AS b ON b.bag_id = e.adjacent_id
+        WHERE e.buffer_size = {buffer_size}
+        AND a.bag_function != 'Others' AND a.bag_function != 'Unknown'
+        AND b.bag_function != 'Others' AND b.bag_function != 'Unknown';
         '''
     )
+    block_size, row_position = compute_blocks(ids, cursor.fetchall())
+
+    cursor.execute(f"ALTER TABLE training_data.{table}_tmp ADD COLUMN IF NOT EXISTS block_size INTEGER;")
+    cursor.execute(f"ALTER TABLE training_data.{table}_tmp ADD COLUMN IF NOT EXISTS row_position INTEGER;")
 
-    # Drop the buffer column
-    cursor.execute(f"ALTER TABLE training_data.{table}_tmp DROP COLUMN footprint_buffer;")
+    cursor.execute(f'''
+        DROP TABLE IF EXISTS {table}_blocks;
+        CREATE TEMPORARY TABLE {table}_blocks (bag_id VARCHAR, block_size INTEGER, row_position INTEGER);
+        '''
+    )
+
+    buffer = io.StringIO()
+    pd.DataFrame({'bag_id': ids, 'block_size': block_size, 'row_position': row_position}).to_csv(buffer, index=False, header=False)
+    buffer.seek(0)
+    cursor.copy_expert(f"COPY {table}_blocks FROM STDIN WITH (FORMAT csv)", buffer)
+
+    cursor.execute(f'''
+        UPDATE training_data.{table}_tmp
+        SET block_size = {table}_blocks.block_size, row_position = {table}_blocks.row_position
+        FROM {table}_blocks
+        WHERE training_data.{table}_tmp.bag_id = {table}_blocks.bag_id;
+
+        DROP TABLE {table}_blocks;
+        '''
+    )
     return
 
 def get_footprint(cursor, table): 
@@ -331,87 +432,140 @@ def get_num_neighbours(cursor, table, neighbour_distances):
 
     print(f'\n>> Dataset {table} -- obtaining number of neighbouring buildings from these distances in m: {neighbour_distances}')
 
-    # Extract number of neightbours based on centroid 
-    for dist in neighbour_distances: 
+    for dist in neighbour_distances:
         cursor.execute(f"ALTER TABLE training_data.{table}_tmp ADD COLUMN IF NOT EXISTS no_neighbours_{dist}m INTEGER;")
 
-        cursor.execute(f'''
-            UPDATE training_data.{table}_tmp
-            SET no_neighbours_{dist}m = subquery.no_neighbours
-            FROM
-                (SELECT a.bag_id, COUNT(*) AS no_neighbours, ARRAY_AGG(b.bag_id)
-                FROM training_data.{table}_tmp AS a
-                JOIN training_data.{table}_tmp AS b
-                ON ST_DWithin(a.footprint_centroid, b.footprint_geom, {dist})
-                WHERE a.bag_id != b.bag_id
-                GROUP BY a.bag_id) AS subquery
-            WHERE training_data.{table}_tmp.bag_id = subquery.bag_id;
-            '''
-        )
+    # Extract number of neighbours based on centroid for all distances from one join at the largest distance
+    # The left join gives 0 neighbours instead of null (except from when footprint geometry is equal to null)
+    columns = ', '.join(f'no_neighbours_{dist}m = subquery.no_neighbours_{dist}m' for dist in neighbour_distances)
+    counts = ', '.join(f'COUNT(*) FILTER (WHERE ST_Distance(a.footprint_centroid, b.footprint_geom) <= {dist}) AS no_neighbours_{dist}m'
+                       for dist in neighbour_distances)
+
+    cursor.execute(f'''
+        UPDATE training_data.{table}_tmp
+        SET {columns}
+        FROM
+            (SELECT a.bag_id, {counts}
+            FROM training_data.{table}_tmp AS a
+            LEFT JOIN training_data.{table}_tmp AS b
+            ON ST_DWithin(a.footprint_centroid, b.footprint_geom, {max(neighbour_distances)})
+            AND a.bag_id != b.bag_id
+            WHERE a.footprint_geom IS NOT NULL
+            GROUP BY a.bag_id) AS subquery
+        WHERE training_data.{table}_tmp.bag_id = subquery.bag_id;
+        '''
+    )
 
-        # Set number of neighbouring buildings equal to zero when column is null
-        # (except from when footprint geometry is equal to null)
-        cursor.execute(f'''
-            UPDATE training_data.{table}_tmp
-            SET no_neighbours_{dist}m = 0
-            WHERE no_neighbours_{dist}m IS NULL
-            AND footprint_geom IS NOT NULL;
-            '''
-        )
-    
     # Drop the centroid column
     cursor.execute(f"ALTER TABLE training_data.{table}_tmp DROP COLUMN footprint_centroid;")
     return
 
 def get_mbr(cursor, table):
+    """
+    Get the length and width of the minimum bounding box (ST_OrientedEnvelope) of each footprint in one UPDATE,
+    as the lengths of two adjacent edges of the box, its first three points.
+    Parameters:
+    cursor -- cursor for database connection
+    table -- table to store the features in the database
+    Returns: none
+    """
 
-    print(f'\n>> Dataset {table} -- obtaining minimum bounding box of footprint')
-
-    cursor.execute(f"ALTER TABLE training_data.{table}_tmp ADD COLUMN IF NOT EXISTS bbox GEOMETRY;")
+    print(f'\n>> Dataset {table} -- obtaining length and width of minimum bounding box of footprint')
 
     cursor.execute(f'''
         UPDATE training_data.{table}_tmp
-        SET bbox = ST_OrientedEnvelope(footprint_geom);
+        SET fp_length = GREATEST(sides.side_1, sides.side_2), fp_width = LEAST(sides.side_1, sides.side_2)
+        FROM
+            (SELECT bag_id, ST_Distance(ST_PointN(ring, 1), ST_PointN(ring, 2)) AS side_1, ST_Distance(ST_PointN(ring, 2), ST_PointN(ring, 3)) AS side_2
+            FROM
+                (SELECT bag_id, ST_ExteriorRing(ST_OrientedEnvelope(footprint_geom)) AS ring
+                FROM training_data.{table}_tmp) AS mbr) AS sides
+        WHERE training_data.{table}_tmp.bag_id = sides.bag_id;
         '''
     )
+    return
 
-    cursor.execute(f"ALTER TABLE training_data.{table}_tmp ADD COLUMN IF NOT EXISTS side_1 DOUBLE PRECISION;")
-    cursor.execute(f"ALTER TABLE training_data.{table}_tmp ADD COLUMN IF NOT EXISTS side_2 DOUBLE PRECISION;")
+def get_bldg_length_width(cursor, table):
 
-    # Store the length of the two sides of the MBR as well.
-    cursor.execute(f'''
-        UPDATE training_data.{table}_tmp
-        SET side_1 = ST_Distance(ST_Point(ST_Xmin(bbox), ST_Ymin(bbox)), ST_Point(ST_Xmin(bbox), ST_Ymax(bbox))),
-        side_2 = ST_Distance(ST_Point(ST_Xmin(bbox), ST_Ymin(bbox)), ST_Point(ST_Xmax(bbox), ST_Ymin(bbox)));
-        '''
-    )
+    cursor.execute(f"ALTER TABLE training_data.{table}_tmp ADD COLUMN IF NOT EXISTS fp_length DOUBLE PRECISION;")
+    cursor.execute(f"ALTER TABLE training_data.{table}_tmp ADD COLUMN IF NOT EXISTS fp_width DOUBLE PRECISION;")
 
-    cursor.execute(f"ALTER TABLE training_data.{table}_tmp DROP COLUMN bbox;")    
+    get_mbr(cursor, table)
     return
 
-def get_bldg_length_width(cursor, table):
+def read_footprint_chunks(cursor, table, chunk_size):
+    """
+    Read the footprints of training_data.{table}_tmp as WKB in chunks through a server-side cursor.
+    Returns: generator of lists of (bag_id, wkb) tuples
+    """
 
-    get_mbr(cursor, table)
+    server_cursor = cursor.connection.cursor(name=f'{table}_footprints', withhold=True)
+    server_cursor.itersize = chunk_size
+    server_cursor.execute(f"SELECT bag_id, ST_AsBinary(footprint_geom) FROM training_data.{table}_tmp;")
 
-    print(f'\n>> Dataset {table} -- obtaining footprint width and length')
+    while True:
+        rows = server_cursor.fetchmany(chunk_size)
+        if not rows:
+            break
+        #bytes instead of memoryview to send the chunks to other processes
+        yield [(bag_id, None if wkb is None else bytes(wkb)) for bag_id, wkb in rows]
 
-    cursor.execute(f"ALTER TABLE training_data.{table}_tmp ADD COLUMN IF NOT EXISTS fp_length DOUBLE PRECISION;")
-    cursor.execute(f"ALTER TABLE training_data.{table}_tmp ADD COLUMN IF NOT EXISTS fp_width DOUBLE PRECISION;")
+    server_cursor.close()
+    return
+
+def compute_footprint_chunk(rows):
+    features = footprint_metrics.compute_features([wkb for bag_id, wkb in rows])
+    features.insert(0, 'bag_id', [bag_id for bag_id, wkb in rows])
+    return features
+
+def get_footprint_metrics(cursor, table, n_processes=1):
+    """
+    Get the footprint area, perimeter, number of vertices, length and width (the features of get_fp_area(), get_fp_perimeter(),
+    get_num_vertices() and get_bldg_length_width()) in Python instead of PostGIS, see footprint_metrics.py.
+    The footprints are read once as WKB and the features are written back with one COPY and one UPDATE.
+    Parameters:
+    cursor -- cursor for database connection
+    table -- table to store the features in the database
+    n_processes -- number of processes to compute the chunks of footprints in (optional)
+    Returns: none
+    """
+
+    print(f'\n>> Dataset {table} -- obtaining footprint area, perimeter, vertices, length and width with {n_processes} processes')
+
+    columns = ', '.join(f'{feature} INTEGER' if feature.startswith('fp_no_') else f'{feature} DOUBLE PRECISION' for feature in footprint_metrics.FEATURES)
+    for column in columns.split(', '):
+        cursor.execute(f"ALTER TABLE training_data.{table}_tmp ADD COLUMN IF NOT EXISTS {column};")
 
     cursor.execute(f'''
-        UPDATE training_data.{table}_tmp
-        SET fp_length = subquery.length, fp_width = subquery.width
-        FROM
-            (SELECT bag_id, CASE WHEN side_1 > side_2 THEN side_1
-            ELSE side_2 END AS length, CASE WHEN side_1 < side_2 THEN side_1
-            ELSE side_2 END AS width FROM training_data.{table}_tmp) AS subquery
-        WHERE training_data.{table}_tmp.bag_id = subquery.bag_id;
+        DROP TABLE IF EXISTS {table}_fp;
+        CREATE TEMPORARY TABLE {table}_fp (bag_id VARCHAR, {columns});
         '''
     )
 
-    # Drop the helper columns.
-    cursor.execute(f"ALTER TABLE training_data.{table}_tmp DROP COLUMN side_1;")
-    cursor.execute(f"ALTER TABLE training_data.{table}_tmp DROP COLUMN side_2;")
+    chunks = read_footprint_chunks(cursor, table, footprint_metrics.CHUNK_SIZE)
+    pool = Pool(n_processes) if n_processes > 1 else None
+    results = pool.imap(compute_footprint_chunk, chunks) if pool else map(compute_footprint_chunk, chunks)
+
+    for features in results:
+        buffer = io.StringIO()
+        features.astype({'fp_no_vertices': 'Int64', 'fp_no_vertices_simple': 'Int64'}).to_csv(buffer, index=False, header=False)
+        buffer.seek(0)
+        cursor.copy_expert(f"COPY {table}_fp FROM STDIN WITH (FORMAT csv)", buffer)
+
+    if pool:
+        pool.close()
+        pool.join()
+
+    update = ', '.join(f'{feature} = {table}_fp.{feature}' for feature in footprint_metrics.FEATURES)
+    cursor.execute(f'''
+        UPDATE training_data.{table}_tmp
+        SET {update}
+        FROM {table}_fp
+        WHERE training_data.{table}_tmp.bag_id = {table}_fp.bag_id;
+
+        DROP TABLE {table}_fp;
+        '''
+    )
     return
 
 # def get_rooftype(cursor, table):
@@ -450,8 +604,95 @@ def get_num_storeys(cursor, table):
     ''')
     return
 
+def create_fused_table(cursor, table, neighbour_distances):
+    """
+    Create the temporary table with all per-row 2D features and BAG joins in a single CREATE UNLOGGED TABLE ... AS SELECT,
+    instead of adding them one UPDATE at a time. Produces the same columns, in the same order, as get_buildingfunction(),
+    get_footprint(), get_constructionyear(), get_num_dwellings(), get_fp_area(), get_fp_perimeter(), get_num_vertices()
+    and get_bldg_length_width(). The columns of the adjacency and neighbour features are created empty,
+    to be filled by get_num_adjacent_bldg(), get_num_adjacent_bldg_of_adjacent_bldg() and get_num_neighbours().
+    Parameters:
+    cursor -- cursor for database connection
+    table -- table to store the features in the database
+    neighbour_distances -- list of distances to neighbouring building centroids
+    Returns: none
+    """
+
+    print(f'\n>> Dataset {table} -- creating temporary unlogged table with the 2D features in a single pass')
+
+    #columns of the original table, without features of a previous run
+    features = ['bag_function', 'footprint_geom', 'no_adjacent_bldg', 'no_adjacent_of_adja_bldg'] + \
+               [f'no_neighbours_{dist}m' for dist in neighbour_distances] + \
+               ['bag_construction_year', 'bag_no_dwellings', 'fp_area', 'fp_perimeter', 'fp_no_vertices', 'fp_no_vertices_simple', 'fp_length', 'fp_width']
+    cursor.execute(f'''
+        SELECT column_name FROM information_schema.columns
+        WHERE table_schema = 'training_data' AND table_name = '{table}'
+        ORDER BY ordinal_position;
+        '''
+    )
+    columns = ''.join(f't."{column}", ' for (column,) in cursor.fetchall() if column not in features)
+    neighbours = ''.join(f'NULL::INTEGER AS no_neighbours_{dist}m, ' for dist in neighbour_distances)
+
+    cursor.execute(f"DROP TABLE IF EXISTS training_data.{table}_tmp;")
+
+    cursor.execute(
+        f"CREATE UNLOGGED TABLE training_data.{table}_tmp AS " +
+        f"SELECT {columns}" +
+            "CASE " +
+                "WHEN vbo.uses = '{woonfunctie}' THEN 'Residential' " +
+                "WHEN vbo.uses != '{woonfunctie}' AND 'woonfunctie' = ANY(vbo.uses) THEN 'Mixed-residential' " +
+                "WHEN 'woonfunctie' != ANY(vbo.uses) AND vbo.uses != '{overige gebruiksfunctie}' AND cardinality(vbo.uses) = 1 THEN 'Non-residential (single-function)' " +
+                "WHEN 'woonfunctie' != ANY(vbo.uses) AND vbo.uses != '{overige gebruiksfunctie}' AND cardinality(vbo.uses) > 1 THEN 'Non-residential (multi-function)' " +
+                "WHEN vbo.uses = '{overige gebruiksfunctie}' THEN 'Others' " +
+                "WHEN vbo.uses IS NULL THEN 'Unknown' " +
+            "END::VARCHAR AS bag_function, " +
+            "pand.footprint_geom::GEOMETRY AS footprint_geom, " +
+            "NULL::INTEGER AS no_adjacent_bldg, NULL::INTEGER AS no_adjacent_of_adja_bldg, " + neighbours +
+            "NULLIF(pand.bag_construction_year::INTEGER, 1005) AS bag_construction_year, " +
+            "vbo.bag_no_dwellings::INTEGER AS bag_no_dwellings, " +
+            "ST_Area(pand.footprint_geom)::DOUBLE PRECISION AS fp_area, " +
+            "ST_Perimeter(pand.footprint_geom)::DOUBLE PRECISION AS fp_perimeter, " +
+            "ST_NPoints(pand.footprint_geom)::INTEGER AS fp_no_vertices, " +
+            "ST_NPoints(ST_SimplifyPreserveTopology(pand.footprint_geom, 0.1))::INTEGER AS fp_no_vertices_simple, " +
+            "GREATEST(sides.side_1, sides.side_2)::DOUBLE PRECISION AS fp_length, " +
+            "LEAST(sides.side_1, sides.side_2)::DOUBLE PRECISION AS fp_width " +
+        f"FROM training_data.{table} AS t " +
+        #one pand per building, like the UPDATE ... FROM in get_footprint() and get_constructionyear()
+        "LEFT JOIN LATERAL " +
+            "(SELECT wkb_geometry AS footprint_geom, oorspronkelijkbouwjaar AS bag_construction_year " +
+            "FROM input_data.pand WHERE identificatie = t.bag_id LIMIT 1) AS pand ON true " +
+        #uses and number of dwellings of the verblijfsobjecten in use, see db_functions.create_vbo_aggregate()
+        "LEFT JOIN input_data.verblijfsobject_per_pand AS vbo ON vbo.pandid = t.bag_id " +
+        #same sides of the minimum bounding box as get_mbr()
+        "CROSS JOIN LATERAL (SELECT ST_ExteriorRing(ST_OrientedEnvelope(pand.footprint_geom)) AS ring) AS mbr " +
+        "CROSS JOIN LATERAL (SELECT ST_Distance(ST_PointN(mbr.ring, 1), ST_PointN(mbr.ring, 2)) AS side_1, " +
+            "ST_Distance(ST_PointN(mbr.ring, 2), ST_PointN(mbr.ring, 3)) AS side_2) AS sides;"
+    )
+
+    cursor.execute(f"ALTER TABLE training_data.{table}_tmp ADD PRIMARY KEY (bag_id);")
+
+    #create index on footprint geometry column
+    cursor.execute(f'''
+        CREATE INDEX IF NOT EXISTS {table}_footprint_idx_tmp
+        ON training_data.{table}_tmp
+        USING GIST (footprint_geom);
+        '''
+    )
+    return
+
 #3D problems
-def get_3DBM_features(cursor, table, lod):
+def get_3DBM_features(cursor, table, lod, target=None):
+    """
+    Get the 3DBM features of input_data.{table}_{lod}_3dbm.
+    Parameters:
+    cursor -- cursor for database connection
+    table -- table of the case study
+    lod -- 'lod1' or 'lod2'
+    target -- table to store the features in, training_data.{target}_tmp, table by default (optional)
+    Returns: none
+    """
+
+    target = target if target is not None else table
 
     print(f'\n>> Dataset {table} -- obtaining {lod} 3DBM features')
 
@@ -464,22 +705,22 @@ def get_3DBM_features(cursor, table, lod):
         '''
     )
 
-    cursor.execute(f"ALTER TABLE training_data.{table}_tmp ADD COLUMN IF NOT EXISTS actual_volume_{lod} DOUBLE PRECISION;")
-    cursor.execute(f"ALTER TABLE training_data.{table}_tmp ADD COLUMN IF NOT EXISTS convex_hull_volume_{lod} DOUBLE PRECISION;")
-    cursor.execute(f"ALTER TABLE training_data.{table}_tmp ADD COLUMN IF NOT EXISTS footprint_perimeter_{lod} DOUBLE PRECISION;")
-    cursor.execute(f"ALTER TABLE training_data.{table}_tmp ADD COLUMN IF NOT EXISTS obb_width_{lod} DOUBLE PRECISION;")
-    cursor.execute(f"ALTER TABLE training_data.{table}_tmp ADD COLUMN IF NOT EXISTS obb_length_{lod} DOUBLE PRECISION;")
-    cursor.execute(f"ALTER TABLE training_data.{table}_tmp ADD COLUMN IF NOT EXISTS ground_area_{lod} DOUBLE PRECISION;")
-    cursor.execute(f"ALTER TABLE training_data.{table}_tmp ADD COLUMN IF NOT EXISTS wall_area_{lod} DOUBLE PRECISION;")
-    cursor.execute(f"ALTER TABLE training_data.{table}_tmp ADD COLUMN IF NOT EXISTS roof_area_{lod} DOUBLE PRECISION;")
-    cursor.execute(f"ALTER TABLE training_data.{table}_tmp ADD COLUMN IF NOT EXISTS ground_point_count_{lod} INTEGER;")
-    cursor.execute(f"ALTER TABLE training_data.{table}_tmp ADD COLUMN IF NOT EXISTS height_max_{lod} DOUBLE PRECISION;")
-    cursor.execute(f"ALTER TABLE training_data.{table}_tmp ADD COLUMN IF NOT EXISTS height_min_roof_{lod} DOUBLE PRECISION;")
-    cursor.execute(f"ALTER TABLE training_data.{table}_tmp ADD COLUMN IF NOT EXISTS shared_walls_area_{lod} DOUBLE PRECISION;")
-    cursor.execute(f"ALTER TABLE training_data.{table}_tmp ADD COLUMN IF NOT EXISTS closest_distance_{lod} DOUBLE PRECISION;")
+    cursor.execute(f"ALTER TABLE training_data.{target}_tmp ADD COLUMN IF NOT EXISTS actual_volume_{lod} DOUBLE PRECISION;")
+    cursor.execute(f"ALTER TABLE training_data.{target}_tmp ADD COLUMN IF NOT EXISTS convex_hull_volume_{lod} DOUBLE PRECISION;")
+    cursor.execute(f"ALTER TABLE training_data.{target}_tmp ADD COLUMN IF NOT EXISTS footprint_perimeter_{lod} DOUBLE PRECISION;")
+    cursor.execute(f"ALTER TABLE training_data.{target}_tmp ADD COLUMN IF NOT EXISTS obb_width_{lod} DOUBLE PRECISION;")
+    cursor.execute(f"ALTER TABLE training_data.{target}_tmp ADD COLUMN IF NOT EXISTS obb_length_{lod} DOUBLE PRECISION;")
+    cursor.execute(f"ALTER TABLE training_data.{target}_tmp ADD COLUMN IF NOT EXISTS ground_area_{lod} DOUBLE PRECISION;")
+    cursor.execute(f"ALTER TABLE training_data.{target}_tmp ADD COLUMN IF NOT EXISTS wall_area_{lod} DOUBLE PRECISION;")
+    cursor.execute(f"ALTER TABLE training_data.{target}_tmp ADD COLUMN IF NOT EXISTS roof_area_{lod} DOUBLE PRECISION;")
+    cursor.execute(f"ALTER TABLE training_data.{target}_tmp ADD COLUMN IF NOT EXISTS ground_point_count_{lod} INTEGER;")
+    cursor.execute(f"ALTER TABLE training_data.{target}_tmp ADD COLUMN IF NOT EXISTS height_max_{lod} DOUBLE PRECISION;")
+    cursor.execute(f"ALTER TABLE training_data.{target}_tmp ADD COLUMN IF NOT EXISTS height_min_roof_{lod} DOUBLE PRECISION;")
+    cursor.execute(f"ALTER TABLE training_data.{target}_tmp ADD COLUMN IF NOT EXISTS shared_walls_area_{lod} DOUBLE PRECISION;")
+    cursor.execute(f"ALTER TABLE training_data.{target}_tmp ADD COLUMN IF NOT EXISTS closest_distance_{lod} DOUBLE PRECISION;")
 
     cursor.execute(f'''
-        UPDATE training_data.{table}_tmp
+        UPDATE training_data.{target}_tmp
         SET actual_volume_{lod} = {table}_{lod}_3dbm.actual_volume_{lod},
         convex_hull_volume_{lod} = {table}_{lod}_3dbm.convex_hull_volume_{lod},
         footprint_perimeter_{lod} = {table}_{lod}_3dbm.footprint_perimeter_{lod},
@@ -494,7 +735,7 @@ def get_3DBM_features(cursor, table, lod):
         shared_walls_area_{lod} = {table}_{lod}_3dbm.shared_walls_area_{lod},
         closest_distance_{lod} = {table}_{lod}_3dbm.closest_distance_{lod}
         FROM input_data.{table}_{lod}_3dbm
-        WHERE training_data.{table}_tmp.bag_id = input_data.{table}_{lod}_3dbm.new_id;
+        WHERE training_data.{target}_tmp.bag_id = input_data.{table}_{lod}_3dbm.new_id;
         '''
     )
 
@@ -504,6 +745,506 @@ def get_3DBM_features(cursor, table, lod):
     )
     return
 
+def get_feature_registry(table, buffer_size, neighbour_distances, block_features, fused_extraction, footprint_engine, n_processes=1):
+    """
+    Get the features extracted after the building function and footprint, in the order of main(),
+    with for every feature the columns it needs (inputs) and the columns it adds (outputs), see feature_scheduler.py.
+    Every function is called with a cursor and the table to store the features in.
+    Parameters:
+    table -- table of the case study
+    buffer_size -- buffer size of the footprints for the adjacency features
+    neighbour_distances -- list of distances to neighbouring building centroids
+    block_features -- whether to include the building block size and position in row
+    fused_extraction -- whether the 2D features are already in the table, see create_fused_table()
+    footprint_engine -- 'postgis' or 'shapely', see get_footprint_metrics()
+    n_processes -- number of processes of the shapely footprint engine (optional)
+    Returns: list of dictionaries with name, function, inputs and outputs,
+    features with side_table False only write their own tables and run on the table itself
+    """
+
+    lod_outputs = ['actual_volume', 'convex_hull_volume', 'footprint_perimeter', 'obb_width', 'obb_length',
+                   'ground_area', 'wall_area', 'roof_area', 'ground_point_count', 'height_max', 'height_min_roof',
+                   'shared_walls_area', 'closest_distance']
+    graph = f'{table}_adjacency'
+
+    features = [
+        {'name': 'adjacency', 'function': lambda cursor, t: compute_adjacency(cursor, t, [buffer_size]),
+         'inputs': ['footprint_geom'], 'outputs': ['adjacency'], 'side_table': False},
+        {'name': 'adjacent', 'function': lambda cursor, t: get_num_adjacent_bldg(cursor, t, buffer_size, graph=graph),
+         'inputs': ['adjacency', 'bag_function', 'footprint_geom'], 'outputs': ['no_adjacent_bldg']},
+        {'name': 'adjacent_of_adjacent', 'function': lambda cursor, t: get_num_adjacent_bldg_of_adjacent_bldg(cursor, t, buffer_size, graph=graph),
+         'inputs': ['adjacency', 'no_adjacent_bldg', 'footprint_geom'], 'outputs': ['no_adjacent_of_adja_bldg']}]
+
+    if block_features:
+        features.append({'name': 'blocks', 'function': lambda cursor, t: get_block_features(cursor, t, buffer_size, graph=graph),
+                         'inputs': ['adjacency', 'bag_function', 'footprint_geom'], 'outputs': ['block_size', 'row_position']})
+
+    features.append({'name': 'neighbours', 'function': lambda cursor, t: get_num_neighbours(cursor, t, neighbour_distances),
+                     'inputs': ['footprint_geom'], 'outputs': [f'no_neighbours_{dist}m' for dist in neighbour_distances]})
+
+    if not fused_extraction:
+        features += [
+            {'name': 'constructionyear', 'function': get_constructionyear, 'inputs': [], 'outputs': ['bag_construction_year']},
+            {'name': 'dwellings', 'function': get_num_dwellings, 'inputs': [], 'outputs': ['bag_no_dwellings']}]
+
+        if footprint_engine == 'shapely':
+            features.append({'name': 'footprint_metrics', 'function': lambda cursor, t: get_footprint_metrics(cursor, t, n_processes),
+                             'inputs': ['footprint_geom'], 'outputs': footprint_metrics.FEATURES})
+        else:
+            features += [
+                {'name': 'fp_area', 'function': get_fp_area, 'inputs': ['footprint_geom'], 'outputs': ['fp_area']},
+                {'name': 'fp_perimeter', 'function': get_fp_perimeter, 'inputs': ['footprint_geom'], 'outputs': ['fp_perimeter']},
+                {'name': 'vertices', 'function': get_num_vertices, 'inputs': ['footprint_geom'], 'outputs': ['fp_no_vertices', 'fp_no_vertices_simple']},
+                {'name': 'length_width', 'function': get_bldg_length_width, 'inputs': ['footprint_geom'], 'outputs': ['fp_length', 'fp_width']}]
+
+    for lod in ['lod1', 'lod2']:
+        features.append({'name': f'3dbm_{lod}', 'function': lambda cursor, t, lod=lod: get_3DBM_features(cursor, table, lod, target=t),
+                         'inputs': [], 'outputs': [f'{output}_{lod}' for output in lod_outputs]})
+
+    if table == 'c1_rh':
+        features.append({'name': 'storeys', 'function': get_num_storeys, 'inputs': [], 'outputs': ['no_storeys']})
+
+    return features
+
+#partitioned extraction
+def get_partition_extents(path_3DBAG):
+    """
+    Get the extents of the 3D BAG tiles of the case study, used as partitions of the feature extraction.
+    Returns: list of [minx, miny, maxx, maxy]
+    """
+
+    return [cityjson_reader.get_extent(tile) for tile in tile_functions.get_tiles(path_3DBAG)]
+
+def create_partitions(cursor, table, extents, halo):
+    """
+    Assign the buildings of training_data.{table} to partitions and store them in training_data.{table}_partition (bag_id, partition, core).
+    Every building is the core of the partition whose extent is nearest to its footprint centroid (the tile containing it),
+    buildings without footprint are part of the first partition. A partition also contains as halo the buildings
+    whose footprint intersects the extent of its core footprints expanded by halo m.
+    Parameters:
+    cursor -- cursor for database connection
+    table -- table of the case study
+    extents -- list of [minx, miny, maxx, maxy] of the partitions, see get_partition_extents()
+    halo -- size of the halo (meters)
+    Returns: list of the partitions with core buildings
+    """
+
+    print(f'\n>> Dataset {table} -- assigning buildings to {len(extents)} partitions with a halo of {halo}m')
+
+    cursor.execute(f'''
+        DROP TABLE IF EXISTS training_data.{table}_partition_fp;
+        CREATE UNLOGGED TABLE training_data.{table}_partition_fp AS
+        SELECT t.bag_id, pand.footprint_geom, ST_Centroid(pand.footprint_geom) AS footprint_centroid
+        FROM training_data.{table} AS t
+        LEFT JOIN LATERAL
+            (SELECT wkb_geometry AS footprint_geom
+            FROM input_data.pand WHERE identificatie = t.bag_id LIMIT 1) AS pand ON true;
+
+        CREATE INDEX {table}_partition_fp_idx ON training_data.{table}_partition_fp USING GIST (footprint_geom);
+        '''
+    )
+
+    cursor.execute(f"SELECT ST_SRID(footprint_geom) FROM training_data.{table}_partition_fp WHERE footprint_geom IS NOT NULL LIMIT 1;")
+    srid = (cursor.fetchone() or (0,))[0]
+    values = ', '.join(f'({i}, ST_MakeEnvelope({minx}, {miny}, {maxx}, {maxy}, {srid}))' for i, (minx, miny, maxx, maxy) in enumerate(extents))
+
+    cursor.execute(f'''
+        DROP TABLE IF EXISTS training_data.{table}_partition_tiles;
+        CREATE UNLOGGED TABLE training_data.{table}_partition_tiles (partition INTEGER, extent GEOMETRY);
+        INSERT INTO training_data.{table}_partition_tiles VALUES {values};
+        CREATE INDEX {table}_partition_tiles_idx ON training_data.{table}_partition_tiles USING GIST (extent);
+        '''
+    )
+
+    #core buildings, the nearest tile of a centroid inside a tile is the tile itself
+    cursor.execute(f'''
+        DROP TABLE IF EXISTS training_data.{table}_partition;
+        CREATE TABLE training_data.{table}_partition AS
+        SELECT f.bag_id, COALESCE(nearest.partition, 0) AS partition, true AS core
+        FROM training_data.{table}_partition_fp AS f
+        LEFT JOIN LATERAL
+            (SELECT partition FROM training_data.{table}_partition_tiles AS tiles
+            WHERE f.footprint_centroid IS NOT NULL
+            ORDER BY tiles.extent <-> f.footprint_centroid LIMIT 1) AS nearest ON true;
+        '''
+    )
+
+    #halo buildings
+    cursor.execute(f'''
+        INSERT INTO training_data.{table}_partition (bag_id, partition, core)
+        SELECT f.bag_id, e.partition, false
+        FROM
+            (SELECT a.partition, ST_SetSRID(ST_Expand(ST_Extent(f.footprint_geom), {halo})::GEOMETRY, {srid}) AS extent
+            FROM training_data.{table}_partition AS a
+            JOIN training_data.{table}_partition_fp AS f ON f.bag_id = a.bag_id
+            WHERE f.footprint_geom IS NOT NULL
+            GROUP BY a.partition) AS e
+        JOIN training_data.{table}_partition_fp AS f
+        ON f.footprint_geom && e.extent
+        JOIN training_data.{table}_partition AS a
+        ON a.bag_id = f.bag_id AND a.partition != e.partition;
+
+        CREATE INDEX {table}_partition_idx ON training_data.{table}_partition (partition, bag_id);
+        DROP TABLE training_data.{table}_partition_fp;
+        DROP TABLE training_data.{table}_partition_tiles;
+        '''
+    )
+
+    cursor.execute(f"SELECT DISTINCT partition FROM training_data.{table}_partition WHERE core ORDER BY partition;")
+    return [partition for (partition,) in cursor.fetchall()]
+
+def get_footprint_features(cursor, table, buffer_size, neighbour_distances, block_features, fused_extraction, footprint_engine):
+    """
+    Create training_data.{table}_tmp with the features that only need the footprints and the BAG, for all buildings of training_data.{table}:
+    building function, footprint, adjacency, neighbours and the 2D features, in the column order of main().
+    The footprint features are computed with footprint_engine 'postgis' or 'shapely' (see get_footprint_metrics()), in the process itself.
+    """
+
+    if fused_extraction:
+        create_fused_table(cursor, table, neighbour_distances)
+    else:
+        db_functions.create_temp_table(cursor, table, pkey='bag_id')
+        get_buildingfunction(cursor, table)
+        get_footprint(cursor, table)
+
+    compute_adjacency(cursor, table, [buffer_size])
+    get_num_adjacent_bldg(cursor, table, buffer_size)
+    get_num_adjacent_bldg_of_adjacent_bldg(cursor, table, buffer_size)
+    if block_features:
+        get_block_features(cursor, table, buffer_size)
+    get_num_neighbours(cursor, table, neighbour_distances)
+
+    if not fused_extraction:
+        get_constructionyear(cursor, table)
+        get_num_dwellings(cursor, table)
+        if footprint_engine == 'shapely':
+            get_footprint_metrics(cursor, table)
+        else:
+            get_fp_area(cursor,table)
+            get_fp_perimeter(cursor,table)
+            get_num_vertices(cursor,table)
+            get_bldg_length_width(cursor, table)
+    return
+
+def extract_partition(args):
+    """
+    Get the footprint features of one partition (core and halo buildings) in training_data.{table}_p{partition}_tmp,
+    on a connection of the pool of the process, see get_footprint_features().
+    Returns: partition and the statements recorded by sql_profiler in the process
+    """
+
+    table, partition, buffer_size, neighbour_distances, block_features, fused_extraction, footprint_engine = args
+    part = f'{table}_p{partition}'
+    n_records = len(sql_profiler.RECORDS)
+
+    with db_functions.session() as cursor:
+        cursor.execute(f'''
+            DROP TABLE IF EXISTS training_data.{part};
+            CREATE UNLOGGED TABLE training_data.{part} AS
+            SELECT t.* FROM training_data.{table} AS t
+            JOIN training_data.{table}_partition AS a
+            ON a.bag_id = t.bag_id AND a.partition = {partition};
+            '''
+        )
+
+        get_footprint_features(cursor, part, buffer_size, neighbour_distances, block_features, fused_extraction, footprint_engine)
+
+        cursor.execute(f"DROP TABLE training_data.{part};")
+    return partition, sql_profiler.RECORDS[n_records:]
+
+def merge_partitions(cursor, table, partitions, buffer_size):
+    """
+    Merge the core buildings of the partitions into training_data.{table}_tmp and their edges into the adjacency graph training_data.{table}_adjacency,
+    and drop the tables of the partitions.
+    """
+
+    print(f'\n>> Dataset {table} -- merging {len(partitions)} partitions')
+
+    cursor.execute(f'''
+        DROP TABLE IF EXISTS training_data.{table}_tmp;
+        CREATE UNLOGGED TABLE training_data.{table}_tmp AS
+        SELECT * FROM training_data.{table}_p{partitions[0]}_tmp WITH NO DATA;
+
+        CREATE TABLE IF NOT EXISTS training_data.{table}_adjacency
+        (bag_id VARCHAR, adjacent_id VARCHAR, buffer_size DOUBLE PRECISION);
+        DELETE FROM training_data.{table}_adjacency WHERE buffer_size = {buffer_size};
+        '''
+    )
+
+    for partition in partitions:
+        part = f'{table}_p{partition}'
+        cursor.execute(f'''
+            INSERT INTO training_data.{table}_tmp
+            SELECT p.* FROM training_data.{part}_tmp AS p
+            JOIN training_data.{table}_partition AS a
+            ON a.bag_id = p.bag_id AND a.partition = {partition} AND a.core;
+
+            INSERT INTO training_data.{table}_adjacency
+            SELECT e.bag_id, e.adjacent_id, e.buffer_size FROM training_data.{part}_adjacency AS e
+            JOIN training_data.{table}_partition AS a
+            ON a.bag_id = e.bag_id AND a.partition = {partition} AND a.core;
+
+            DROP TABLE training_data.{part}_tmp;
+            DROP TABLE training_data.{part}_adjacency;
+            '''
+        )
+
+    cursor.execute(f'''
+        ALTER TABLE training_data.{table}_tmp ADD PRIMARY KEY (bag_id);
+        CREATE INDEX IF NOT EXISTS {table}_footprint_idx_tmp ON training_data.{table}_tmp USING GIST (footprint_geom);
+        CREATE INDEX IF NOT EXISTS {table}_adjacency_idx ON training_data.{table}_adjacency (buffer_size, bag_id);
+        DROP TABLE training_data.{table}_partition;
+        '''
+    )
+    return
+
+def extract_partitioned(cursor, table, extents, halo, n_processes, buffer_size, neighbour_distances, block_features, fused_extraction, footprint_engine):
+    """
+    Get the footprint features (see get_footprint_features()) per partition in n_processes parallel processes
+    and merge them into training_data.{table}_tmp. The adjacency and neighbour features of the core buildings of a partition
+    are the same as without partitions as long as the halo is larger than the largest neighbour distance plus the size of the buildings,
+    the building blocks are the same when they do not extend further than the halo outside of the partition.
+    Parameters:
+    cursor -- cursor for database connection
+    table -- table of the case study
+    extents -- list of [minx, miny, maxx, maxy] of the partitions, see get_partition_extents()
+    halo -- size of the halo (meters)
+    n_processes -- number of processes
+    buffer_size, neighbour_distances, block_features, fused_extraction, footprint_engine -- see get_footprint_features()
+    Returns: none
+    """
+
+    partitions = create_partitions(cursor, table, extents, halo)
+
+    print(f'\n>> Dataset {table} -- extracting features of {len(partitions)} partitions with {n_processes} processes')
+
+    args = [(table, partition, buffer_size, neighbour_distances, block_features, fused_extraction, footprint_engine) for partition in partitions]
+    with Pool(n_processes) as pool:
+        for i, (partition, records) in enumerate(pool.imap_unordered(extract_partition, args)):
+            sql_profiler.RECORDS.extend(records)
+            print(f'\n>> Dataset {table} -- partition {partition} done ({i + 1}/{len(partitions)})')
+
+    merge_partitions(cursor, table, partitions, buffer_size)
+    return
+
+#incremental extraction
+def get_snapshot_query(table):
+    """
+    Get the query of the snapshot of the BAG for the buildings of training_data.{table}_base:
+    per building a hash of its pand, a hash of its verblijfsobjecten and its footprint.
+    """
+
+    return f'''
+        SELECT b.bag_id, pand.pand_hash, vbo.vbo_hash, pand.footprint_geom
+        FROM training_data.{table}_base AS b
+        LEFT JOIN LATERAL
+            (SELECT md5(ROW(wkb_geometry, oorspronkelijkbouwjaar, status, eindgeldigheid)::TEXT) AS pand_hash, wkb_geometry AS footprint_geom
+            FROM input_data.pand WHERE identificatie = b.bag_id LIMIT 1) AS pand ON true
+        LEFT JOIN
+            (SELECT pandid, md5(string_agg(ROW(identificatie, status, eindgeldigheid, gebruiksdoel)::TEXT, ',' ORDER BY identificatie)) AS vbo_hash
+            FROM input_data.verblijfsobject, unnest(pandref) AS pandid
+            GROUP BY pandid) AS vbo
+        ON vbo.pandid = b.bag_id
+        '''
+
+def save_base(cursor, table):
+    """
+    Keep a copy of the buildings and labels of training_data.{table} before the first extraction as training_data.{table}_base,
+    the buildings an incremental extraction starts from.
+    """
+
+    cursor.execute(f"CREATE TABLE IF NOT EXISTS training_data.{table}_base AS TABLE training_data.{table};")
+    return
+
+def save_snapshot(cursor, table):
+    """
+    Store the snapshot of the BAG used by the extraction as training_data.{table}_snapshot, see get_snapshot_query().
+    """
+
+    print(f'\n>> Dataset {table} -- storing snapshot of the BAG for incremental extraction')
+
+    cursor.execute(f'''
+        DROP TABLE IF EXISTS training_data.{table}_snapshot;
+        CREATE TABLE training_data.{table}_snapshot AS {get_snapshot_query(table)};
+        ALTER TABLE training_data.{table}_snapshot ADD PRIMARY KEY (bag_id);
+        '''
+    )
+    return
+
+def update_base(cursor, table, citydbx):
+    """
+    Compare the buildings of the case study (see import_groundtruth.get_selection_query()) with training_data.{table}_base:
+    insert the new buildings into training_data.{table}_base and delete the buildings that are no longer selected.
+    get_affected_buildings() then treats both as changed, so they are inserted into or deleted from training_data.{table}.
+    Parameters:
+    cursor -- cursor for database connection
+    table -- table of the case study
+    citydbx -- 3D City DB schema of the case study
+    Returns: number of inserted and number of deleted buildings
+    """
+
+    print(f'\n>> Dataset {table} -- comparing the buildings of {citydbx} with training_data.{table}_base')
+
+    cursor.execute(f'''
+        DROP TABLE IF EXISTS {table}_selection;
+        CREATE TEMPORARY TABLE {table}_selection AS {import_groundtruth.get_selection_query(table, citydbx)};
+
+        INSERT INTO training_data.{table}_base (bag_id, building_type)
+        SELECT DISTINCT ON (s.bag_id) s.bag_id, s.building_type FROM {table}_selection AS s
+        WHERE NOT EXISTS (SELECT 1 FROM training_data.{table}_base AS b WHERE b.bag_id = s.bag_id);
+        '''
+    )
+    n_inserted = cursor.rowcount
+
+    cursor.execute(f'''
+        DELETE FROM training_data.{table}_base AS b
+        WHERE NOT EXISTS (SELECT 1 FROM {table}_selection AS s WHERE s.bag_id = b.bag_id);
+        '''
+    )
+    n_deleted = cursor.rowcount
+
+    cursor.execute(f"DROP TABLE {table}_selection;")
+    return n_inserted, n_deleted
+
+def has_snapshot(cursor, table):
+    cursor.execute(f"SELECT to_regclass('training_data.{table}_snapshot') IS NOT NULL AND to_regclass('training_data.{table}_base') IS NOT NULL;")
+    return cursor.fetchone()[0]
+
+def get_affected_buildings(cursor, table, max_distance):
+    """
+    Compare the BAG with the snapshot of the previous extraction and store the buildings whose pand or verblijfsobjecten changed,
+    that were added to or removed from training_data.{table}_base (see update_base()),
+    plus the buildings within max_distance m of their old or new footprint, in training_data.{table}_affected.
+    The new snapshot is stored in training_data.{table}_snapshot_new.
+    Returns: number of changed and number of affected buildings
+    """
+
+    print(f'\n>> Dataset {table} -- comparing the BAG with the snapshot of the previous extraction')
+
+    cursor.execute(f'''
+        DROP TABLE IF EXISTS training_data.{table}_snapshot_new;
+        CREATE TABLE training_data.{table}_snapshot_new AS {get_snapshot_query(table)};
+        ALTER TABLE training_data.{table}_snapshot_new ADD PRIMARY KEY (bag_id);
+        CREATE INDEX {table}_snapshot_new_idx ON training_data.{table}_snapshot_new USING GIST (footprint_geom);
+
+        DROP TABLE IF EXISTS {table}_changed;
+        CREATE TEMPORARY TABLE {table}_changed AS
+        SELECT COALESCE(n.bag_id, o.bag_id) AS bag_id, n.footprint_geom, o.footprint_geom AS old_footprint_geom
+        FROM training_data.{table}_snapshot_new AS n
+        FULL JOIN training_data.{table}_snapshot AS o ON o.bag_id = n.bag_id
+        WHERE o.bag_id IS NULL OR n.bag_id IS NULL
+        OR n.pand_hash IS DISTINCT FROM o.pand_hash
+        OR n.vbo_hash IS DISTINCT FROM o.vbo_hash;
+        '''
+    )
+
+    cursor.execute(f'''
+        DROP TABLE IF EXISTS training_data.{table}_affected;
+        CREATE TABLE training_data.{table}_affected AS
+        SELECT bag_id FROM {table}_changed
+        UNION
+        SELECT n.bag_id
+        FROM {table}_changed AS c
+        JOIN training_data.{table}_snapshot_new AS n
+        ON ST_DWithin(n.footprint_geom, c.footprint_geom, {max_distance})
+        OR ST_DWithin(n.footprint_geom, c.old_footprint_geom, {max_distance});
+        '''
+    )
+
+    cursor.execute(f"SELECT (SELECT COUNT(*) FROM {table}_changed), (SELECT COUNT(*) FROM training_data.{table}_affected);")
+    n_changed, n_affected = cursor.fetchone()
+    cursor.execute(f"DROP TABLE {table}_changed;")
+    return n_changed, n_affected
+
+def extract_incremental(cursor, table, citydbx, halo, buffer_size, neighbour_distances, block_features, fused_extraction, footprint_engine):
+    """
+    Recompute the features of the buildings affected by changes in the BAG or in the buildings of the case study since the previous extraction
+    (see update_base() and get_affected_buildings()) and upsert them into training_data.{table}. The affected buildings are extracted like a partition (see extract_partition())
+    with the buildings within halo m as halo, so their adjacency and neighbour features are correct.
+    Parameters:
+    cursor -- cursor for database connection
+    table -- table of the case study
+    citydbx -- 3D City DB schema of the case study
+    halo -- size of the halo (meters)
+    buffer_size, neighbour_distances, block_features, fused_extraction, footprint_engine -- see get_footprint_features()
+    Returns: none
+    """
+
+    n_inserted, n_deleted = update_base(cursor, table, citydbx)
+    print(f'\n>> Dataset {table} -- {n_inserted} buildings added to and {n_deleted} buildings removed from the case study')
+
+    n_changed, n_affected = get_affected_buildings(cursor, table, max(neighbour_distances))
+    print(f'\n>> Dataset {table} -- {n_changed} buildings changed, recomputing {n_affected} buildings')
+
+    if n_affected > 0:
+        base = f'{table}_base'
+        part = f'{base}_p0'
+
+        #the affected buildings are the core of a single partition
+        cursor.execute(f'''
+            DROP TABLE IF EXISTS training_data.{base}_partition;
+            CREATE TABLE training_data.{base}_partition AS
+            SELECT bag_id, 0 AS partition, true AS core FROM training_data.{table}_affected;
+
+            INSERT INTO training_data.{base}_partition (bag_id, partition, core)
+            SELECT DISTINCT n.bag_id, 0, false
+            FROM training_data.{table}_affected AS a
+            JOIN training_data.{table}_snapshot_new AS m ON m.bag_id = a.bag_id
+            JOIN training_data.{table}_snapshot_new AS n ON ST_DWithin(n.footprint_geom, m.footprint_geom, {halo})
+            WHERE n.bag_id NOT IN (SELECT bag_id FROM training_data.{table}_affected);
+            '''
+        )
+
+        extract_partition((base, 0, buffer_size, neighbour_distances, block_features, fused_extraction, footprint_engine))
+
+        #same steps as main() after the footprint features
+        cursor.execute(f"DELETE FROM training_data.{part}_tmp WHERE bag_function != 'Residential' AND bag_function != 'Mixed-residential';")
+        get_3DBM_features(cursor, table, 'lod1', target=part)
+        get_3DBM_features(cursor, table, 'lod2', target=part)
+        if table == 'c1_rh':
+            get_num_storeys(cursor, part)
+        remove_redundant_features(cursor, part)
+        remove_null_values(cursor, part)
+
+        print(f'\n>> Dataset {table} -- upserting {n_affected} buildings into training_data.{table}')
+        db_functions.invalidate_training_cache(table)
+
+        cursor.execute(f'''
+            SELECT column_name FROM information_schema.columns
+            WHERE table_schema = 'training_data' AND table_name = '{table}'
+            ORDER BY ordinal_position;
+            '''
+        )
+        columns = ', '.join(f'"{column}"' for (column,) in cursor.fetchall())
+
+        #affected buildings that are no longer residential or no longer in the case study are only deleted
+        cursor.execute(f'''
+            DELETE FROM training_data.{table} WHERE bag_id IN (SELECT bag_id FROM training_data.{table}_affected);
+            INSERT INTO training_data.{table} ({columns})
+            SELECT {columns} FROM training_data.{part}_tmp
+            WHERE bag_id IN (SELECT bag_id FROM training_data.{table}_affected);
+
+            DELETE FROM training_data.{table}_adjacency
+            WHERE buffer_size = {buffer_size} AND bag_id IN (SELECT bag_id FROM training_data.{table}_affected);
+            INSERT INTO training_data.{table}_adjacency
+            SELECT bag_id, adjacent_id, buffer_size FROM training_data.{part}_adjacency
+            WHERE bag_id IN (SELECT bag_id FROM training_data.{table}_affected);
+
+            DROP TABLE training_data.{part}_tmp;
+            DROP TABLE training_data.{part}_adjacency;
+            DROP TABLE training_data.{base}_partition;
+            '''
+        )
+
+    cursor.execute(f'''
+        DROP TABLE training_data.{table}_affected;
+        DROP TABLE training_data.{table}_snapshot;
+        DROP INDEX training_data.{table}_snapshot_new_idx;
+        ALTER TABLE training_data.{table}_snapshot_new RENAME TO {table}_snapshot;
+        '''
+    )
+    return
+
 #data cleaning
 def remove_redundant_features(cursor, table):
 
@@ -587,63 +1328,124 @@ def main():
         params = json.load(f)
         
         table = params['table']
+        citydbx = params['citydbx']
         buffer_size = params['buffer_size']
-
-    #get db parameters
-    user,password,database,host,port = db_functions.get_db_parameters()
-
-    #create connection to db with the db parameters
-    conn = db_functions.setup_connection(user,password,database,host,port)
-    conn.autocommit = True
-
-    #create a cursor
-    cursor = conn.cursor()
-
-    #create temporary table to store extracted features in
-    db_functions.create_temp_table(cursor, table, pkey='bag_id')
-
-    #get building function
-    get_buildingfunction(cursor, table)
-
-    #needed for other features
-    get_footprint(cursor, table)
-
-    #get adjacent number of buildings (before removing non-residential)
-    get_num_adjacent_bldg(cursor, table, buffer_size)
-    get_num_adjacent_bldg_of_adjacent_bldg(cursor, table)
-    get_num_neighbours(cursor, table, [25, 50, 75, 100])
-
-    #remove any rows where function is not residential/mixed-residential
-    print(f'\n>> Dataset {table} -- removing non-residential buildings')
-    cursor.execute(f"DELETE FROM training_data.{table}_tmp WHERE bag_function != 'Residential' AND bag_function != 'Mixed-residential';")
-
-    #get 2D features
-    get_constructionyear(cursor, table)
-    get_num_dwellings(cursor, table)
-    get_fp_area(cursor,table)
-    get_fp_perimeter(cursor,table)
-    get_num_vertices(cursor,table)
-    get_bldg_length_width(cursor, table)
-    # get_rooftype(cursor, table)
-
-    #get 3D features
-    lod1 = 'lod1'
-    lod2 = 'lod2'
-    get_3DBM_features(cursor, table, lod1)
-    get_3DBM_features(cursor, table, lod2)
-
-    if table == 'c1_rh':
-        get_num_storeys(cursor, table)
-
-    #Clean data
-    remove_redundant_features(cursor, table)
-    remove_null_values(cursor, table)
-
-    #Replace original table with the temporary table containing the feature candidates
-    db_functions.replace_temp_table(cursor, table)
-
-    #close db connection
-    db_functions.close_connection(conn, cursor)
+        fused_extraction = params['fused_extraction']
+        footprint_engine = params['footprint_engine']
+        block_features = params['block_features']
+        n_connections = params['n_connections']
+        partition_extraction = params['partition_extraction']
+        partition_halo = params['partition_halo']
+        n_processes = params['n_processes']
+        path_3DBAG = params['path_3DBAG']
+        incremental_extraction = params['incremental_extraction']
+        refresh_vbo_aggregate = params['refresh_vbo_aggregate']
+        profile_sql = params['profile_sql']
+        explain_analyze = params['explain_analyze']
+        swap_temp_table = params['swap_temp_table']
+
+    if profile_sql:
+        sql_profiler.enable(explain_analyze)
+
+    with db_functions.session() as cursor:
+        neighbour_distances = [25, 50, 75, 100]
+
+        #uses and number of dwellings per pand, read by the building function and number of dwellings
+        db_functions.create_vbo_aggregate(cursor, refresh_vbo_aggregate)
+
+        if incremental_extraction:
+            if has_snapshot(cursor, table):
+                #only recompute the buildings affected by changes in the BAG since the previous extraction
+                extract_incremental(cursor, table, citydbx, partition_halo, buffer_size, neighbour_distances, block_features, fused_extraction, footprint_engine)
+                sql_profiler.write_profile(f'{table}_extract_features')
+                return
+
+            #first run: full extraction, keep the buildings and a snapshot of the BAG for the next runs
+            save_base(cursor, table)
+
+        if partition_extraction:
+            #get the footprint features per 3D BAG tile in parallel processes
+            extents = get_partition_extents(path_3DBAG)
+            extract_partitioned(cursor, table, extents, partition_halo, n_processes, buffer_size, neighbour_distances, block_features, fused_extraction, footprint_engine)
+
+            #remove any rows where function is not residential/mixed-residential
+            print(f'\n>> Dataset {table} -- removing non-residential buildings')
+            cursor.execute(f"DELETE FROM training_data.{table}_tmp WHERE bag_function != 'Residential' AND bag_function != 'Mixed-residential';")
+
+            #get 3D features
+            get_3DBM_features(cursor, table, 'lod1')
+            get_3DBM_features(cursor, table, 'lod2')
+
+            if table == 'c1_rh':
+                get_num_storeys(cursor, table)
+        else:
+            if fused_extraction:
+                #create temporary table with building function, footprint and the other 2D features in one pass
+                create_fused_table(cursor, table, neighbour_distances)
+            else:
+                #create temporary table to store extracted features in
+                db_functions.create_temp_table(cursor, table, pkey='bag_id')
+
+                #get building function
+                get_buildingfunction(cursor, table)
+
+                #needed for other features
+                get_footprint(cursor, table)
+
+            if n_connections > 1:
+                #get the other features concurrently in side tables, see feature_scheduler.py
+                features = get_feature_registry(table, buffer_size, neighbour_distances, block_features, fused_extraction, footprint_engine, n_processes)
+                feature_scheduler.run_features(cursor, table, features, n_connections)
+
+                #remove any rows where function is not residential/mixed-residential
+                print(f'\n>> Dataset {table} -- removing non-residential buildings')
+                cursor.execute(f"DELETE FROM training_data.{table}_tmp WHERE bag_function != 'Residential' AND bag_function != 'Mixed-residential';")
+            else:
+                #get adjacent number of buildings from the adjacency graph (before removing non-residential)
+                compute_adjacency(cursor, table, [buffer_size])
+                get_num_adjacent_bldg(cursor, table, buffer_size)
+                get_num_adjacent_bldg_of_adjacent_bldg(cursor, table, buffer_size)
+                if block_features:
+                    get_block_features(cursor, table, buffer_size)
+                get_num_neighbours(cursor, table, neighbour_distances)
+
+                #remove any rows where function is not residential/mixed-residential
+                print(f'\n>> Dataset {table} -- removing non-residential buildings')
+                cursor.execute(f"DELETE FROM training_data.{table}_tmp WHERE bag_function != 'Residential' AND bag_function != 'Mixed-residential';")
+
+                #get 2D features (already in the table with fused_extraction)
+                if not fused_extraction:
+                    get_constructionyear(cursor, table)
+                    get_num_dwellings(cursor, table)
+                    if footprint_engine == 'shapely':
+                        get_footprint_metrics(cursor, table, n_processes)
+                    else:
+                        get_fp_area(cursor,table)
+                        get_fp_perimeter(cursor,table)
+                        get_num_vertices(cursor,table)
+                        get_bldg_length_width(cursor, table)
+                    # get_rooftype(cursor, table)
+
+                #get 3D features
+                lod1 = 'lod1'
+                lod2 = 'lod2'
+                get_3DBM_features(cursor, table, lod1)
+                get_3DBM_features(cursor, table, lod2)
+
+                if table == 'c1_rh':
+                    get_num_storeys(cursor, table)
+
+        #Clean data
+        remove_redundant_features(cursor, table)
+        remove_null_values(cursor, table)
+
+        #Replace original table with the temporary table containing the feature candidates
+        db_functions.replace_temp_table(cursor, table, swap=swap_temp_table)
+
+        if incremental_extraction:
+            save_snapshot(cursor, table)
+
+    sql_profiler.write_profile(f'{table}_extract_features')
     return
 
 if __name__ == '__main__':
@@ -0,0 +1,149 @@
+'''
+Dependency-aware scheduler to extract independent features concurrently.
+Every feature of the registry (see extract_features.get_feature_registry())
+states the columns it needs and the columns it adds. A feature is started as
+soon as all its inputs are available, on a connection of the pool of
+db_functions, and writes into its own side table with a copy of its inputs:
+training_data.<table>_<feature>_tmp. At the end, the side tables are joined
+into training_data.<table>_tmp, so the wall-clock time follows the longest
+chain of dependencies instead of the sum of all features.
+'''
+
+import db_functions
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+from time import time
+
+def get_side_table(table, feature):
+    return f"{table}_{feature['name']}"
+
+def create_side_table(cursor, table, feature, producers):
+    """
+    Create the side table of a feature with bag_id and the input columns, from the table or from the side tables of other features.
+    Parameters:
+    cursor -- cursor for database connection
+    table -- table of the case study
+    feature -- feature of the registry
+    producers -- dictionary with output as key and the feature producing it as value
+    """
+
+    side = get_side_table(table, feature)
+    columns = ['t.bag_id']
+    joins = {}
+    for column in feature['inputs']:
+        if column not in producers:
+            columns.append(f't."{column}"')
+        elif producers[column].get('side_table', True):
+            producer = get_side_table(table, producers[column])
+            joins[producer] = f'p{len(joins)}'
+            columns.append(f'{joins[producer]}."{column}"')
+
+    join = ''.join(f' LEFT JOIN training_data.{producer}_tmp AS {alias} ON {alias}.bag_id = t.bag_id' for producer, alias in joins.items())
+
+    cursor.execute(f"DROP TABLE IF EXISTS training_data.{side}_tmp;")
+    cursor.execute(f"CREATE UNLOGGED TABLE training_data.{side}_tmp AS SELECT {', '.join(columns)} FROM training_data.{table}_tmp AS t{join};")
+    cursor.execute(f"ALTER TABLE training_data.{side}_tmp ADD PRIMARY KEY (bag_id);")
+
+    if 'footprint_geom' in feature['inputs']:
+        cursor.execute(f"CREATE INDEX IF NOT EXISTS {side}_footprint_idx_tmp ON training_data.{side}_tmp USING GIST (footprint_geom);")
+    return
+
+def run_feature(table, feature, producers):
+    """
+    Run a feature on a connection of the pool (see db_functions.session()), in its side table unless side_table is False.
+    """
+
+    with db_functions.session() as cursor:
+        start = time()
+
+        if feature.get('side_table', True):
+            create_side_table(cursor, table, feature, producers)
+            feature['function'](cursor, get_side_table(table, feature))
+        else:
+            feature['function'](cursor, table)
+
+        print(f"\n>> Dataset {table} -- feature {feature['name']} done in {time() - start:.1f}s")
+    return
+
+def join_side_tables(cursor, table, features):
+    """
+    Join the outputs of the side tables into training_data.{table}_tmp in one pass and drop the side tables.
+    Outputs that are already columns of the table (e.g. created empty by extract_features.create_fused_table()) keep their position,
+    the other outputs are added in the order of the features.
+    """
+
+    side_features = [feature for feature in features if feature.get('side_table', True)]
+
+    print(f'\n>> Dataset {table} -- joining the features of {len(side_features)} side tables')
+    outputs = {output: f's{i}' for i, feature in enumerate(side_features) for output in feature['outputs']}
+
+    cursor.execute(f'''
+        SELECT column_name FROM information_schema.columns
+        WHERE table_schema = 'training_data' AND table_name = '{table}_tmp'
+        ORDER BY ordinal_position;
+        '''
+    )
+    table_columns = [column for (column,) in cursor.fetchall()]
+
+    columns = [f'{outputs[column]}."{column}"' if column in outputs else f't."{column}"' for column in table_columns]
+    columns += [f'{alias}."{output}"' for output, alias in outputs.items() if output not in table_columns]
+    join = ''.join(f' LEFT JOIN training_data.{get_side_table(table, feature)}_tmp AS s{i} ON s{i}.bag_id = t.bag_id'
+                   for i, feature in enumerate(side_features))
+
+    cursor.execute(f"DROP TABLE IF EXISTS training_data.{table}_joined;")
+    cursor.execute(f"CREATE UNLOGGED TABLE training_data.{table}_joined AS SELECT {', '.join(columns)} FROM training_data.{table}_tmp AS t{join};")
+    cursor.execute(f"DROP TABLE training_data.{table}_tmp;")
+    cursor.execute(f"ALTER TABLE training_data.{table}_joined RENAME TO {table}_tmp;")
+    cursor.execute(f"ALTER TABLE training_data.{table}_tmp ADD PRIMARY KEY (bag_id);")
+
+    if 'footprint_geom' in table_columns:
+        cursor.execute(f"CREATE INDEX IF NOT EXISTS {table}_footprint_idx_tmp ON training_data.{table}_tmp USING GIST (footprint_geom);")
+
+    for feature in side_features:
+        cursor.execute(f"DROP TABLE IF EXISTS training_data.{get_side_table(table, feature)}_tmp;")
+    return
+
+def run_features(cursor, table, features, n_connections):
+    """
+    Run the features concurrently on n_connections connections, each feature as soon as its inputs are available,
+    and join their side tables into training_data.{table}_tmp.
+    Inputs that are not an output of another feature need to be columns of training_data.{table}_tmp already.
+    Parameters:
+    cursor -- cursor for database connection, used to join the side tables
+    table -- table of the case study
+    features -- list of features, see extract_features.get_feature_registry()
+    n_connections -- number of database connections
+    Returns: none
+    """
+
+    producers = {output: feature for feature in features for output in feature['outputs']}
+
+    print(f'\n>> Dataset {table} -- extracting {len(features)} features on {n_connections} connections')
+
+    if n_connections >= db_functions.MAX_CONNECTIONS:
+        raise ValueError(f'n_connections should be smaller than the size of the connection pool ({db_functions.MAX_CONNECTIONS})')
+
+    start = time()
+    done = set()
+    remaining = list(features)
+    running = {}
+    with ThreadPoolExecutor(n_connections) as executor:
+        while remaining or running:
+            ready = [feature for feature in remaining
+                     if all(column not in producers or producers[column]['name'] in done for column in feature['inputs'])]
+            for feature in ready:
+                remaining.remove(feature)
+                running[executor.submit(run_feature, table, feature, producers)] = feature
+
+            if not running:
+                raise ValueError(f"Features with circular dependencies: {[feature['name'] for feature in remaining]}")
+
+            finished, _ = wait(running, return_when=FIRST_COMPLETED)
+            for future in finished:
+                feature = running.pop(future)
+                future.result()
+                done.add(feature['name'])
+
+    print(f'\n>> Dataset {table} -- extracted {len(features)} features in {time() - start:.1f}s')
+
+    join_side_tables(cursor, table, features)
+    return
@@ -0,0 +1,141 @@
+'''
+Registry of the feature sets used by tune_parameters.py and model_prediction.py.
+The features of a training table are kept as one NumPy matrix, the feature sets
+are column index arrays into it. The source of the feature sets is explicit:
+'project' uses the feature sets of the graduation project (REMOVED), these
+match the provided models; 'scores' keeps all features except the n_removed
+lowest scoring features of results/{table}_score_*.csv, written by select_features.py.
+'''
+
+import numpy as np
+import os
+import pandas as pd
+from sklearn.model_selection import train_test_split
+
+#features removed based on correlation (see analyze_features.py)
+CORRELATED = ['actual_volume_lod1',
+              'convex_hull_volume_lod1',
+              'convex_hull_volume_lod2',
+              'wall_area_lod1',
+              'roof_area_lod1',
+              'height_max_lod1']
+
+#features of a single case study that are not used by the models
+EXCLUDED = {'c1_rh': ['no_storeys']}
+
+#columns that are not features
+LABELS = ['bag_id', 'building_type']
+
+#split of the rows into a train and test set, the same as select_features.split_data()
+TEST_SIZE = 0.20
+RANDOM_STATE = 0
+
+#feature set -> score of select_features.py (results/{table}_score_{score}.csv)
+SCORES = {'anova_f': 'anova_f', 'mi': 'mutual_info', 'impurity': 'rf', 'permutation': 'permutation'}
+
+#features removed per feature set in the graduation project
+REMOVED = {
+    'c1_rh': {
+        'anova_f': ['no_neighbours_25m', 'roof_area_lod2', 'fp_perimeter', 'obb_length_lod1', 'fp_no_vertices', 'height_max_lod2',
+                    'height_min_roof_lod2', 'bag_construction_year', 'no_neighbours_75m', 'no_neighbours_100m', 'fp_area'],
+        'mi': ['fp_perimeter', 'roof_area_lod2', 'obb_length_lod1', 'wall_area_lod2', 'height_max_lod2', 'height_min_roof_lod2',
+               'bag_no_dwellings', 'fp_no_vertices', 'no_neighbours_75m', 'no_neighbours_25m', 'no_neighbours_100m'],
+        'impurity': ['roof_area_lod2', 'wall_area_lod2', 'fp_perimeter', 'obb_length_lod1', 'height_min_roof_lod2', 'no_neighbours_50m',
+                     'fp_no_vertices', 'bag_no_dwellings', 'no_neighbours_75m', 'no_neighbours_100m', 'fp_area'],
+        'permutation': ['no_neighbours_100m', 'actual_volume_lod2', 'fp_perimeter', 'no_neighbours_75m', 'no_neighbours_50m', 'obb_length_lod1',
+                        'fp_no_vertices', 'fp_area', 'height_min_roof_lod2', 'roof_area_lod2', 'height_max_lod2']},
+    'c2_delft': {
+        'anova_f': ['actual_volume_lod2', 'no_adjacent_of_adja_bldg', 'roof_area_lod2', 'height_min_roof_lod2', 'fp_area', 'no_neighbours_50m',
+                    'fp_no_vertices', 'no_neighbours_25m', 'no_neighbours_75m', 'no_neighbours_100m', 'bag_construction_year'],
+        'mi': ['wall_area_lod2', 'height_max_lod2', 'no_adjacent_bldg', 'bag_construction_year', 'no_adjacent_of_adja_bldg', 'height_min_roof_lod2',
+               'fp_no_vertices', 'no_neighbours_25m', 'no_neighbours_50m', 'no_neighbours_100m', 'no_neighbours_75m'],
+        'impurity': ['wall_area_lod2', 'roof_area_lod2', 'fp_perimeter', 'obb_length_lod1', 'height_min_roof_lod2', 'bag_construction_year',
+                     'no_neighbours_100m', 'no_neighbours_75m', 'no_neighbours_50m', 'fp_no_vertices', 'no_neighbours_25m'],
+        'permutation': ['bag_construction_year', 'actual_volume_lod2', 'height_min_roof_lod2', 'height_max_lod2', 'roof_area_lod2', 'no_neighbours_25m',
+                        'no_neighbours_100m', 'no_neighbours_50m', 'fp_no_vertices', 'fp_perimeter', 'no_neighbours_75m']}}
+
+def get_excluded(table):
+    """
+    Get the columns of training_data.{table} that are never used as features, to pass to db_functions.load_training_table().
+    """
+
+    return CORRELATED + EXCLUDED.get(table, [])
+
+def get_removed_features(table, name, n_removed=11, source='project'):
+    """
+    Get the features removed from a feature set.
+    Parameters:
+    table -- table of the case study
+    name -- feature set, see SCORES
+    n_removed -- number of lowest scoring features to remove, for source 'scores' (optional)
+    source -- 'project': the feature sets of the graduation project, 'scores': the score files of select_features.py (optional)
+    Returns: list of feature names
+    """
+
+    if source == 'project':
+        if name not in REMOVED.get(table, {}):
+            raise ValueError(f"No feature set {name} of the graduation project for {table}, use feature set source 'scores'")
+        return REMOVED[table][name]
+
+    if source == 'scores':
+        path = f'results/{table}_score_{SCORES[name]}.csv'
+        if not os.path.exists(path):
+            raise ValueError(f'No scores for feature set {name} of {table} in {path}, run select_features.py first')
+        scores = pd.read_csv(path)
+        return list(scores.sort_values('score')['name'][:n_removed])
+
+    raise ValueError(f"Unknown feature set source '{source}', use 'project' or 'scores'")
+
+class FeatureRegistry:
+    """
+    The features and labels of a training table as NumPy arrays and the feature sets as column index arrays.
+    The matrix is stored column by column (Fortran order), so taking the columns of a feature set copies contiguous blocks.
+    Parameters:
+    table -- table of the case study
+    data -- DataFrame of the table, see db_functions.load_training_table()
+    n_removed -- number of lowest scoring features removed per feature set, for source 'scores' (optional)
+    source -- source of the feature sets, see get_removed_features() (optional)
+    names -- feature sets to register (optional)
+    """
+
+    def __init__(self, table, data, n_removed=11, source='project', names=tuple(SCORES)):
+        self.table = table
+        excluded = set(get_excluded(table)) | set(LABELS)
+        self.features = [column for column in data.columns if column not in excluded]
+        self.matrix = np.asfortranarray(data[self.features].to_numpy(dtype='float64'))
+        self.labels = data['building_type'].to_numpy()
+        self.bag_ids = data['bag_id'].to_numpy()
+
+        if source == 'scores':
+            print(f'\n>> Dataset {table} -- feature sets without the {n_removed} lowest scoring features of results/{table}_score_*.csv')
+        else:
+            print(f'\n>> Dataset {table} -- feature sets of the graduation project')
+
+        position = {feature: i for i, feature in enumerate(self.features)}
+        self.indices = {}
+        for name in names:
+            removed = set(get_removed_features(table, name, n_removed, source))
+            self.indices[name] = np.array([position[feature] for feature in self.features if feature not in removed])
+
+    def get_columns(self, name):
+        return [self.features[i] for i in self.indices[name]]
+
+    def get_matrix(self, name, rows=None):
+        """
+        Get the columns of a feature set, for the given rows (optional).
+        """
+
+        if rows is None:
+            return self.matrix[:, self.indices[name]]
+        return self.matrix[np.ix_(rows, self.indices[name])]
+
+    def get_frame(self, name, rows=None):
+        return pd.DataFrame(self.get_matrix(name, rows), columns=self.get_columns(name))
+
+    def split(self):
+        """
+        Split the rows into a train and test set, the same split as select_features.split_data() for every feature set.
+        Returns: arrays with the row numbers of the train and test set
+        """
+
+        return train_test_split(np.arange(len(self.labels)), test_size=TEST_SIZE, random_state=RANDOM_STATE, stratify=self.labels)
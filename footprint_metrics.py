@@ -0,0 +1,129 @@
+'''
+Python engine for the 2D footprint features of extract_features.py.
+Computes fp_area, fp_perimeter, fp_no_vertices, fp_no_vertices_simple,
+fp_length and fp_width of a batch of footprints read as WKB, with the
+vectorized functions of Shapely 2 over the whole batch. With Shapely 1.8
+(the version in environment.yml) the same features are computed per footprint.
+The features are the same as the PostGIS functions of extract_features.py:
+ST_Area, ST_Perimeter, ST_NPoints, ST_SimplifyPreserveTopology and the sides
+of ST_OrientedEnvelope.
+
+Run as script to compare fp_length and fp_width with the obb_length and
+obb_width of 3DBM for a CSV with the 3DBM ids and the footprints as WKT,
+e.g. exported with: COPY (SELECT bag_id, ST_AsText(footprint_geom) ...):
+python footprint_metrics.py footprints.csv merged_lod1.csv
+'''
+
+import numpy as np
+import pandas as pd
+import shapely
+import shapely.wkb
+import shapely.wkt
+import sys
+from time import time
+
+SHAPELY2 = int(shapely.__version__.split('.')[0]) >= 2
+FEATURES = ['fp_area', 'fp_perimeter', 'fp_no_vertices', 'fp_no_vertices_simple', 'fp_length', 'fp_width']
+TOLERANCE = 0.1
+CHUNK_SIZE = 10000
+
+def num_coordinates(geom):
+    """
+    Get the number of coordinates of a (multi)polygon like ST_NPoints, for Shapely 1.8.
+    """
+
+    if geom.is_empty:
+        return 0
+    if hasattr(geom, 'geoms'):
+        return sum(num_coordinates(part) for part in geom.geoms)
+    if hasattr(geom, 'exterior'):
+        return len(geom.exterior.coords) + sum(len(ring.coords) for ring in geom.interiors)
+    return len(geom.coords)
+
+def compute_features_loop(wkbs):
+    rows = []
+    for wkb in wkbs:
+        if wkb is None:
+            rows.append([np.nan] * len(FEATURES))
+            continue
+        geom = shapely.wkb.loads(bytes(wkb))
+        rectangle = geom.minimum_rotated_rectangle
+        #an empty footprint gives an empty polygon without coordinates
+        if not rectangle.is_empty and hasattr(rectangle, 'exterior') and len(rectangle.exterior.coords) >= 3:
+            p = np.array(rectangle.exterior.coords[:3])
+            side_1, side_2 = np.hypot(*(p[1] - p[0])), np.hypot(*(p[2] - p[1]))
+        else:
+            side_1, side_2 = np.nan, np.nan
+        rows.append([geom.area, geom.length, num_coordinates(geom),
+                     num_coordinates(geom.simplify(TOLERANCE, preserve_topology=True)),
+                     max(side_1, side_2), min(side_1, side_2)])
+    return pd.DataFrame(rows, columns=FEATURES)
+
+def compute_features(wkbs):
+    """
+    Compute the footprint features of a batch of footprints.
+    Parameters:
+    wkbs -- list of footprints as WKB (None for buildings without footprint)
+    Returns: DataFrame with FEATURES as columns in the order of wkbs, NaN for buildings without footprint
+    """
+
+    if not SHAPELY2:
+        return compute_features_loop(wkbs)
+
+    geoms = shapely.from_wkb(np.array([None if wkb is None else bytes(wkb) for wkb in wkbs], dtype=object))
+    missing = shapely.is_missing(geoms)
+
+    #same sides as get_mbr(): the lengths of two adjacent edges of the oriented envelope
+    ring = shapely.get_exterior_ring(shapely.minimum_rotated_rectangle(geoms))
+    p0, p1, p2 = [shapely.get_point(ring, i) for i in range(3)]
+    side_1 = shapely.distance(p0, p1)
+    side_2 = shapely.distance(p1, p2)
+
+    features = pd.DataFrame({
+        'fp_area': shapely.area(geoms),
+        'fp_perimeter': shapely.length(geoms),
+        'fp_no_vertices': shapely.get_num_coordinates(geoms),
+        'fp_no_vertices_simple': shapely.get_num_coordinates(shapely.simplify(geoms, TOLERANCE, preserve_topology=True)),
+        'fp_length': np.fmax(side_1, side_2),
+        'fp_width': np.fmin(side_1, side_2)})
+    features = features.astype({'fp_no_vertices': float, 'fp_no_vertices_simple': float})
+    features.loc[missing, :] = np.nan
+    return features
+
+def compare_obb(footprints_csv, reference_csv, tolerance=0.1):
+    """
+    Compare fp_length and fp_width with obb_length and obb_width of 3DBM and time the computation.
+    Parameters:
+    footprints_csv -- CSV with columns bag_id and footprint as WKT
+    reference_csv -- merged 3DBM output with id, obb_width and obb_length
+    tolerance -- maximum difference of a side (m)
+    Returns: DataFrame with the differences per building
+    """
+
+    footprints = pd.read_csv(footprints_csv, names=['bag_id', 'wkt'])
+    reference = pd.read_csv(reference_csv, usecols=['id', 'obb_width', 'obb_length'])
+    reference['bag_id'] = reference['id'].str[:-2]
+
+    wkbs = [None if pd.isna(wkt) else shapely.wkb.dumps(shapely.wkt.loads(wkt)) for wkt in footprints['wkt']]
+
+    start = time()
+    features = compute_features(wkbs)
+    print(f'\n>> Computed {len(wkbs)} footprints in {time() - start:.2f}s' + (' (vectorized)' if SHAPELY2 else ''))
+
+    if SHAPELY2:
+        start = time()
+        compute_features_loop(wkbs)
+        print(f'\n>> Computed {len(wkbs)} footprints in {time() - start:.2f}s (per footprint)')
+
+    features['bag_id'] = footprints['bag_id']
+    merged = features.merge(reference, on='bag_id')
+    merged['length_difference'] = merged['fp_length'] - merged['obb_length']
+    merged['width_difference'] = merged['fp_width'] - merged['obb_width']
+    within = (merged['length_difference'].abs() <= tolerance) & (merged['width_difference'].abs() <= tolerance)
+
+    print(f'\n>> {within.sum()} of {len(merged)} buildings have the same sides as 3DBM within {tolerance}m')
+    print(merged[['length_difference', 'width_difference']].describe())
+    return merged
+
+if __name__ == '__main__':
+    compare_obb(sys.argv[1], sys.argv[2])
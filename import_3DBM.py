@@ -1,61 +1,115 @@
+import glob
+import io
 import json
+import os
 import pandas as pd
 import db_functions
-from sqlalchemy import create_engine
 
-def prepare_3DBM_features(lod):
+#id and 3D Building Metrics to keep as features with their types
+#max_Z and min_Z of roof
+FEATURES = {'id': str, 'actual_volume': 'float32', 'convex_hull_volume': 'float32',
+            'footprint_perimeter': 'float32', 'obb_width': 'float32', 'obb_length': 'float32',
+            'ground_area': 'float32', 'wall_area': 'float32', 'roof_area': 'float32', 'ground_point_count': 'Int32',
+            'max_Z': 'float32', 'min_Z': 'float32', 'ground_Z': 'float32',
+            'hole_count': 'Int32', 'shared_walls_area': 'float32', 'closest_distance': 'float32'}
+
+def read_staging(staging_files, chunk_size):
+    """
+    Read the features from the Parquet staging files written by utilize_3DBM.py.
+    The files are memory-mapped, only the feature columns are read and row groups containing only buildings with holes are skipped.
+    Parameters:
+    staging_files -- paths to the Parquet files of one LoD
+    chunk_size -- maximum number of rows per chunk
+    Returns: generator of DataFrames with the features
+    """
+
+    #pyarrow is only required for the Parquet staging format
+    import pyarrow.parquet as pq
+
+    for staging_file in staging_files:
+        data = pq.read_table(staging_file, columns=list(FEATURES), filters=[('hole_count', '=', 0)], memory_map=True)
+        for batch in data.to_batches(max_chunksize=chunk_size):
+            yield batch.to_pandas().astype(FEATURES)
+
+def prepare_3DBM_features(lod, chunk_size=100000):
+    """
+    Read the features to keep from the 3DBM results in chunks, so memory stays bounded for large case studies.
+    The Parquet staging files are read when staging_format is parquet, the merged .csv file otherwise.
+    Parameters:
+    lod -- 'lod1' or 'lod2'
+    chunk_size -- number of rows per chunk
+    Returns: generator of DataFrames with the features of the buildings without holes
+    """
 
     with open('params.json', 'r') as f:
         params = json.load(f)
 
         path_3DBAG = params['path_3DBAG']
-
-    print(f'\n>> Preparing {lod} 3DBM features from {path_3DBAG}merged_{lod}.csv')
-    
-    #Read the LoD 1.2 or 2.2 .csv files
-    data = pd.read_csv(path_3DBAG+f'merged_{lod}.csv')
-
-    #id and 3D Building Metrics to keep as features
-    #max_Z and min_Z of roof
-    features = ['id','actual_volume','convex_hull_volume',
-                'footprint_perimeter','obb_width','obb_length',
-                'ground_area', 'wall_area', 'roof_area', 'ground_point_count',
-                'max_Z', 'min_Z', 'ground_Z',
-                'hole_count','shared_walls_area', 'closest_distance']
-    data_features = data[features]
-    
-    #Assign LoD to columnnames
-    new_columnnames = ['id']
-    for i in range(len(features)-1):
-        new_columnnames.append(features[i+1] + f'_{lod}')
-    
-    data_features.columns = new_columnnames
-
-    #Remove buildings with holes
-    clean = data_features[data_features[f"hole_count_{lod}"] == 0]
-
-    return clean
-
-def import_3DBM_features(cursor, conn1, lod, table):
-
-    #Prepare the metrics from 3DBM to be imported as features
-    features = prepare_3DBM_features(lod)
+        staging_format = params['staging_format']
+
+    staging_files = sorted(glob.glob(os.path.join(path_3DBAG, 'staging', f'lod={lod}', '*.parquet')))
+
+    if staging_format == 'parquet' and staging_files:
+        print(f'\n>> Preparing {lod} 3DBM features from {len(staging_files)} Parquet files in {path_3DBAG}staging/lod={lod}')
+        reader = read_staging(staging_files, chunk_size)
+    else:
+        if staging_format == 'parquet':
+            print(f'\n>> No Parquet files in {path_3DBAG}staging/lod={lod}, falling back to merged_{lod}.csv')
+        print(f'\n>> Preparing {lod} 3DBM features from {path_3DBAG}merged_{lod}.csv')
+
+        #Read only the features of the LoD 1.2 or 2.2 .csv files
+        reader = pd.read_csv(path_3DBAG+f'merged_{lod}.csv', usecols=list(FEATURES), dtype=FEATURES, chunksize=chunk_size)
+
+    for chunk in reader:
+        data_features = chunk[list(FEATURES)]
+
+        #Assign LoD to columnnames
+        data_features.columns = ['id'] + [f'{feature}_{lod}' for feature in list(FEATURES)[1:]]
+
+        #Remove buildings with holes
+        yield data_features[data_features[f"hole_count_{lod}"] == 0]
+
+def copy_features(cursor, chunks, table, lod):
+    """
+    Load features into the pre-declared table with COPY FROM STDIN, one chunk at a time through an in-memory CSV buffer.
+    Parameters:
+    cursor -- cursor for database connection
+    chunks -- iterable of DataFrames with the columns of the table, see prepare_3DBM_features()
+    table -- table of the case study
+    lod -- 'lod1' or 'lod2'
+    Returns: number of rows loaded
+    """
+
+    rows = 0
+    for chunk in chunks:
+        columns = ', '.join(f'"{column}"' for column in chunk.columns)
+        buffer = io.StringIO()
+        chunk.to_csv(buffer, index=False, header=False)
+        buffer.seek(0)
+        cursor.copy_expert(f"COPY input_data.{table}_{lod}_3dbm ({columns}) FROM STDIN WITH (FORMAT csv)", buffer)
+        rows += len(chunk)
+
+    return rows
+
+def import_3DBM_features(cursor, lod, table):
 
     print(f'\n>> Importing {lod} 3DBM features to database input_data.{table}_{lod}_3dbm')
 
     #Create table to store 3DBM features
+    #max_Z, min_Z and ground_Z are quoted, since extract_features.py and validate_features.py refer to them with capitals
     cursor.execute(f'''
         DROP TABLE IF EXISTS input_data.{table}_{lod}_3dbm;
         CREATE TABLE input_data.{table}_{lod}_3dbm (id VARCHAR, actual_volume_{lod} DOUBLE PRECISION, convex_hull_volume_{lod} DOUBLE PRECISION,
         footprint_perimeter_{lod} DOUBLE PRECISION, obb_width_{lod} DOUBLE PRECISION, obb_length_{lod} DOUBLE PRECISION,
         ground_area_{lod} DOUBLE PRECISION, wall_area_{lod} DOUBLE PRECISION, roof_area_{lod} DOUBLE PRECISION, ground_point_count_{lod} INTEGER,
-        max_Z_{lod} DOUBLE PRECISION, min_Z_{lod} DOUBLE PRECISION, ground_Z_{lod} DOUBLE PRECISION,
+        "max_Z_{lod}" DOUBLE PRECISION, "min_Z_{lod}" DOUBLE PRECISION, "ground_Z_{lod}" DOUBLE PRECISION,
         hole_count_{lod} INTEGER, shared_walls_area_{lod} DOUBLE PRECISION, closest_distance_{lod} DOUBLE PRECISION);
         '''
     )
 
-    #Import 3DBM features
-    features.to_sql(f'{table}_{lod}_3dbm', conn1, schema='input_data', if_exists= 'replace')
+    #Prepare the metrics from 3DBM and import them chunk by chunk with COPY into the typed table
+    rows = copy_features(cursor, prepare_3DBM_features(lod), table, lod)
+    print(f'\n>> Imported {rows} rows to input_data.{table}_{lod}_3dbm')
 
     return
 
@@ -65,30 +119,13 @@ def main():
         
         table = params['table']
 
-    #get db parameters
-    user,password,database,host,port = db_functions.get_db_parameters()
-
-    #create connection to db with the db parameters
-    conn = db_functions.setup_connection(user,password,database,host,port)
-    conn.autocommit = True
-
-    #import connection to db
-    db = create_engine(f'postgresql://{user}:{password}@{host}:{port}/{database}')
-    conn1 = db.connect()
-
-    #create a cursor
-    cursor = conn.cursor()
-
-    lod1 = 'lod1'
-    lod2 = 'lod2'
+    with db_functions.session() as cursor:
+        lod1 = 'lod1'
+        lod2 = 'lod2'
 
-    import_3DBM_features(cursor, conn1, lod1, table)
-    import_3DBM_features(cursor, conn1, lod2, table)
+        import_3DBM_features(cursor, lod1, table)
+        import_3DBM_features(cursor, lod2, table)
 
-    #close db connections
-    db_functions.close_connection(conn, cursor)
-    conn1.commit()
-    conn1.close()
     return
 
 if __name__ == '__main__':
@@ -1,51 +1,58 @@
 import db_functions
 import json
+import sql_profiler
 
-def extract_rh_groundtruth():
+def get_selection_query(table, citydbx):
     """
-    Extract pand bag_id's and building types from Rijssen-Holten open energy test-bed in 3DCityDB schemas
+    Get the query of the labelled buildings of a case study: the bag_id's of the buildings in the 3D City DB schema and their building types,
+    with the columns of training_data.{table} before the extraction of the features. Also used by the incremental extraction
+    (see extract_features.update_base()) to find the buildings added to or removed from the case study.
+    Parameters:
+    table -- table of the case study
+    citydbx -- 3D City DB schema of the case study
+    Returns: query
     """
 
-    #get db parameters
-    user,password,database,host,port = db_functions.get_db_parameters()
-
-    #create connection to 3dcity db
-    conn = db_functions.setup_connection(user,password,database,host,port)
-    conn.autocommit = True
+    if table == 'c1_rh' and citydbx == 'citydb':
+        #NL.IMBAG.Pand.0150100000059983 is manually removed, because its footprint geom in the BAG is faulty
+        return '''
+            SELECT cityobject.gmlid AS bag_id, attrib.building_type
+            FROM citydb.cityobject
+            LEFT JOIN LATERAL
+                (SELECT cityobject_genericattrib.strval AS building_type
+                FROM citydb.cityobject AS labelled, citydb.cityobject_genericattrib
+                WHERE labelled.gmlid = cityobject.gmlid AND labelled.id = cityobject_genericattrib.cityobject_id
+                AND cityobject_genericattrib.attrname = 'dutch_building_type'
+                LIMIT 1) AS attrib ON true
+            WHERE objectclass_id = 26 AND name IS NOT NULL AND gmlid != 'NL.IMBAG.Pand.0150100000059983'
+            '''
+
+    return f'''
+        SELECT cityobject.gmlid AS bag_id, c0_ep.building_type::TEXT[] AS building_type, NULL::VARCHAR AS building_type2
+        FROM {citydbx}.cityobject
+        LEFT JOIN training_data.c0_ep ON c0_ep.bag_id = cityobject.gmlid
+        WHERE objectclass_id = 26
+        '''
 
-    #create a cursor
-    cursor = conn.cursor()
+def extract_rh_groundtruth():
+    """
+    Extract pand bag_id's and building types from Rijssen-Holten open energy test-bed in 3DCityDB schemas
+    """
 
-    print('\n>> Extracting labelled data from energy test-bed Rijssen-Holten to table training_data.c1_rh')
+    with db_functions.session() as cursor:
+        print('\n>> Extracting labelled data from energy test-bed Rijssen-Holten to table training_data.c1_rh')
+        db_functions.invalidate_training_cache('c1_rh')
 
-    #create table with bag_id's of buildings in case study
-    #NL.IMBAG.Pand.0150100000059983 is manually removed, because its footprint geom in the BAG is faulty
-    cursor.execute('''
-        CREATE SCHEMA IF NOT EXISTS training_data;
-        DROP TABLE IF EXISTS training_data.c1_rh;
-        CREATE TABLE training_data.c1_rh AS
-        SELECT gmlid AS bag_id
-        FROM citydb.cityobject
-        WHERE objectclass_id = 26 AND name IS NOT NULL AND gmlid != 'NL.IMBAG.Pand.0150100000059983';
-        '''
-    )
-
-    #add labelled data
-    cursor.execute("ALTER TABLE training_data.c1_rh ADD COLUMN IF NOT EXISTS building_type VARCHAR;")
-    cursor.execute('''
-        UPDATE training_data.c1_rh
-        SET building_type = subquery.building_type
-        FROM
-            (SELECT cityobject.gmlid as bag_id, cityobject_genericattrib.strval AS building_type
-            FROM citydb.cityobject, citydb.cityobject_genericattrib
-            WHERE cityobject.id = cityobject_genericattrib.cityobject_id AND cityobject_genericattrib.attrname = 'dutch_building_type'
-            ORDER BY bag_id) AS subquery
-        WHERE training_data.c1_rh.bag_id = subquery.bag_id
-        '''
-    )
+        #create table with bag_id's of buildings in case study and their labelled data
+        cursor.execute(f'''
+            CREATE SCHEMA IF NOT EXISTS training_data;
+            DROP TABLE IF EXISTS training_data.c1_rh;
+            DROP TABLE IF EXISTS training_data.c1_rh_base;
+            DROP TABLE IF EXISTS training_data.c1_rh_snapshot;
+            CREATE TABLE training_data.c1_rh AS {get_selection_query('c1_rh', 'citydb')};
+            '''
+        )
 
-    #close db connection
-    db_functions.close_connection(conn, cursor)
     return
 
 def extract_ep_groundtruth():
@@ -53,81 +60,48 @@ def extract_ep_groundtruth():
     Extract pand bag_id's and building types from input_data."ep-online"
     """
 
-    #get db parameters
-    user,password,database,host,port = db_functions.get_db_parameters()
-
-    #create connection to db with the db parameters
-    conn = db_functions.setup_connection(user,password,database,host,port)
-    conn.autocommit = True
-
-    #create a cursor
-    cursor = conn.cursor()
-
-    print('\n>> Extracting labelled data from ep-online to table training_data.c0_ep')
-
-    #create table of labelled data (in training_data schema)
-    #extracts the building type from each verblijfsobject in ep-online then linked with verblijfsobject (BAG) dataset to check its status
-    #then linked to pandid via pandref (in verblijfsobject dataset)
-    #the pandref is then also linked to pand (BAG) dataset to check its status as well
-    cursor.execute('''
-        CREATE SCHEMA IF NOT EXISTS training_data;
-        DROP TABLE IF EXISTS training_data.c0_ep;
-        CREATE TABLE training_data.c0_ep AS
-        SELECT bag_id, ARRAY_AGG("ep-online"."Pand_gebouwtype") AS building_type
-        FROM input_data."ep-online", input_data.verblijfsobject, unnest(pandref) AS bag_id, input_data.pand
-        WHERE 'NL.IMBAG.Verblijfsobject.' || "Pand_bagverblijfsobjectid" = verblijfsobject.identificatie
-        AND verblijfsobject.status LIKE 'Verblijfsobject in gebruik%'
-        AND verblijfsobject.eindgeldigheid IS NULL
-        AND bag_id = pand.identificatie
-        AND pand.status LIKE 'Pand in gebruik%'
-        AND pand.eindgeldigheid IS NULL
-        GROUP BY bag_id
-        ORDER BY bag_id ASC;
-        '''
-    )
+    with db_functions.session() as cursor:
+        print('\n>> Extracting labelled data from ep-online to table training_data.c0_ep')
+
+        db_functions.create_vbo_aggregate(cursor)
+
+        #create table of labelled data (in training_data schema)
+        #extracts the building type from each verblijfsobject in ep-online then linked with the verblijfsobjecten in use of each pand
+        #(see db_functions.create_vbo_aggregate())
+        #the pand is then also linked to pand (BAG) dataset to check its status as well
+        cursor.execute('''
+            CREATE SCHEMA IF NOT EXISTS training_data;
+            DROP TABLE IF EXISTS training_data.c0_ep;
+            CREATE TABLE training_data.c0_ep AS
+            SELECT vbo.pandid AS bag_id, ARRAY_AGG("ep-online"."Pand_gebouwtype") AS building_type
+            FROM input_data."ep-online", input_data.verblijfsobject_per_pand AS vbo, unnest(vbo.vbo_ids) AS vbo_id, input_data.pand
+            WHERE 'NL.IMBAG.Verblijfsobject.' || "Pand_bagverblijfsobjectid" = vbo_id
+            AND vbo.pandid = pand.identificatie
+            AND pand.status LIKE 'Pand in gebruik%'
+            AND pand.eindgeldigheid IS NULL
+            GROUP BY vbo.pandid
+            ORDER BY vbo.pandid ASC;
+            '''
+        )
 
-    #close db connection
-    db_functions.close_connection(conn, cursor)
     return
 
 def get_groundtruth(table, citydbx):
 
-    #get db parameters
-    user,password,database,host,port = db_functions.get_db_parameters()
-
-    #create connection to db with the db parameters
-    conn = db_functions.setup_connection(user,password,database,host,port)
-    conn.autocommit = True
+    with db_functions.session() as cursor:
+        print(f'\n>> Creating table {table} with bag_ids from {citydbx} and extract labelled data from c0_ep')
+        db_functions.invalidate_training_cache(table)
 
-    #create a cursor
-    cursor = conn.cursor()
+        #create table with bag_id's of buildings in case study and their labelled data from c0_ep
+        cursor.execute(f'''
+            CREATE SCHEMA IF NOT EXISTS training_data;
+            DROP TABLE IF EXISTS training_data.{table};
+            DROP TABLE IF EXISTS training_data.{table}_base;
+            DROP TABLE IF EXISTS training_data.{table}_snapshot;
+            CREATE TABLE training_data.{table} AS {get_selection_query(table, citydbx)};
+            '''
+        )
 
-    print(f'\n>> Creating table {table} with bag_ids from {citydbx} and extract labelled data from c0_ep')
-
-    #create table with bag_id's of buildings in case study
-    cursor.execute(f'''
-        CREATE SCHEMA IF NOT EXISTS training_data;
-        DROP TABLE IF EXISTS training_data.{table};
-        CREATE TABLE training_data.{table} AS
-        SELECT gmlid AS bag_id
-        FROM {citydbx}.cityobject
-        WHERE objectclass_id = 26;
-        '''
-    )
-
-    #add labelled data
-    cursor.execute(f"ALTER TABLE training_data.{table} ADD COLUMN IF NOT EXISTS building_type text[];")
-    cursor.execute(f"ALTER TABLE training_data.{table} ADD COLUMN IF NOT EXISTS building_type2 VARCHAR;")
-    cursor.execute(f'''
-        UPDATE training_data.{table}
-        SET building_type = c0_ep.building_type
-        FROM training_data.c0_ep
-        WHERE {table}.bag_id = training_data.c0_ep.bag_id
-        '''
-    )
-
-    #close db connection
-    db_functions.close_connection(conn, cursor)
     return
 
 def main():
@@ -136,15 +110,21 @@ def main():
         
         table = params['table']
         citydbx = params['citydbx']
+        profile_sql = params['profile_sql']
+        explain_analyze = params['explain_analyze']
+
+    if profile_sql:
+        sql_profiler.enable(explain_analyze)
 
     #extract_ep_groundtruth()
     
     if table == 'c1_rh' and citydbx == 'citydb':
         extract_rh_groundtruth()
-        return
     else:
         get_groundtruth(table, citydbx)
-        return
+
+    sql_profiler.write_profile(f'{table}_import_groundtruth')
+    return
 
 if __name__ == '__main__':
     main()
\ No newline at end of file
@@ -1,4 +1,5 @@
 import db_functions
+import feature_sets
 import json
 import pandas as pd
 from sklearn.model_selection import train_test_split
@@ -116,6 +117,14 @@ def randomforest_test(table, X_train, y_train, X_test, y_test):
     #permutation based feature importance instead of impurity based (since its strongly biased and favor high cardinality features)
     result = permutation_importance(rf, X_test_scaled, y_test, n_repeats=5, random_state=0)
 
+    #write to csv file
+    with open(f'results/{table}_score_permutation.csv', 'w') as f:
+        sys.stdout = f
+        print(f'feature,name,score')
+        for i in range(len(result.importances_mean)):
+            print(f'{i},{column_names[i]},{result.importances_mean[i]}')
+        sys.stdout = original_stdout
+
     sorted_importances_idx = result.importances_mean.argsort()
     importances = pd.DataFrame(result.importances[sorted_importances_idx].T, columns=X_train.columns[sorted_importances_idx],)
 
@@ -140,23 +149,10 @@ def main():
         params = json.load(f)
         
         table = params['table']
+        feature_cache = params['feature_cache']
 
-    #get db parameters
-    user,password,database,host,port = db_functions.get_db_parameters()
-
-    #create connection to db with the db parameters
-    conn = db_functions.setup_connection(user,password,database,host,port)
-    conn.autocommit = True
-
-    data = pd.read_sql_query(f"SELECT * FROM training_data.{table};", conn)
-
-    #Remove features based on correlation
-    data = data.drop(['actual_volume_lod1',
-                      'convex_hull_volume_lod1',
-                      'convex_hull_volume_lod2',
-                      'wall_area_lod1',
-                      'roof_area_lod1',
-                      'height_max_lod1'], axis='columns')
+    #Load training data without the features removed based on correlation
+    data = db_functions.load_training_table(table, exclude=feature_sets.get_excluded(table), cache=feature_cache)
 
     #split into X (features) and y (target) and then into train and test split (80% - 20%)
     X_train, X_test, y_train, y_test = split_data(data)
@@ -0,0 +1,108 @@
+'''
+Instrumentation of the SQL statements of the pipeline.
+When enabled (see enable()), the connections of db_functions (session()
+and setup_connection()) create cursors that record for every statement the
+function that executed it (the stage), the wall time and the number of rows,
+and optionally run the data-modifying statements with EXPLAIN (ANALYZE, BUFFERS) to keep their plans.
+write_profile() stores the records of a run as CSV and JSON in profiles/
+and prints the slowest stages.
+'''
+
+import json
+import os
+import re
+import sys
+from datetime import datetime
+from time import time
+import pandas as pd
+import psycopg2.extensions
+
+RECORDS = []
+SETTINGS = {'enabled': False, 'explain': False}
+
+#single statements that EXPLAIN ANALYZE can run instead of the statement itself, without a result for the caller
+EXPLAINABLE = re.compile(r'^\s*(UPDATE|INSERT|DELETE|CREATE\s+(UNLOGGED\s+|TEMPORARY\s+)?TABLE\s+\S+\s+AS)\s', re.IGNORECASE)
+
+def enable(explain=False):
+    """
+    Record the statements of all connections created from now on.
+    Parameters:
+    explain -- also run the single UPDATE, INSERT, DELETE and CREATE TABLE AS statements with EXPLAIN (ANALYZE, BUFFERS) (optional)
+    """
+
+    SETTINGS['enabled'] = True
+    SETTINGS['explain'] = explain
+
+def get_cursor_factory():
+    return ProfilingCursor if SETTINGS['enabled'] else None
+
+def is_explainable(query):
+    query = query.strip().rstrip(';')
+    return ';' not in query and EXPLAINABLE.match(query) is not None
+
+def get_plan_rows(plan):
+    """
+    Get the number of rows of a plan of EXPLAIN (ANALYZE, FORMAT JSON), the rows of the input of an UPDATE, INSERT or DELETE.
+    """
+
+    node = plan[0]['Plan']
+    if node['Node Type'] == 'ModifyTable' and node.get('Plans'):
+        node = node['Plans'][0]
+    return node['Actual Rows'] * node.get('Actual Loops', 1)
+
+def record(stage, statement, seconds, rows, plan=None):
+    RECORDS.append({'stage': stage, 'statement': ' '.join(statement.split())[:200], 'seconds': seconds,
+                    'rows': rows if rows is None or rows >= 0 else None, 'plan': plan})
+
+class ProfilingCursor(psycopg2.extensions.cursor):
+    """
+    Cursor that records every statement, see record().
+    """
+
+    def execute(self, query, vars=None):
+        stage = sys._getframe(1).f_code.co_name
+        start = time()
+
+        if SETTINGS['explain'] and isinstance(query, str) and is_explainable(query):
+            super().execute('EXPLAIN (ANALYZE, BUFFERS, FORMAT JSON) ' + query, vars)
+            plan = self.fetchone()[0]
+            record(stage, query, time() - start, get_plan_rows(plan), plan)
+            return
+
+        super().execute(query, vars)
+        record(stage, str(query), time() - start, self.rowcount)
+
+    def copy_expert(self, sql, file, size=8192):
+        stage = sys._getframe(1).f_code.co_name
+        start = time()
+        super().copy_expert(sql, file, size)
+        record(stage, sql, time() - start, self.rowcount)
+
+def write_profile(name, n_stages=15):
+    """
+    Write the recorded statements to profiles/{name}_{time}.csv (without plans) and .json (with plans)
+    and print the stages with the largest total wall time.
+    Parameters:
+    name -- name of the run, e.g. table and script
+    n_stages -- number of stages to print (optional)
+    Returns: DataFrame with the total wall time, number of statements and rows per stage
+    """
+
+    if not RECORDS:
+        return None
+
+    os.makedirs('profiles', exist_ok=True)
+    path = os.path.join('profiles', f'{name}_{datetime.now():%Y%m%d_%H%M%S}')
+
+    records = pd.DataFrame(RECORDS)
+    records.drop(columns='plan').to_csv(path + '.csv', index=False)
+    with open(path + '.json', 'w') as f:
+        json.dump(RECORDS, f, indent=1)
+
+    stages = records.groupby('stage').agg(seconds=('seconds', 'sum'), statements=('seconds', 'size'), rows=('rows', 'sum'))
+    stages = stages.sort_values('seconds', ascending=False)
+    stages['share'] = (stages['seconds'] / stages['seconds'].sum()).round(3)
+
+    print(f'\n>> Profile of {name} written to {path}.csv and {path}.json, slowest stages:')
+    print(stages.head(n_stages).to_string())
+    return stages
@@ -0,0 +1,60 @@
+'''
+3D BAG tile functions shared by utilize_3DBM.py, building_metrics.py and extract_features.py:
+the tiles of the case study, the LoDs of the metrics and the versions of
+the metrics engines used as cache keys.
+'''
+
+import glob
+import hashlib
+import os
+
+#LoD names used in the output files and the corresponding CityJSON LoD
+LODS = {'lod1': '1.2', 'lod2': '2.2'}
+
+#source file of the native metrics engine, hashed as its version
+NATIVE_ENGINE = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'building_metrics.py')
+
+def get_tiles(path_3DBAG):
+    """
+    Get the 3D BAG tiles of the case study, skipping the files created by utilize_3DBM.py.
+    Parameters:
+    path_3DBAG -- path to the folder containing the tiles
+    Returns: sorted list of tile paths
+    """
+
+    return sorted(tile for tile in glob.glob(f'{path_3DBAG}*.json') if not os.path.basename(tile).startswith('merged'))
+
+def hash_file(path, h=None):
+    """
+    Compute the SHA-256 hash of a file, reading it in blocks.
+    """
+
+    h = h if h is not None else hashlib.sha256()
+    with open(path, 'rb') as f:
+        for block in iter(lambda: f.read(1 << 20), b''):
+            h.update(block)
+    return h.hexdigest()
+
+def get_3DBM_version(path_3DBM):
+    """
+    Get the version of 3DBM as hash of its Python source files, so that any change to 3DBM invalidates the cache.
+    """
+
+    h = hashlib.sha256()
+    for source in sorted(glob.glob(os.path.join(path_3DBM, '**', '*.py'), recursive=True)):
+        h.update(os.path.relpath(source, path_3DBM).encode())
+        hash_file(source, h)
+    return h.hexdigest()[:12]
+
+def get_engine_version(engine, path_3DBM):
+    """
+    Get the version of the metrics engine used in the cache keys of the per-tile results.
+    Parameters:
+    engine -- metrics engine, '3DBM' or 'native'
+    path_3DBM -- path to the 3DBM folder
+    Returns: hash of building_metrics.py prefixed with 'native' for the native engine, see get_3DBM_version() for 3DBM
+    """
+
+    if engine == 'native':
+        return 'native' + hash_file(NATIVE_ENGINE)[:12]
+    return get_3DBM_version(path_3DBM)
@@ -1,7 +1,7 @@
 import json
 import db_functions
 import pandas as pd
-import select_features
+import feature_sets
 from sklearn.ensemble import RandomForestClassifier
 from sklearn.svm import LinearSVC, SVC
 from sklearn import preprocessing
@@ -110,6 +110,9 @@ def main():
         params = json.load(f)
         
         table = params['table']
+        feature_cache = params['feature_cache']
+        feature_set_source = params['feature_set_source']
+        n_removed_features = params['n_removed_features']
 
         n_estimators = params['rf_n_estimators']
         max_depth = params['rf_max_depth']
@@ -121,137 +124,30 @@ def main():
         C = params['C']
         max_iter = params['max_iter']
 
-    #get db parameters
-    user,password,database,host,port = db_functions.get_db_parameters()
+    #Load training data without the features removed based on correlation
+    data = db_functions.load_training_table(table, exclude=feature_sets.get_excluded(table), cache=feature_cache)
 
-    #create connection to db with the db parameters
-    conn = db_functions.setup_connection(user,password,database,host,port)
-    conn.autocommit = True
-
-    data = pd.read_sql_query(f"SELECT * FROM training_data.{table};", conn)
-    
-    #Remove features based on correlation
-    data = data.drop(['actual_volume_lod1',
-                      'convex_hull_volume_lod1',
-                      'convex_hull_volume_lod2',
-                      'wall_area_lod1',
-                      'roof_area_lod1',
-                      'height_max_lod1'], axis='columns')
-    
-    #Remove features based on feature selection methods
-    if table == 'c1_rh':
-        anova_features = data.drop(['no_neighbours_25m',
-                                    'roof_area_lod2',
-                                    'fp_perimeter',
-                                    'obb_length_lod1',
-                                    'fp_no_vertices',
-                                    'height_max_lod2',
-                                    'height_min_roof_lod2',
-                                    'bag_construction_year',
-                                    'no_neighbours_75m',
-                                    'no_neighbours_100m',
-                                    'fp_area'], axis='columns')
-
-        mi_features = data.drop(['fp_perimeter',
-                                    'roof_area_lod2',
-                                    'obb_length_lod1',
-                                    'wall_area_lod2',
-                                    'height_max_lod2',
-                                    'height_min_roof_lod2',
-                                    'bag_no_dwellings',
-                                    'fp_no_vertices',
-                                    'no_neighbours_75m',
-                                    'no_neighbours_25m',
-                                    'no_neighbours_100m'], axis='columns')
-
-        impurity_features = data.drop(['roof_area_lod2',
-                                        'wall_area_lod2',
-                                        'fp_perimeter',
-                                        'obb_length_lod1',
-                                        'height_min_roof_lod2',
-                                        'no_neighbours_50m',
-                                        'fp_no_vertices',
-                                        'bag_no_dwellings',
-                                        'no_neighbours_75m',
-                                        'no_neighbours_100m',
-                                        'fp_area'], axis='columns')
-
-        permutation_features = data.drop(['no_neighbours_100m',
-                                        'actual_volume_lod2',
-                                        'fp_perimeter',
-                                        'no_neighbours_75m',
-                                        'no_neighbours_50m',
-                                        'obb_length_lod1',
-                                        'fp_no_vertices',
-                                        'fp_area',
-                                        'height_min_roof_lod2',
-                                        'roof_area_lod2',
-                                        'height_max_lod2'], axis='columns')
-    elif table == 'c2_delft':
-        anova_features = data.drop(['actual_volume_lod2',
-                                    'no_adjacent_of_adja_bldg',
-                                    'roof_area_lod2',
-                                    'height_min_roof_lod2',
-                                    'fp_area',
-                                    'no_neighbours_50m',
-                                    'fp_no_vertices',
-                                    'no_neighbours_25m',
-                                    'no_neighbours_75m',
-                                    'no_neighbours_100m',
-                                    'bag_construction_year'], axis='columns')
-
-        mi_features = data.drop(['wall_area_lod2',
-                                 'height_max_lod2',
-                                 'no_adjacent_bldg',
-                                 'bag_construction_year',
-                                 'no_adjacent_of_adja_bldg',
-                                 'height_min_roof_lod2',
-                                 'fp_no_vertices',
-                                 'no_neighbours_25m',
-                                 'no_neighbours_50m',
-                                 'no_neighbours_100m',
-                                 'no_neighbours_75m'], axis='columns')
-
-        impurity_features = data.drop(['wall_area_lod2',
-                                       'roof_area_lod2',
-                                       'fp_perimeter',
-                                       'obb_length_lod1',
-                                       'height_min_roof_lod2',
-                                       'bag_construction_year',
-                                       'no_neighbours_100m',
-                                       'no_neighbours_75m',
-                                       'no_neighbours_50m',
-                                       'fp_no_vertices',
-                                       'no_neighbours_25m'], axis='columns')
-
-        permutation_features = data.drop(['bag_construction_year',
-                                          'actual_volume_lod2',
-                                          'height_min_roof_lod2',
-                                          'height_max_lod2',
-                                          'roof_area_lod2',
-                                          'no_neighbours_25m',
-                                          'no_neighbours_100m',
-                                          'no_neighbours_50m',
-                                          'fp_no_vertices',
-                                          'fp_perimeter',
-                                          'no_neighbours_75m'], axis='columns')
+    #Feature sets based on feature selection methods, the same train rows for every feature set
+    registry = feature_sets.FeatureRegistry(table, data, n_removed_features, feature_set_source)
+    train, test = registry.split()
+    y_train = registry.labels[train]
 
     #SVC
     # -anova-f features
-    X_train, X_test, y_train, y_test = select_features.split_data(anova_features)
+    X_train = registry.get_frame('anova_f', train)
     cross_validation(X_train, y_train, 'svc', 'tol', tol)
     cross_validation(X_train, y_train, 'svc', 'C', C)
     cross_validation(X_train, y_train, 'svc', 'max_iter', max_iter)
 
     # -mi features
-    X_train, X_test, y_train, y_test = select_features.split_data(mi_features)
+    X_train = registry.get_frame('mi', train)
     cross_validation(X_train, y_train, 'svc', 'tol', tol)
     cross_validation(X_train, y_train, 'svc', 'C', C)
     cross_validation(X_train, y_train, 'svc', 'max_iter', max_iter)
 
     #RANDOM FOREST
     # -impurity features
-    X_train, X_test, y_train, y_test = select_features.split_data(impurity_features)
+    X_train = registry.get_frame('impurity', train)
     cross_validation(X_train, y_train, 'rf', 'n_estimators', n_estimators)
     cross_validation(X_train, y_train, 'rf', 'max_depth', max_depth)
     cross_validation(X_train, y_train, 'rf', 'min_samples_split', min_samples_split)
@@ -260,7 +156,7 @@ def main():
 
 
     # -permutation features
-    X_train, X_test, y_train, y_test = select_features.split_data(permutation_features)
+    X_train = registry.get_frame('permutation', train)
     cross_validation(X_train, y_train, 'rf', 'n_estimators', n_estimators)
     cross_validation(X_train, y_train, 'rf', 'max_depth', max_depth)
     cross_validation(X_train, y_train, 'rf', 'min_samples_split', min_samples_split)
@@ -269,4 +165,4 @@ def main():
     return
 
 if __name__ == '__main__':
-    main()
\ No newline at end of file
+    main()
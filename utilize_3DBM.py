@@ -1,42 +1,375 @@
 '''
-Utilizes cjio and 3DBM to first merge all tiles from case study
-and then filter it into LoD 1.2 and 2.2. Lastly, the 3D Building
-Metrics are computed and stored into .csv files.
+Utilizes the streaming CityJSON reader and 3DBM to first merge all tiles
+from case study and filter it into LoD 1.2 and 2.2 in a single pass.
+Lastly, the 3D Building Metrics are computed and stored into .csv files.
+
+When per_tile is set in params.json the merge is skipped: every tile is
+filtered and computed on its own in a process pool and the results are
+concatenated into the same merged_lod1.csv and merged_lod2.csv files.
+The per-tile results are cached by tile content, LoD and 3DBM version,
+so a rerun only computes new or changed tiles. Without per_tile, the merged
+files can be split in chunks of chunk_size buildings that are recorded in a
+checkpoint, so an interrupted run resumes from the last finished chunk.
+
+With metrics_engine set to native in params.json the metrics are computed
+per tile by building_metrics.py instead of 3DBM. It is not a drop-in
+replacement for 3DBM until its parity check of a full tile passes (see README).
+
+With staging_format set to parquet in params.json the results are written
+as one Parquet file per tile (or chunk) in staging/lod=<lod>/ instead of
+the merged .csv files.
 '''
 
+import building_metrics
+import cityjson_reader
+import glob
+import hashlib
 import json
 import os
+import tile_functions
+from datetime import timedelta
+from multiprocessing import Pool
+from time import time
+import pandas as pd
+
+#number of buildings per row group of the Parquet staging files
+ROW_GROUP_SIZE = 10000
+
+class Progress:
+    """
+    Reports the number of processed buildings per second and the estimated time remaining of a run.
+    Parameters:
+    name -- name of the run to print
+    total -- number of units (tiles or chunks) to process
+    """
+
+    def __init__(self, name, total):
+        self.name = name
+        self.total = total
+        self.units = 0
+        self.buildings = 0
+        self.start = time()
+
+    def update(self, buildings, units=1):
+        self.units += units
+        self.buildings += buildings
+        elapsed = time() - self.start
+        eta = elapsed / self.units * (self.total - self.units)
+        print(f"\n>> {self.name}: {self.units}/{self.total} done, {self.buildings} buildings, "
+              f"{self.buildings / elapsed:.1f} buildings/s, ETA {timedelta(seconds=round(eta))}")
+        return
+
+def count_rows(csv):
+    with open(csv, 'r') as f:
+        return sum(1 for line in f) - 1
+
+def get_tiles_signature(tiles):
+    """
+    Get a signature of the tiles (name, size and modification time), to check whether a checkpoint belongs to the same input.
+    """
+
+    h = hashlib.sha256()
+    for tile in tiles:
+        h.update(f'{os.path.basename(tile)},{os.path.getsize(tile)},{os.path.getmtime(tile)};'.encode())
+    return h.hexdigest()
+
+def save_checkpoint(path, checkpoint):
+    #write to a temporary file first, so an interrupted run never leaves a broken checkpoint
+    with open(path + '.tmp', 'w') as f:
+        json.dump(checkpoint, f, indent=2)
+    os.replace(path + '.tmp', path)
+    return
+
+def load_checkpoint(path, signature):
+    """
+    Load the checkpoint of a previous run on the same tiles, None if there is none or it can not be resumed.
+    A finished chunk of which the .csv file is missing is computed again.
+    """
+
+    if not os.path.exists(path):
+        return None
+
+    with open(path, 'r') as f:
+        checkpoint = json.load(f)
+
+    if checkpoint['tiles'] != signature:
+        print(f"\n>> Checkpoint {path} does not match the tiles in the folder, starting from scratch")
+        return None
+
+    for chunk in checkpoint['chunks']:
+        if chunk['done'] and not os.path.exists(chunk['csv']):
+            print(f"\n>> {chunk['csv']} of a finished chunk is missing, computing the chunk again")
+            chunk['done'] = False
+
+    if not all(os.path.exists(chunk['city']) for chunk in checkpoint['chunks'] if not chunk['done']):
+        print(f"\n>> Checkpoint {path} has unfinished chunks without their merged file, starting from scratch")
+        return None
+    return checkpoint
+
+def stage_tables(tables, path_3DBAG, lod):
+    """
+    Write the metrics to the Parquet staging folder staging/lod=<lod>/ inside path_3DBAG, one file per tile or chunk.
+    Buildings already written for a previous tile are skipped, like the duplicates in concatenate_tiles().
+    Parameters:
+    tables -- list of (name, path to .csv file with the metrics) tuples
+    path_3DBAG -- path to the folder containing the tiles
+    lod -- 'lod1' or 'lod2'
+    """
+
+    staging_dir = os.path.join(path_3DBAG, 'staging', f'lod={lod}')
+    print(f"\n>> Staging {len(tables)} files as Parquet in {staging_dir}")
+
+    #remove the files of a previous run, tiles may have been removed since
+    os.makedirs(staging_dir, exist_ok=True)
+    for old in glob.glob(os.path.join(staging_dir, '*.parquet')):
+        os.remove(old)
+
+    seen = set()
+    for name, csv in tables:
+        data = pd.read_csv(csv)
+        data = data[~data['id'].isin(seen)].drop_duplicates(subset='id')
+        seen.update(data['id'])
+
+        #single precision is enough for the metrics and halves the size of the files
+        data = data.astype({column: 'float32' for column in data.select_dtypes('float64').columns})
+        data.to_parquet(os.path.join(staging_dir, f'{name}.parquet'), index=False, row_group_size=ROW_GROUP_SIZE)
+    return
+
+def compute_merged(path_3DBAG, path_3DBM, chunk_size, staging_format):
+    """
+    Merge all tiles and split LoD 1.2 and 2.2 in one pass, then compute the metrics with 3DBM.
+    The merged file is recorded as one chunk in a checkpoint, so a restarted run does not merge the tiles again.
+    With chunk_size (opt-in) the merged files are split into chunks of about chunk_size buildings (whole tiles),
+    each chunk is computed separately and recorded in the checkpoint, so a restarted run resumes from the last finished chunk.
+    Note: with chunk_size shared_walls_area and closest_distance only take buildings within the same chunk into account.
+    """
+
+    tiles = tile_functions.get_tiles(path_3DBAG)
+    if not tiles:
+        print(f"\nError: no tiles found in {path_3DBAG}")
+        return
+
+    signature = get_tiles_signature(tiles)
+    checkpoint_paths = {lod: f'{path_3DBAG}merged_{lod}.checkpoint.json' for lod in tile_functions.LODS}
+    checkpoints = {lod: load_checkpoint(checkpoint_paths[lod], signature) for lod in tile_functions.LODS}
+
+    #merge all .json files and filter the LoD 1.2 and 2.2 (when not resuming), one tile in memory at a time
+    todo = [lod for lod in tile_functions.LODS if checkpoints[lod] is None]
+    if todo:
+        print(f"\n>> Merging all .json files in {path_3DBAG} and splitting LoD {', '.join(tile_functions.LODS[lod] for lod in todo)} into merged_<lod>_<chunk>.city.json:")
+        chunks = cityjson_reader.split_lods(tiles, {tile_functions.LODS[lod]: f'{path_3DBAG}merged_{lod}.city.json' for lod in todo}, chunk_size or None)
+
+        for lod in todo:
+            if not chunk_size:
+                #one chunk, named like the chunks for a uniform checkpoint
+                os.replace(f'{path_3DBAG}merged_{lod}.city.json', f'{path_3DBAG}merged_{lod}_0.city.json')
+                chunks[tile_functions.LODS[lod]] = [(f'{path_3DBAG}merged_{lod}_0.city.json', chunks[tile_functions.LODS[lod]][0][1])]
+
+            checkpoints[lod] = {'tiles': signature, 'chunks': [{'city': city, 'csv': city.replace('.city.json', '.csv'), 'buildings': n, 'done': False}
+                                                              for city, n in chunks[tile_functions.LODS[lod]]]}
+            save_checkpoint(checkpoint_paths[lod], checkpoints[lod])
+
+    #Compute metrics in LoD 1.2 and LoD 2.2 from merged .json files
+    for lod in tile_functions.LODS:
+        chunks = checkpoints[lod]['chunks']
+        remaining = [chunk for chunk in chunks if not chunk['done']]
+        print(f"\n>> Computing 3D Building Metrics from merged_{lod} ({len(chunks) - len(remaining)}/{len(chunks)} chunks done):")
+
+        progress = Progress(f'3DBM {lod}', len(remaining))
+        for chunk in remaining:
+            if os.system(f"python {path_3DBM}CityStats.py {chunk['city']} -o {chunk['csv']}") != 0:
+                print(f"\nError: 3DBM failed on {chunk['city']}, rerun to resume from this chunk")
+                return
+
+            chunk['done'] = True
+            save_checkpoint(checkpoint_paths[lod], checkpoints[lod])
+            os.remove(chunk['city'])
+            progress.update(chunk['buildings'])
+
+        if staging_format == 'parquet':
+            stage_tables([(f'merged_{k}', chunk['csv']) for k, chunk in enumerate(chunks)], path_3DBAG, lod)
+        else:
+            concatenate_tiles([chunk['csv'] for chunk in chunks], f'{path_3DBAG}merged_{lod}.csv')
+
+        for chunk in chunks:
+            os.remove(chunk['csv'])
+        os.remove(checkpoint_paths[lod])
+    return
+
+def get_halo_tiles(tiles, extents, halo):
+    """
+    Get for every tile the other tiles within halo m of its extent.
+    Returns: dictionary with tile as key and list of adjacent tiles as value
+    """
+
+    halo_tiles = {}
+    for tile, (minx, miny, maxx, maxy) in zip(tiles, extents):
+        halo_tiles[tile] = [other for other, extent in zip(tiles, extents) if other != tile
+                            and extent[0] <= maxx + halo and extent[2] >= minx - halo and extent[1] <= maxy + halo and extent[3] >= miny - halo]
+    return halo_tiles
+
+def remove_files(paths):
+    """
+    Remove the files that exist of a list of paths.
+    """
+
+    for path in paths:
+        if os.path.exists(path):
+            os.remove(path)
+
+def get_tile_hashes(tiles, halo_tiles, n_processes):
+    """
+    Hash the content of every tile once and combine it with the hashes of its halo tiles.
+    Parameters:
+    tiles -- paths to the 3D BAG tiles
+    halo_tiles -- dictionary with tile as key and list of adjacent tiles as value, see get_halo_tiles()
+    n_processes -- number of processes to hash the tiles with
+    Returns: dictionary with tile as key and hash of the tile and its halo tiles as value
+    """
+
+    with Pool(n_processes) as pool:
+        hashes = dict(zip(tiles, pool.map(tile_functions.hash_file, tiles)))
+
+    tile_hashes = {}
+    for tile in tiles:
+        tile_hashes[tile] = hashes[tile]
+        if halo_tiles[tile]:
+            tile_hashes[tile] = hashlib.sha256((hashes[tile] + ''.join(sorted(hashes[other] for other in halo_tiles[tile]))).encode()).hexdigest()
+    return tile_hashes
+
+def compute_tile(tile, tile_hash, path_3DBM, engine, version, cache_dir, halo_tiles=()):
+    """
+    Split LoD 1.2 and 2.2 of a single tile and compute their metrics with 3DBM or the native engine,
+    unless the metrics of a tile with the same content are already in the cache.
+    Parameters:
+    tile -- path to the 3D BAG tile
+    tile_hash -- hash of the tile and its halo tiles, see get_tile_hashes()
+    path_3DBM -- path to 3DBM repository
+    engine -- '3DBM' or 'native'
+    version -- engine version, see tile_functions.get_engine_version()
+    cache_dir -- folder to store the per-tile files in
+    halo_tiles -- adjacent tiles used as neighbours by the native engine, part of tile_hash (optional)
+    Returns: dictionary with LoD as key and path to the .csv file with the metrics of the tile as value, None if a step failed
+    """
+
+    name = os.path.basename(tile).split('.')[0]
+    keys = {lod: f'{tile_hash}_{lod}_{version}' for lod in tile_functions.LODS}
+    tile_csvs = {lod: os.path.join(cache_dir, f'{key}.csv') for lod, key in keys.items()}
+
+    todo = [lod for lod in tile_functions.LODS if not os.path.exists(tile_csvs[lod])]
+    for lod in tile_functions.LODS:
+        if lod not in todo:
+            print(f"\n>> Using cached {lod} 3D Building Metrics of {name}")
+    if not todo:
+        return tile_csvs
+
+    if engine == 'native':
+        for lod in todo:
+            tile_csv_tmp = os.path.join(cache_dir, f'{keys[lod]}.csv.tmp')
+            try:
+                building_metrics.compute_metrics(tile, tile_functions.LODS[lod], halo_tiles).to_csv(tile_csv_tmp, index=False)
+                os.replace(tile_csv_tmp, tile_csvs[lod])
+            finally:
+                remove_files([tile_csv_tmp])
+            print(f"\n>> Computed {lod} building metrics of {name} with the native engine")
+        return tile_csvs
+
+    tile_lods = {lod: os.path.join(cache_dir, f'{keys[lod]}.city.json') for lod in todo}
+    #write to a temporary file first, so an interrupted run leaves no incomplete cache entry
+    tile_csv_tmps = {lod: os.path.join(cache_dir, f'{keys[lod]}.csv.tmp') for lod in todo}
+
+    try:
+        cityjson_reader.split_lods([tile], {tile_functions.LODS[lod]: tile_lods[lod] for lod in todo})
+
+        for lod in todo:
+            if os.system(f"python {path_3DBM}CityStats.py {tile_lods[lod]} -o {tile_csv_tmps[lod]} > /dev/null") != 0:
+                print(f"\nError: 3DBM failed on {tile_lods[lod]}")
+                tile_csvs[lod] = None
+                continue
+
+            os.replace(tile_csv_tmps[lod], tile_csvs[lod])
+            print(f"\n>> Computed {lod} 3D Building Metrics of {name}")
+    finally:
+        #remove the split tiles and partial outputs, also when 3DBM failed or the run was interrupted
+        remove_files(list(tile_lods.values()) + list(tile_csv_tmps.values()))
+    return tile_csvs
+
+def compute_tile_star(args):
+    #unpack the arguments for Pool.imap_unordered and keep track of the tile
+    return args[0], compute_tile(*args)
+
+def concatenate_tiles(tile_csvs, output):
+    """
+    Concatenate the per-tile metrics into one .csv file with the same columns as the merged 3DBM output.
+    """
+
+    print(f"\n>> Concatenating {len(tile_csvs)} files into {output}")
+
+    data = pd.concat([pd.read_csv(tile_csv) for tile_csv in tile_csvs], ignore_index=True)
+    data = data.drop_duplicates(subset='id')
+    data.to_csv(output, index=False)
+    return
+
+def compute_per_tile(path_3DBAG, path_3DBM, n_processes, engine, staging_format):
+    """
+    Compute the metrics of every tile and LoD in a process pool without merging the tiles first.
+    Note: with 3DBM shared_walls_area and closest_distance only take buildings within the same tile into account,
+    the native engine also uses the buildings of the adjacent tiles within building_metrics.HALO m.
+    """
+
+    tiles = tile_functions.get_tiles(path_3DBAG)
+    version = tile_functions.get_engine_version(engine, path_3DBM)
+    cache_dir = os.path.join(path_3DBAG, 'cache')
+    os.makedirs(cache_dir, exist_ok=True)
+
+    print(f"\n>> Computing 3D Building Metrics of {len(tiles)} tiles in {path_3DBAG} with {n_processes} processes:")
 
-with open('params.json', 'r') as f:
-    params = json.load(f)
+    halo_tiles = {tile: [] for tile in tiles}
+    if engine == 'native':
+        with Pool(n_processes) as pool:
+            extents = pool.map(cityjson_reader.get_extent, tiles)
+        halo_tiles = get_halo_tiles(tiles, extents, building_metrics.HALO)
+    tile_hashes = get_tile_hashes(tiles, halo_tiles, n_processes)
 
-    path_3DBAG = params['path_3DBAG']
-    path_3DBM = params['path_3DBM']
+    results = {}
+    progress = {lod: Progress(f'{engine} {lod}', len(tiles)) for lod in tile_functions.LODS}
+    with Pool(n_processes) as pool:
+        for tile, result in pool.imap_unordered(compute_tile_star, [(tile, tile_hashes[tile], path_3DBM, engine, version, cache_dir, halo_tiles[tile]) for tile in tiles]):
+            results[tile] = result
+            for lod in tile_functions.LODS:
+                progress[lod].update(count_rows(result[lod]) if result[lod] is not None else 0)
 
-#Uncomment to remove previously created files
-if os.path.exists(f"{path_3DBAG}merged.city.json"):
-  print(f"\n>> {path_3DBAG}merged.city.json already exists, removing...")
-  os.remove(f"{path_3DBAG}merged.city.json")
-if os.path.exists(f"{path_3DBAG}merged_lod1.city.json"):
-  print(f"\n>> {path_3DBAG}merged_lod1.city.json already exists, removing...")
-  os.remove(f"{path_3DBAG}merged_lod1.city.json".format(path_3DBAG))
-if os.path.exists(f"{path_3DBAG}merged_lod2.city.json".format(path_3DBAG)):
-  print(f"\n>> {path_3DBAG}merged_lod2.city.json already exists, removing...")
-  os.remove(f"{path_3DBAG}merged_lod2.city.json")
+    for lod in tile_functions.LODS:
+        tile_csvs = [results[tile][lod] for tile in tiles]
+        failed = [tile for tile, tile_csv in zip(tiles, tile_csvs) if tile_csv is None]
+        if failed:
+            print(f"\nError: {len(failed)} tiles failed for {lod}, the {lod} results are not written: {failed}")
+            continue
 
-#use cjio to merge all .json files into one and filter the LoD 1.2 and 2.2
-print(f"\n>> Merging all .json files in {path_3DBAG} into merged.city.json using cjio:")
-os.system(f"cjio empty.city.json merge '{path_3DBAG}*.json' save {path_3DBAG}merged.city.json")
+        if staging_format == 'parquet':
+            stage_tables([(os.path.basename(tile).split('.')[0], tile_csv) for tile, tile_csv in zip(tiles, tile_csvs)], path_3DBAG, lod)
+        else:
+            concatenate_tiles(tile_csvs, f'{path_3DBAG}merged_{lod}.csv')
+    return
 
-print("\n>> Splitting LoD 1.2 of merged.city.json using cjio:")
-os.system(f"cjio {path_3DBAG}merged.city.json lod_filter 1.2 save {path_3DBAG}merged_lod1.city.json")
+def main():
+    with open('params.json', 'r') as f:
+        params = json.load(f)
 
-print("\n>> Splitting LoD 2.2 of merged.city.json using cjio:")
-os.system(f"cjio {path_3DBAG}merged.city.json lod_filter 2.2 save {path_3DBAG}merged_lod2.city.json")
+        path_3DBAG = params['path_3DBAG']
+        path_3DBM = params['path_3DBM']
+        per_tile = params['per_tile']
+        n_processes = params['n_processes']
+        engine = params['metrics_engine']
+        chunk_size = params['chunk_size']
+        staging_format = params['staging_format']
 
-#Compute metrics in LoD 1.2 and LoD 2.2 from merged .json file
-print("\n>> Computing 3D Building Metrics from merged_lod1.city.json:")
-os.system(f"python {path_3DBM}CityStats.py {path_3DBAG}merged_lod1.city.json -o {path_3DBAG}merged_lod1.csv")
+    #the native engine always works per tile
+    if per_tile or engine == 'native':
+        compute_per_tile(path_3DBAG, path_3DBM, n_processes, engine, staging_format)
+    else:
+        compute_merged(path_3DBAG, path_3DBM, chunk_size, staging_format)
+    return
 
-print("\n>> Computing 3D Building Metrics from merged_lod2.city.json:")
-os.system(f"python {path_3DBM}CityStats.py {path_3DBAG}merged_lod2.city.json -o {path_3DBAG}merged_lod2.csv")
\ No newline at end of file
+if __name__ == '__main__':
+    main()
@@ -5,6 +5,8 @@ Functions to validate features
 import json
 import db_functions
 import extract_features
+import sql_profiler
+from time import time
 
 def create_temp_validation_table(cursor, table, pkey=None):
     
@@ -37,76 +39,21 @@ def validate_no_adjacent_bldg(cursor, table, buffer_size):
     #needed for other features
     extract_features.get_footprint(cursor, table)
 
-    extract_features.get_num_adjacent_bldg(cursor, table, buffer_size)
-    
-    extract_features.get_num_adjacent_bldg_of_adjacent_bldg(cursor, table)
-
-    #compare with using buffer 0.30
-    #create new buffer
+    #compare with using buffer 0.30, both from the same adjacency graph
     size = 0.30
-    print(f'\n>> Dataset {table} -- computing buffers of {size}m around footprints')
-
-    cursor.execute(f"ALTER TABLE training_data.{table}_tmp ADD COLUMN IF NOT EXISTS footprint_buffer030 GEOMETRY;")
-
-    cursor.execute(f'''
-        UPDATE training_data.{table}_tmp
-        SET footprint_buffer030 = subquery.buffer
-        FROM
-            (SELECT bag_id, ST_Buffer(footprint_geom, {size}, 'join=mitre') AS buffer
-            FROM training_data.{table}_tmp) AS subquery
-        WHERE training_data.{table}_tmp.bag_id = subquery.bag_id;
-        '''
-    )
+    extract_features.compute_adjacency(cursor, table, [buffer_size, size])
 
-    cursor.execute(f'''
-        CREATE INDEX IF NOT EXISTS {table}_buf_idx_tmp
-        ON training_data.{table}_tmp
-        USING GIST (footprint_buffer030);
-        '''
-    )
+    extract_features.get_num_adjacent_bldg(cursor, table, buffer_size)
+    
+    extract_features.get_num_adjacent_bldg_of_adjacent_bldg(cursor, table, buffer_size)
 
     # Extract number of adjacent buildings based on buffer of 0.30m
-    cursor.execute(f"ALTER TABLE training_data.{table}_tmp ADD COLUMN IF NOT EXISTS no_adjacent_bldg030 INTEGER;")
+    extract_features.get_num_adjacent_bldg(cursor, table, size, column='no_adjacent_bldg030')
 
-    cursor.execute(f'''
-        UPDATE training_data.{table}_tmp
-        SET no_adjacent_bldg030 = subquery.no_adjacent
-        FROM
-            (SELECT a.bag_id, COUNT(*) AS no_adjacent
-            FROM training_data.{table}_tmp AS a
-            JOIN training_data.{table}_tmp AS b ON ST_INTERSECTS(a.footprint_buffer030, b.footprint_geom)
-            WHERE a.bag_id != b.bag_id
-            AND a.bag_function != 'Others' AND a.bag_function != 'Unknown' 
-            AND b.bag_function != 'Others' AND b.bag_function != 'Unknown' 
-            GROUP BY a.bag_id) AS subquery
-        WHERE training_data.{table}_tmp.bag_id = subquery.bag_id;
-        '''
-    )
-
-    cursor.execute(f"ALTER TABLE training_data.{table}_tmp ADD COLUMN IF NOT EXISTS no_adjacent_of_adja_bldg030 INTEGER;")
+    extract_features.get_num_adjacent_bldg_of_adjacent_bldg(cursor, table, size, column='no_adjacent_of_adja_bldg030')
 
-    cursor.execute(f'''
-        UPDATE training_data.{table}_tmp
-        SET no_adjacent_of_adja_bldg030 = subquery.no_adjacent_of_adja_bldg
-        FROM
-            (SELECT a.bag_id, MAX(b.no_adjacent_bldg) AS no_adjacent_of_adja_bldg
-            FROM training_data.{table}_tmp AS a
-            JOIN training_data.{table}_tmp AS b ON ST_INTERSECTS(a.footprint_buffer030, b.footprint_geom)
-            WHERE a.bag_id != b.bag_id
-            GROUP BY a.bag_id) AS subquery
-        WHERE training_data.{table}_tmp.bag_id = subquery.bag_id;
-        '''
-    )
-    
-    # Set number of adjacent buildings equal to zero when column is null
-    # (except from when footprint geometry is equal to null)
-    cursor.execute(f'''
-        UPDATE training_data.{table}_tmp
-        SET no_adjacent_bldg030 = 0 
-        WHERE no_adjacent_bldg030 IS NULL
-        AND footprint_geom IS NOT NULL;
-        '''
-    )
+    #the adjacency graph is only needed for the counts above
+    cursor.execute(f"DROP TABLE training_data.{table}_adjacency;")
     return
 
 def validate_no_neighbours(cursor, table, neighbour_distances):
@@ -224,6 +171,49 @@ def validate_obb(cursor, table):
 
     return
 
+def validate_length_width(cursor, table, case_table, tolerance=0.1):
+    """
+    Compare fp_length and fp_width of get_mbr() with obb_length and obb_width of 3DBM (lod1) and with the previous sides of get_mbr(),
+    the x and y extent of the oriented envelope, and time both. Needs the footprints, see validate_obb().
+    Parameters:
+    cursor -- cursor for database connection
+    table -- validation table
+    case_table -- table of the case study, with the 3DBM features in input_data.{case_table}_lod1_3dbm
+    tolerance -- maximum difference of a side (m)
+    Returns: none
+    """
+
+    start = time()
+    extract_features.get_bldg_length_width(cursor, table)
+    print(f'\n>> Dataset {table} -- sides of minimum bounding box from its edges in {time() - start:.1f}s')
+
+    start = time()
+    cursor.execute(f'''
+        DROP TABLE IF EXISTS {table}_aabb;
+        CREATE TEMPORARY TABLE {table}_aabb AS
+        SELECT bag_id, GREATEST(ST_XMax(bbox) - ST_XMin(bbox), ST_YMax(bbox) - ST_YMin(bbox)) AS fp_length,
+        LEAST(ST_XMax(bbox) - ST_XMin(bbox), ST_YMax(bbox) - ST_YMin(bbox)) AS fp_width
+        FROM (SELECT bag_id, ST_OrientedEnvelope(footprint_geom) AS bbox FROM training_data.{table}_tmp) AS mbr;
+        '''
+    )
+    print(f'\n>> Dataset {table} -- sides of minimum bounding box from its x and y extent in {time() - start:.1f}s')
+
+    for name, sides in [('edges', f'training_data.{table}_tmp'), ('x and y extent', f'{table}_aabb')]:
+        cursor.execute(f'''
+            SELECT COUNT(*),
+            COUNT(*) FILTER (WHERE ABS(s.fp_length - m.obb_length_lod1) <= {tolerance} AND ABS(s.fp_width - m.obb_width_lod1) <= {tolerance}),
+            AVG(ABS(s.fp_length - m.obb_length_lod1)), AVG(ABS(s.fp_width - m.obb_width_lod1))
+            FROM {sides} AS s
+            JOIN input_data.{case_table}_lod1_3dbm AS m ON LEFT(m.id, -2) = s.bag_id;
+            '''
+        )
+        n, n_within, length_difference, width_difference = cursor.fetchone()
+        print(f'\n>> Dataset {table} -- {name}: {n_within} of {n} buildings have the same sides as 3DBM within {tolerance}m, ' +
+              f'mean difference of length {length_difference} and width {width_difference}')
+
+    cursor.execute(f"DROP TABLE {table}_aabb;")
+    return
+
 def validate_surface_areas(cursor, table):
 
     cursor.execute(f"ALTER TABLE training_data.{table}_tmp ADD COLUMN IF NOT EXISTS roof_area_lod1_postgis DOUBLE PRECISION;")
@@ -384,49 +374,172 @@ def get_height_values_3DBM(cursor, table, lod):
     )
     return
 
+def compare_features(cursor, table1, table2):
+    """
+    Compare the features of training_data.{table1}_tmp and training_data.{table2}_tmp per building.
+    Returns: dictionary with column as key and number of buildings with a different value (or missing in one table) as value
+    """
+
+    cursor.execute(f'''
+        SELECT column_name FROM information_schema.columns
+        WHERE table_schema = 'training_data' AND table_name = '{table1}_tmp' AND column_name != 'bag_id'
+        ORDER BY ordinal_position;
+        '''
+    )
+    columns = [column for (column,) in cursor.fetchall()]
+
+    #geometries are compared with ST_Equals, the other columns must be equal
+    differences = ', '.join(
+        f'COUNT(*) FILTER (WHERE a.bag_id IS NULL OR b.bag_id IS NULL OR NOT ST_Equals(a."{column}", b."{column}"))' if column == 'footprint_geom' else
+        f'COUNT(*) FILTER (WHERE a.bag_id IS NULL OR b.bag_id IS NULL OR a."{column}" IS DISTINCT FROM b."{column}")'
+        for column in columns)
+
+    cursor.execute(f'''
+        SELECT {differences}
+        FROM training_data.{table1}_tmp AS a
+        FULL JOIN training_data.{table2}_tmp AS b ON a.bag_id = b.bag_id;
+        '''
+    )
+    return dict(zip(columns, cursor.fetchone()))
+
+def compare_partitioned_extraction(cursor, table, v3table, v4table, extents, partition_halo, n_processes, buffer_size, footprint_engine):
+    """
+    Extract the footprint features (see extract_features.get_footprint_features()) of the buildings of training_data.{v3table} without partitions
+    and of the same buildings in training_data.{v4table} per partition, and compare them.
+    Returns: dictionary with column as key and number of buildings with a different value as value, see compare_features()
+    """
+
+    neighbour_distances = [25, 50, 75, 100]
+
+    print(f'\n>> Dataset {table} -- extracting footprint features without partitions')
+    extract_features.get_footprint_features(cursor, v3table, buffer_size, neighbour_distances, True, False, footprint_engine)
+
+    print(f'\n>> Dataset {table} -- extracting footprint features per partition')
+    extract_features.extract_partitioned(cursor, v4table, extents, partition_halo, n_processes, buffer_size, neighbour_distances, True, False, footprint_engine)
+
+    differences = compare_features(cursor, v3table, v4table)
+    for column, n in differences.items():
+        print(f'\n>> Dataset {table} -- {column}: {n} buildings differ between partitioned and unpartitioned extraction')
+
+    if any(differences.values()):
+        print(f'\nError: partitioned extraction of {table} differs, compare training_data.{v3table}_tmp with training_data.{v4table}_tmp')
+    else:
+        print(f'\n>> Dataset {table} -- partitioned extraction is equal to unpartitioned extraction')
+    return differences
+
+def validate_partitions(cursor, table, buffer_size, path_3DBAG, partition_halo, n_processes, footprint_engine):
+    """
+    Compare the footprint features extracted per partition (the 3D BAG tiles) with the ones extracted without partitions.
+    """
+
+    v3table = 'validate3_' + table
+    v4table = 'validate4_' + table
+
+    for vtable in [v3table, v4table]:
+        cursor.execute(f"DROP TABLE IF EXISTS training_data.{vtable};")
+        cursor.execute(f"CREATE TABLE training_data.{vtable} AS SELECT bag_id FROM training_data.{table};")
+
+    extents = extract_features.get_partition_extents(path_3DBAG)
+    return compare_partitioned_extraction(cursor, table, v3table, v4table, extents, partition_halo, n_processes, buffer_size, footprint_engine)
+
+def validate_partition_halo(cursor, table, buffer_size, partition_halo, footprint_engine, n_buildings=500):
+    """
+    Compare partitioned with unpartitioned extraction for a small sample: the n_buildings buildings of training_data.{table}
+    nearest to its first building, split into two partitions at the median x coordinate of their centroids,
+    so that the adjacency, neighbour and block features of the buildings along the split depend on the halo.
+    Independent of the 3D BAG tiles, so it also runs for case studies within a single tile.
+    """
+
+    v5table = 'validate5_' + table
+    v6table = 'validate6_' + table
+
+    cursor.execute(f'''
+        DROP TABLE IF EXISTS {table}_sample;
+        CREATE TEMPORARY TABLE {table}_sample AS
+        WITH footprints AS
+            (SELECT t.bag_id, pand.footprint_geom
+            FROM training_data.{table} AS t
+            JOIN LATERAL
+                (SELECT wkb_geometry AS footprint_geom
+                FROM input_data.pand WHERE identificatie = t.bag_id LIMIT 1) AS pand ON true)
+        SELECT f.bag_id, f.footprint_geom
+        FROM footprints AS f, (SELECT footprint_geom FROM footprints ORDER BY bag_id LIMIT 1) AS seed
+        ORDER BY f.footprint_geom <-> seed.footprint_geom
+        LIMIT {n_buildings};
+        '''
+    )
+
+    cursor.execute(f'''
+        SELECT ST_XMin(extent), ST_YMin(extent), ST_XMax(extent), ST_YMax(extent), split
+        FROM
+            (SELECT ST_Extent(footprint_geom) AS extent,
+            percentile_cont(0.5) WITHIN GROUP (ORDER BY ST_X(ST_Centroid(footprint_geom))) AS split
+            FROM {table}_sample) AS sample;
+        '''
+    )
+    minx, miny, maxx, maxy, split = cursor.fetchone()
+    extents = [[minx, miny, split, maxy], [split, miny, maxx, maxy]]
+
+    for vtable in [v5table, v6table]:
+        cursor.execute(f"DROP TABLE IF EXISTS training_data.{vtable};")
+        cursor.execute(f"CREATE TABLE training_data.{vtable} AS SELECT bag_id FROM {table}_sample;")
+    cursor.execute(f"DROP TABLE {table}_sample;")
+
+    print(f'\n>> Dataset {table} -- validating the halo with {n_buildings} buildings split into two partitions at x = {split:.1f}')
+    return compare_partitioned_extraction(cursor, table, v5table, v6table, extents, partition_halo, 2, buffer_size, footprint_engine)
+
 def main():
     with open('params.json', 'r') as f:
         params = json.load(f)
         
         table = params['table']
         buffer_size = params['buffer_size']
+        path_3DBAG = params['path_3DBAG']
+        partition_halo = params['partition_halo']
+        n_processes = params['n_processes']
+        footprint_engine = params['footprint_engine']
+        profile_sql = params['profile_sql']
+        explain_analyze = params['explain_analyze']
 
-    #get db parameters
-    user,password,database,host,port = db_functions.get_db_parameters()
+    if profile_sql:
+        sql_profiler.enable(explain_analyze)
 
-    #create connection to db with the db parameters
-    conn = db_functions.setup_connection(user,password,database,host,port)
-    conn.autocommit = True
+    with db_functions.session() as cursor:
+        #uses and number of dwellings per pand, see db_functions.create_vbo_aggregate()
+        db_functions.create_vbo_aggregate(cursor)
 
-    #create a cursor
-    cursor = conn.cursor()
+        v1table = 'validate1_' + table
+        #create temporary validation table of all buildings to store data used for validation of the features
+        create_temp_validation_table(cursor, v1table, pkey='bag_id')
 
-    v1table = 'validate1_' + table
-    #create temporary validation table of all buildings to store data used for validation of the features
-    create_temp_validation_table(cursor, v1table, pkey='bag_id')
+        #adjacency
+        validate_no_adjacent_bldg(cursor, v1table, buffer_size)
 
-    #adjacency
-    validate_no_adjacent_bldg(cursor, v1table, buffer_size)
+        #neighbours
+        validate_no_neighbours(cursor, v1table, [25, 50, 75, 100])
 
-    #neighbours
-    validate_no_neighbours(cursor, v1table, [25, 50, 75, 100])
+        #volumes
+        validate_volumes(cursor, v1table)
 
-    #volumes
-    validate_volumes(cursor, v1table)
+        v2table = 'validate2_' + table
+        #create ANOTHER temporary validation table of all buildings to store data used for validation of the features
+        create_temp_validation_table(cursor, v2table, pkey='bag_id')
 
-    v2table = 'validate2_' + table
-    #create ANOTHER temporary validation table of all buildings to store data used for validation of the features
-    create_temp_validation_table(cursor, v2table, pkey='bag_id')
+        #obb
+        validate_obb(cursor, v2table)
+        validate_length_width(cursor, v2table, table)
 
-    #obb
-    validate_obb(cursor, v2table)
+        #surface areas
+        validate_surface_areas(cursor, v2table)
 
-    #surface areas
-    validate_surface_areas(cursor, v2table)
+        #height
+        validate_height_values(cursor, v2table)
 
-    #height
-    validate_height_values(cursor, v2table)
+        #partitioned extraction
+        validate_partitions(cursor, table, buffer_size, path_3DBAG, partition_halo, n_processes, footprint_engine)
+        validate_partition_halo(cursor, table, buffer_size, partition_halo, footprint_engine)
 
+    sql_profiler.write_profile(f'{table}_validate_features')
     return
 
 if __name__ == '__main__':